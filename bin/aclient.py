@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+#
+#       Author:  Peter Harding  <plh@performiq.com.au>
+#                PerformIQ Pty. Ltd.
+#
+#                Mobile:  0418 375 085
+#
+#          Copyright (C) 1994-2016, Peter Harding
+#                        All rights reserved
+#
+#---------------------------------------------------------------------
+"""
+Purpose:
+
+  asyncio implementation of the DataServer client API (Python 3)
+
+  Usage:
+
+     ds = await aclient.connect(port=PORT)
+
+     (type_ref, attributes)  = await ds.RegisterType(table_name)
+
+     row  = await ds.GetNext(type_ref)
+     rows = await asyncio.gather(*[ds.GetNext(type_ref) for i in range(100)])
+
+     await ds.Close()
+
+  The methods mirror client.Connection - RegisterType, GetNext,
+  GetHashed, GetNextKeyed, GetRandomKeyed, GetIndexed, GetWeighted,
+  Checkout, Commit, Release, StoreCsvData, StoreKeyedData, Flush, Compact
+  and the block methods - but are coroutines.
+
+  Notes:
+
+   i)    The connection always uses the framed (v2) wire protocol.
+         Each request is written as soon as it is made and replies are
+         matched to requests in order, so any number of requests can
+         be outstanding on one connection without a thread each.
+
+   ii)   Rows are returned as str decoded with ENCODING (latin-1 by
+         default, which passes every byte through unchanged).
+
+   iii)  To measure a source:
+
+           $ aclient.py -p <port> -t <table> -n <requests> -c <concurrency>
+"""
+#---------------------------------------------------------------------
+
+import re
+import sys
+import time
+import struct
+import getopt
+import asyncio
+import collections
+
+#---------------------------------------------------------------------
+
+__id__            = "@(#)  aclient.py  [1.0.0]  2026-10-18"
+__version__       = re.search(r'.*\[([^\]]*)\].*', __id__).group(1)
+
+HOST              = 'localhost'
+PORT              = 9578
+
+debug_level       = 0
+
+ENCODING          = 'latin-1'
+
+PROTOCOL_V2       = 2
+
+FRAME_HEADER      = struct.Struct('!I')       #  Frame body length
+REQUEST_HEADER    = struct.Struct('!Bi')      #  Opcode, source handle
+
+OPCODES           = {
+                       'INIT'  : 1,
+                       'REG'   : 2,
+                       'REGK'  : 3,
+                       'REGI'  : 4,
+                       'GETN'  : 5,
+                       'GETKS' : 6,
+                       'GETK'  : 7,
+                       'GETKR' : 8,
+                       'GETH'  : 9,
+                       'GETI'  : 10,
+                       'STOC'  : 11,
+                       'STOK'  : 12,
+                       'GETNB' : 13,
+                       'GETKB' : 14,
+                       'GETIR' : 15,
+                       'STATS' : 16,
+                       'FLUSH' : 17,
+                       'COMPACT' : 18,
+                       'GETW'  : 19,
+                       'GETWB' : 20,
+                       'CHECKOUT' : 21,
+                       'COMMIT' : 22,
+                       'RELEASE' : 23,
+                    }
+
+ROW_SEPARATOR     = '\n'           #  Between rows in block replies
+
+#=====================================================================
+
+class Py2Unmarshaller:
+   """
+   The servers run under Python 2 and send attributes as marshal data.
+   Python 3's marshal can not read the string references Python 2 uses
+   for repeated interned strings, so the subset of types the servers
+   send is decoded here.
+   """
+
+   def __init__(self, data):
+      self.Data     = data
+      self.Pos      = 0
+      self.Interned = []
+
+   def read(self, n):
+      s = self.Data[self.Pos:self.Pos + n]
+      self.Pos += n
+      return s
+
+   def int32(self):
+      return struct.unpack('<i', self.read(4))[0]
+
+   def load(self):
+      code = self.read(1)
+
+      if code == b'0':                           # NULL - ends a dict
+         return None
+      elif code == b'N':
+         return None
+      elif code == b'T':
+         return True
+      elif code == b'F':
+         return False
+      elif code == b'i':
+         return self.int32()
+      elif code == b'I':
+         return struct.unpack('<q', self.read(8))[0]
+      elif code == b'l':
+         n      = self.int32()
+         digits = [struct.unpack('<H', self.read(2))[0] for i in range(abs(n))]
+         value  = sum([d << (15 * i) for (i, d) in enumerate(digits)])
+         return -value if n < 0 else value
+      elif code == b'g':
+         return struct.unpack('<d', self.read(8))[0]
+      elif code == b'f':
+         return float(self.read(ord(self.read(1))))
+      elif code in (b's', b't', b'u'):
+         s = self.read(self.int32()).decode('utf-8' if code == b'u' else ENCODING)
+         if code == b't':
+            self.Interned.append(s)
+         return s
+      elif code == b'R':
+         return self.Interned[self.int32()]
+      elif code in (b'(', b'['):
+         items = [self.load() for i in range(self.int32())]
+         return tuple(items) if code == b'(' else items
+      elif code == b'{':
+         d = {}
+         while True:
+            key = self.load()
+            if key is None:
+               return d
+            d[key] = self.load()
+      else:
+         raise ValueError('Unsupported marshal type %r' % code)
+
+#---------------------------------------------------------------------
+
+def unmarshal(data):
+   return Py2Unmarshaller(data).load()
+
+#=====================================================================
+
+class AsyncConnection:
+   DELIM          = ','
+
+   def __init__(self, reader, writer):
+      "Use connect() - the INIT handshake has to be awaited"
+
+      self.reader     = reader
+      self.writer     = writer
+      self.pending    = collections.deque()     # Futures in request order
+      self.attributes = None
+      self.sources    = {}
+      self.receiver   = None
+
+   #------------------------------------------------------------------
+
+   async def Init(self):
+      # The INIT itself is plain text - the reply is the first frame
+
+      self.writer.write(("INIT|Python|%d" % PROTOCOL_V2).encode(ENCODING))
+
+      self.attributes = unmarshal(await self.ReadFrame())
+      self.receiver   = asyncio.ensure_future(self.Receive())
+
+      if debug_level > 0:  print('AsyncConnection.attributes -> "%s"' % self.attributes)
+
+   #------------------------------------------------------------------
+
+   async def ReadFrame(self):
+      (length,) = FRAME_HEADER.unpack(await self.reader.readexactly(FRAME_HEADER.size))
+
+      return await self.reader.readexactly(length)
+
+   #------------------------------------------------------------------
+
+   async def Receive(self):
+      "Hand each reply frame to the oldest outstanding request"
+
+      try:
+         while True:
+            data = await self.ReadFrame()
+
+            future = self.pending.popleft()
+
+            if not future.cancelled():
+               future.set_result(data)
+      except (asyncio.IncompleteReadError, ConnectionError, IndexError) as e:
+         self.Fail(ConnectionError('Connection closed by data server'))
+      except asyncio.CancelledError:
+         self.Fail(ConnectionError('Connection closed'))
+         raise
+
+   #------------------------------------------------------------------
+
+   def Fail(self, e):
+      while self.pending:
+         future = self.pending.popleft()
+         if not future.done():
+            future.set_exception(e)
+
+   #------------------------------------------------------------------
+
+   async def RequestBytes(self, op, type_ref=-1, *args):
+      if self.writer is None:
+         raise ConnectionError('Connection closed')
+
+      body = REQUEST_HEADER.pack(OPCODES[op], type_ref) + \
+             '|'.join([str(arg) for arg in args]).encode(ENCODING)
+
+      future = asyncio.get_running_loop().create_future()
+
+      # Queue the future and write the frame with no await in between
+      # so replies stay in request order
+
+      self.pending.append(future)
+      self.writer.write(FRAME_HEADER.pack(len(body)) + body)
+
+      await self.writer.drain()
+
+      data = await future
+
+      if debug_level > 0: print('[AsyncConnection::Request]  Sent:  %s %d %s  Received: "%s"' % (op, type_ref, args, data))
+
+      return data
+
+   #------------------------------------------------------------------
+
+   async def Request(self, op, type_ref=-1, *args):
+      "Send a single request and return the reply"
+
+      return (await self.RequestBytes(op, type_ref, *args)).decode(ENCODING)
+
+   #------------------------------------------------------------------
+
+   async def RegisterType(self, type):
+      response = await self.RequestBytes("REG", -1, type)
+
+      (type_ref, attributes) = response.split(b'|', 1)
+      type_ref               = int(type_ref)
+      attributes             = unmarshal(attributes)
+
+      self.sources[type_ref] = attributes
+
+      return (type_ref, attributes)
+
+   #------------------------------------------------------------------
+
+   async def GetNext(self, type_ref):
+      return (await self.Request("GETN", type_ref)).split(self.DELIM)
+
+   #------------------------------------------------------------------
+
+   async def GetHashed(self, type_ref, key):
+      return (await self.Request("GETH", type_ref, key)).split(self.DELIM)
+
+   #------------------------------------------------------------------
+
+   async def GetNextKeyed(self, type_ref, key):
+      return (await self.Request("GETK", type_ref, key)).split(self.DELIM)
+
+   #------------------------------------------------------------------
+
+   async def GetRandomKeyed(self, type_ref, key):
+      return (await self.Request("GETKR", type_ref, key)).split(self.DELIM)
+
+   #------------------------------------------------------------------
+
+   async def GetIndexed(self, type_ref, idx):
+      return (await self.Request("GETI", int(type_ref), idx)).split(self.DELIM)
+
+   #------------------------------------------------------------------
+
+   async def GetWeighted(self, type_ref):
+      return (await self.Request("GETW", type_ref)).split(self.DELIM)
+
+   #------------------------------------------------------------------
+
+   async def GetBlock(self, op, type_ref, *args):
+      "Issue a block request - returns a list of rows, each split into fields"
+
+      reply = await self.Request(op, type_ref, *args)
+
+      if reply.startswith('*'):           # *Exhausted* etc
+         return []
+
+      return [row.split(self.DELIM) for row in reply.split(ROW_SEPARATOR)]
+
+   #------------------------------------------------------------------
+
+   async def GetNextBlock(self, type_ref, n):
+      return await self.GetBlock("GETNB", type_ref, n)
+
+   #------------------------------------------------------------------
+
+   async def GetNextKeyedBlock(self, type_ref, key, n):
+      return await self.GetBlock("GETKB", type_ref, key, n)
+
+   #------------------------------------------------------------------
+
+   async def GetIndexedRange(self, type_ref, start, n):
+      return await self.GetBlock("GETIR", int(type_ref), start, n)
+
+   #------------------------------------------------------------------
+
+   async def GetWeightedBlock(self, type_ref, n):
+      return await self.GetBlock("GETWB", type_ref, n)
+
+   #------------------------------------------------------------------
+
+   async def GetStats(self):
+      return await self.Request("STATS")
+
+   #------------------------------------------------------------------
+
+   async def Flush(self):
+      reply = await self.Request("FLUSH")
+
+      try:
+         rc = int(reply)
+      except ValueError:
+         rc = -1
+
+      return rc
+
+   #------------------------------------------------------------------
+
+   async def Compact(self, type_ref):
+      reply = await self.Request("COMPACT", type_ref)
+
+      try:
+         rc = int(reply)
+      except ValueError:
+         rc = -1
+
+      return rc
+
+   #------------------------------------------------------------------
+
+   async def Checkout(self, type_ref, ttl=None):
+      if ttl == None:
+         reply = await self.Request("CHECKOUT", type_ref)
+      else:
+         reply = await self.Request("CHECKOUT", type_ref, ttl)
+
+      if reply.startswith('*'):           # *Exhausted* etc
+         return (None, reply.split(self.DELIM))
+
+      (lease, row) = reply.split(ROW_SEPARATOR, 1)
+
+      return (lease, row.split(self.DELIM))
+
+   #------------------------------------------------------------------
+
+   async def Commit(self, type_ref, lease):
+      reply = await self.Request("COMMIT", type_ref, lease)
+
+      try:
+         rc = int(reply)
+      except ValueError:
+         rc = -1
+
+      return rc
+
+   #------------------------------------------------------------------
+
+   async def Release(self, type_ref, lease):
+      reply = await self.Request("RELEASE", type_ref, lease)
+
+      try:
+         rc = int(reply)
+      except ValueError:
+         rc = -1
+
+      return rc
+
+   #------------------------------------------------------------------
+
+   async def StoreCsvData(self, type_ref, data):
+      reply = await self.Request("STOC", type_ref, data)
+
+      try:
+         rc = int(reply)
+      except ValueError:
+         rc = -1
+
+      return rc
+
+   #------------------------------------------------------------------
+
+   async def StoreKeyedData(self, type_ref, key_ref, data):
+      reply = await self.Request("STOK", type_ref, key_ref, data)
+
+      try:
+         rc = int(reply)
+      except ValueError:
+         rc = -1
+
+      return rc
+
+   #------------------------------------------------------------------
+
+   async def Close(self):
+      "Close the socket - requests still outstanding fail with ConnectionError"
+
+      if self.writer is None:
+         return
+
+      writer      = self.writer
+      self.writer = None
+
+      writer.close()
+
+      try:
+         await writer.wait_closed()
+      except ConnectionError:
+         pass
+
+      if self.receiver:
+         self.receiver.cancel()
+
+         try:
+            await self.receiver
+         except asyncio.CancelledError:
+            pass
+
+      self.Fail(ConnectionError('Connection closed'))
+
+#---------------------------------------------------------------------
+
+async def connect(server=HOST, port=PORT):
+   "Open an AsyncConnection to server:port"
+
+   (reader, writer) = await asyncio.open_connection(server, port)
+
+   conn = AsyncConnection(reader, writer)
+
+   await conn.Init()
+
+   return conn
+
+#=====================================================================
+
+async def measure(table, no_requests, concurrency):
+   ds = await connect(HOST, PORT)
+
+   (type_ref, attributes) = await ds.RegisterType(table)
+
+   print('Data type "%s" registered as %d - %s' % (table, type_ref, attributes))
+
+   remaining = [no_requests]
+
+   async def worker():
+      while remaining[0] > 0:
+         remaining[0] -= 1
+         await ds.GetNext(type_ref)
+
+   t_start = time.time()
+
+   await asyncio.gather(*[worker() for i in range(concurrency)])
+
+   elapsed = time.time() - t_start
+
+   print('%d GETN requests, %d outstanding - %.0f req/sec' % (no_requests, concurrency, no_requests / elapsed))
+
+   await ds.Close()
+
+#---------------------------------------------------------------------
+
+def main(argv):
+   global debug_level
+   global PORT
+
+   table       = None
+   no_requests = 1000
+   concurrency = 10
+
+   try:
+      opts, args = getopt.getopt(argv, "c:dhn:p:t:V?")
+   except getopt.error:
+      print(__doc__)
+      return 1
+
+   for o, a in opts:
+      if o == '-c':
+         concurrency        = int(a)
+      elif o == '-d':
+         debug_level       += 1
+      elif o == '-n':
+         no_requests        = int(a)
+      elif o == '-p':
+         PORT               = int(a)
+      elif o == '-t':
+         table              = a
+      elif o == '-V':
+         print("Version: %s" % __version__)
+         return 0
+      elif o in ('-h', '-?'):
+         print(__doc__)
+         return 0
+
+   if table:
+      asyncio.run(measure(table, no_requests, concurrency))
+
+   return 0
+
+#---------------------------------------------------------------------
+
+if __name__ == '__main__':
+   sys.exit(main(sys.argv[1:]))
+
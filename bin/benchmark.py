@@ -0,0 +1,669 @@
+#!/usr/bin/env python
+#
+#       Author:  Peter Harding  <plh@performiq.com.au>
+#                PerformIQ Pty. Ltd.
+#
+#                Mobile:  0418 375 085
+#
+#          Copyright (C) 1994-2016, Peter Harding
+#                        All rights reserved
+#
+#---------------------------------------------------------------------
+"""
+End to end load benchmark for dserver.py and dshttpd.py.
+
+  Usage:
+
+    # benchmark.py [-t <server>] [-u <vusers>] [-n <requests>] [-m <mix>]
+                   [-E <engine>] [-P <protocol>] [-c <processes>]
+                   [-b <block>] [-J <policy>] [-W <workers>] [-p <port>]
+                   [-o <file>] [-k]
+
+      -t <server>     dserver or dshttpd (default dserver)
+      -u <vusers>     Comma separated vuser counts - one run each
+                      (default 1,10,50)
+      -n <requests>   Requests issued by each vuser (default 1000)
+      -m <mix>        Opcode mix as op:weight pairs
+                      (default GETN:60,GETK:10,GETH:10,GETI:10,STOC:10)
+      -E <engine>     dserver engine - threaded or async
+      -P <protocol>   dserver wire protocol - 1 or 2 (default 2)
+      -c <processes>  Client processes the vusers are spread over
+                      (default 1)
+      -b <block>      Rows per GETNB, GETKB, GETIR and GETWB request (default 10)
+      -J <policy>     Journal policy written to dserver.ini
+      -W <workers>    dshttpd worker pool size written to dserver.ini
+                      (default thread per connection)
+      -p <port>       Port the server listens on (default 9700)
+      -o <file>       Write the JSON report to file as well as stdout
+      -k              Keep the generated environment directories
+
+  Each run generates a scratch DATA directory (dserver.ini plus .dat
+  files sized for the run), starts the server against it, connects
+  every vuser and then releases them together.  Each vuser issues
+  its requests back to back choosing opcodes at random according to
+  the mix.  When all vusers finish the server is stopped and the
+  throughput, error count and p50/p95/p99/p999 latencies (overall
+  and per opcode) are reported as JSON.
+
+  Opcodes available in the mix (and the source each one uses):
+
+    GETN  GETNB     Customers (CSV)
+    GETK  GETKB     Keyed
+    GETKS           KeyedSequence
+    GETH            Hashed
+    GETI  GETIR     Indexed
+    GETW  GETWB     Weighted
+    SEQ             Sequence (GETN)
+    STOC            Store (CSV)
+
+  Replies starting with '*' (e.g. *Exhausted*) and non 200 HTTP
+  responses are counted as errors.
+"""
+#---------------------------------------------------------------------
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import socket
+import getopt
+import signal
+import shutil
+import marshal
+import httplib
+import tempfile
+import threading
+import subprocess
+
+import client
+
+#---------------------------------------------------------------------
+
+__id__            = "@(#)  benchmark.py  [1.0.0]  2026-10-18"
+__version__       = re.search(r'.*\[([^\]]*)\].*', __id__).group(1)
+
+debug_level       = 0
+verbose_flg       = False
+keep_flg          = False
+
+HOST              = '127.0.0.1'
+PORT              = 9700
+ENVIRONMENT       = 'BM'
+
+server_name       = 'dserver'
+engine            = None
+protocol          = client.PROTOCOL_V2
+vuser_counts      = [1, 10, 50]
+no_requests       = 1000
+no_processes      = 1
+block_size        = 10
+journal_policy    = None
+pool_workers      = None
+mix_spec          = 'GETN:60,GETK:10,GETH:10,GETI:10,STOC:10'
+output_file       = None
+
+GROUP             = 'G'
+NO_KEYS           = 100
+NO_INDEXED        = 1000
+NO_WEIGHTED       = 1000
+START_TIMEOUT     = 60.0
+
+PERCENTILES       = (('p50', 0.50), ('p95', 0.95), ('p99', 0.99), ('p999', 0.999))
+
+#---------------------------------------------------------------------
+
+SOURCES           = (                         #  Handles are in this order
+                       ('Customers',     'CSV'),
+                       ('Keyed',         'Keyed'),
+                       ('KeyedSequence', 'KeyedSequence'),
+                       ('Hashed',        'Hashed'),
+                       ('Indexed',       'Indexed'),
+                       ('Sequence',      'Sequence'),
+                       ('Store',         'CSV'),
+                       ('Weighted',      'Weighted'),
+                    )
+
+HANDLES           = dict([(SOURCES[i][0], i) for i in range(len(SOURCES))])
+
+OPS               = {                         #  op -> (opcode, source)
+                       'GETN'  : ('GETN',  'Customers'),
+                       'GETNB' : ('GETNB', 'Customers'),
+                       'GETK'  : ('GETK',  'Keyed'),
+                       'GETKB' : ('GETKB', 'Keyed'),
+                       'GETKS' : ('GETKS', 'KeyedSequence'),
+                       'GETH'  : ('GETH',  'Hashed'),
+                       'GETI'  : ('GETI',  'Indexed'),
+                       'GETIR' : ('GETIR', 'Indexed'),
+                       'GETW'  : ('GETW',  'Weighted'),
+                       'GETWB' : ('GETWB', 'Weighted'),
+                       'SEQ'   : ('GETN',  'Sequence'),
+                       'STOC'  : ('STOC',  'Store'),
+                    }
+
+#=====================================================================
+
+def op_args(op, rng):
+   "Arguments (after the handle) for a request"
+
+   if op in ('GETK', 'GETKS'):
+      return (GROUP,)
+   elif op == 'GETKB':
+      return (GROUP, block_size)
+   elif op in ('GETNB', 'GETWB'):
+      return (block_size,)
+   elif op == 'GETH':
+      return ("K%d" % rng.randrange(NO_KEYS),)
+   elif op == 'GETI':
+      return (rng.randrange(NO_INDEXED),)
+   elif op == 'GETIR':
+      return (rng.randrange(NO_INDEXED - block_size), block_size)
+   elif op == 'STOC':
+      return ("stored,%d" % rng.randrange(1000000),)
+   else:
+      return ()
+
+#---------------------------------------------------------------------
+
+def parse_mix(spec):
+   "'GETN:60,GETK:40' -> [(op, weight), ...]"
+
+   mix = []
+
+   for item in spec.split(','):
+      (op, weight) = (item.split(':') + ['1'])[:2]
+
+      op = op.strip().upper()
+
+      if not OPS.has_key(op):
+         raise ValueError("Unknown op '%s' in mix" % op)
+
+      mix.append((op, int(weight)))
+
+   return mix
+
+#---------------------------------------------------------------------
+
+def make_environment(no_rows):
+   "Write dserver.ini and the .dat files - returns the DATA directory"
+
+   data_dir    = tempfile.mkdtemp(prefix='benchmark_')
+   environment = "%s/%s" % (data_dir, ENVIRONMENT)
+
+   os.mkdir(environment)
+
+   f = open("%s/dserver.ini" % data_dir, 'w')
+   f.write("[Config]\n")
+   f.write("Port=%d\n" % PORT)
+   f.write("Environment=%s\n" % ENVIRONMENT)
+   if journal_policy:
+      f.write("Journal=%s\n" % journal_policy)
+   if pool_workers:
+      f.write("Workers=%d\n" % pool_workers)
+   f.write("\n[Data]\n")
+   for (name, source_type) in SOURCES:
+      f.write("Description=%s:%s:\n" % (name, source_type))
+   f.close()
+
+   f = open("%s/Customers.dat" % environment, 'w')
+   for i in xrange(no_rows):
+      f.write("cust%08d,Firstname%d,Surname%d,%d Long Street,Suburb\n" % (i, i, i, i))
+   f.close()
+
+   f = open("%s/Keyed.dat" % environment, 'w')
+   f.write("[%s]\n" % GROUP)
+   for i in xrange(no_rows):
+      f.write("keyed%08d,%d\n" % (i, i))
+   f.close()
+
+   f = open("%s/KeyedSequence.dat" % environment, 'w')
+   f.write("%s:1\n" % GROUP)
+   f.close()
+
+   f = open("%s/Hashed.dat" % environment, 'w')
+   for i in xrange(NO_KEYS):
+      f.write("K%d:value%d\n" % (i, i))
+   f.close()
+
+   f = open("%s/Indexed.dat" % environment, 'w')
+   for i in xrange(NO_INDEXED):
+      f.write("idx%06d,passwd%d\n" % (i, i))
+   f.close()
+
+   f = open("%s/Sequence.dat" % environment, 'w')
+   f.write("1\n")
+   f.close()
+
+   f = open("%s/Store.dat" % environment, 'w')
+   f.close()
+
+   f = open("%s/Weighted.dat" % environment, 'w')
+   for i in xrange(NO_WEIGHTED):
+      f.write("%d:weighted%06d\n" % (i % 10 + 1, i))
+   f.close()
+
+   return data_dir
+
+#---------------------------------------------------------------------
+
+def start_server(data_dir):
+   "Start the server and wait until it accepts connections"
+
+   path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "%s.py" % server_name)
+
+   cmd  = [sys.executable, path, '-w', data_dir]
+
+   if engine:
+      cmd.extend(['-E', engine])
+
+   log  = open("%s/benchmark.log" % data_dir, 'w')
+
+   proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+   t_limit = time.time() + START_TIMEOUT
+
+   while time.time() < t_limit:
+      if proc.poll() != None:
+         raise RuntimeError("%s exited (rc %d) - see %s/benchmark.log" % (server_name, proc.returncode, data_dir))
+
+      try:
+         s = socket.create_connection((HOST, PORT), 1.0)
+         s.close()
+         return proc
+      except socket.error:
+         time.sleep(0.2)
+
+   proc.kill()
+
+   raise RuntimeError("%s did not start listening on port %d" % (server_name, PORT))
+
+#---------------------------------------------------------------------
+
+def stop_server(proc):
+   proc.send_signal(signal.SIGTERM)
+
+   t_limit = time.time() + 30.0
+
+   while proc.poll() == None and time.time() < t_limit:
+      time.sleep(0.1)
+
+   if proc.poll() == None:
+      proc.kill()
+      proc.wait()
+
+#=====================================================================
+
+class SocketVUser:
+   "A vuser talking to dserver over a client.Connection"
+
+   def __init__(self):
+      self.Connection = client.Connection(HOST, PORT, protocol=protocol)
+
+   def request(self, opcode, handle, args):
+      return self.Connection.Request(opcode, handle, *args)
+
+   def close(self):
+      self.Connection.Close()
+
+#---------------------------------------------------------------------
+
+class HttpVUser:
+   "A vuser talking to dshttpd - httplib reconnects if the server closes"
+
+   def __init__(self):
+      self.Connection = httplib.HTTPConnection(HOST, PORT)
+      self.Connection.connect()
+
+   def request(self, opcode, handle, args):
+      msg = '|'.join([opcode, str(handle)] + [str(arg) for arg in args])
+
+      self.Connection.request('GET', '/?msg=' + msg)
+
+      response = self.Connection.getresponse()
+      reply    = response.read()
+
+      if response.status != 200:          # 503 from a full worker pool
+         return '*HTTP*%d*' % response.status
+
+      return reply
+
+   def close(self):
+      self.Connection.close()
+
+#---------------------------------------------------------------------
+
+def vuser(vuser_id, mix, go, results):
+   "Connect, wait for the start signal then issue no_requests requests"
+
+   rng      = random.Random(vuser_id)
+   choices  = []
+
+   for (op, weight) in mix:
+      choices.extend([op] * weight)
+
+   latencies = dict([(op, []) for (op, weight) in mix])
+   errors    = dict([(op, 0) for (op, weight) in mix])
+
+   if server_name == 'dshttpd':
+      v = HttpVUser()
+   else:
+      v = SocketVUser()
+
+   go.wait()
+
+   for i in xrange(no_requests):
+      op               = rng.choice(choices)
+      (opcode, source) = OPS[op]
+      args             = op_args(op, rng)
+
+      t_start = time.time()
+
+      try:
+         reply = v.request(opcode, HANDLES[source], args)
+      except Exception, e:
+         if debug_level > 0: print "[benchmark]  vuser %d  %s failed: %s" % (vuser_id, op, str(e))
+         reply = None
+
+      latencies[op].append(time.time() - t_start)
+
+      if (not reply) or reply.startswith('*'):
+         errors[op] += 1
+
+   results.append((latencies, errors, time.time()))
+
+   v.close()
+
+#---------------------------------------------------------------------
+
+def client_process(first_id, count, mix, ready_w, go_r, result_w):
+   "Run count vusers as threads - reports back over result_w"
+
+   go      = threading.Event()
+   results = []
+   threads = [threading.Thread(target=vuser, args=(first_id + i, mix, go, results))
+                 for i in range(count)]
+
+   for t in threads: t.start()
+
+   os.write(ready_w, 'R')
+
+   os.read(go_r, 1)                   # Wait for every process to connect
+
+   go.set()
+
+   for t in threads: t.join()
+
+   data = marshal.dumps(results)
+
+   while data:
+      n    = os.write(result_w, data)
+      data = data[n:]
+
+#---------------------------------------------------------------------
+
+def read_all(fd):
+   chunks = []
+
+   while True:
+      chunk = os.read(fd, 65536)
+      if not chunk: break
+      chunks.append(chunk)
+
+   return ''.join(chunks)
+
+#---------------------------------------------------------------------
+
+def drive(no_vusers, mix):
+   "Fork the client processes - returns (t_start, [(latencies, errors, t_end), ...])"
+
+   (ready_r, ready_w) = os.pipe()
+   (go_r,    go_w)    = os.pipe()
+
+   processes = min(no_processes, no_vusers)
+   children  = []
+
+   for p in range(processes):
+      count    = no_vusers / processes + (p < no_vusers % processes)
+      first_id = p * (no_vusers / processes) + min(p, no_vusers % processes)
+
+      (result_r, result_w) = os.pipe()
+
+      pid = os.fork()
+
+      if pid == 0:
+         os.close(result_r)
+         try:
+            client_process(first_id, count, mix, ready_w, go_r, result_w)
+         finally:
+            os._exit(0)
+
+      os.close(result_w)
+
+      children.append((pid, result_r))
+
+   for p in range(processes):
+      os.read(ready_r, 1)
+
+   time.sleep(0.5)                    # Let the vuser connections settle
+
+   t_start = time.time()
+
+   os.write(go_w, 'G' * processes)
+
+   results = []
+
+   for (pid, result_r) in children:
+      data = read_all(result_r)
+      os.close(result_r)
+      os.waitpid(pid, 0)
+      if data:
+         results.extend(marshal.loads(data))
+
+   for fd in (ready_r, ready_w, go_r, go_w):
+      os.close(fd)
+
+   return (t_start, results)
+
+#=====================================================================
+
+def percentiles(latencies):
+   "Latencies in seconds -> {'p50' : ms, ...}"
+
+   latencies = sorted(latencies)
+   n         = len(latencies)
+   report    = {}
+
+   for (label, p) in PERCENTILES:
+      if n > 0:
+         report[label] = round(latencies[max(int(math.ceil(p * n)) - 1, 0)] * 1000.0, 3)
+      else:
+         report[label] = None
+
+   if n > 0:
+      report['max']  = round(latencies[-1] * 1000.0, 3)
+      report['mean'] = round(sum(latencies) * 1000.0 / n, 3)
+
+   return report
+
+#---------------------------------------------------------------------
+
+def summarise(no_vusers, mix, t_start, results):
+   t_end   = max([r[2] for r in results] or [t_start])
+   elapsed = max(t_end - t_start, 1e-9)
+
+   everything = []
+   ops        = {}
+   total_errs = 0
+
+   for (op, weight) in mix:
+      latencies = []
+      errors    = 0
+
+      for (op_latencies, op_errors, t) in results:
+         latencies.extend(op_latencies[op])
+         errors += op_errors[op]
+
+      everything.extend(latencies)
+      total_errs += errors
+
+      ops[op] = {
+                   'requests'   : len(latencies),
+                   'errors'     : errors,
+                   'throughput' : round(len(latencies) / elapsed, 1),
+                   'latency_ms' : percentiles(latencies),
+                }
+
+   return {
+             'server'     : server_name,
+             'engine'     : engine,
+             'protocol'   : (server_name == 'dserver') and protocol or None,
+             'journal'    : journal_policy,
+             'workers'    : (server_name == 'dshttpd') and pool_workers or None,
+             'vusers'     : no_vusers,
+             'processes'  : min(no_processes, no_vusers),
+             'requests'   : len(everything),
+             'errors'     : total_errs,
+             'elapsed'    : round(elapsed, 3),
+             'throughput' : round(len(everything) / elapsed, 1),
+             'latency_ms' : percentiles(everything),
+             'ops'        : ops,
+          }
+
+#---------------------------------------------------------------------
+
+def run(no_vusers, mix):
+   total   = no_vusers * no_requests
+   no_rows = total * max(block_size, 1) + 1
+
+   data_dir = make_environment(no_rows)
+
+   if verbose_flg: print >>sys.stderr, "[benchmark]  %d vusers - environment %s" % (no_vusers, data_dir)
+
+   try:
+      proc = start_server(data_dir)
+
+      try:
+         (t_start, results) = drive(no_vusers, mix)
+      finally:
+         stop_server(proc)
+
+      return summarise(no_vusers, mix, t_start, results)
+   finally:
+      if not keep_flg:
+         shutil.rmtree(data_dir)
+
+#---------------------------------------------------------------------
+
+def benchmark():
+   mix = parse_mix(mix_spec)
+
+   report = {
+               'version'  : __version__,
+               'date'     : time.strftime('%Y-%m-%d %H:%M:%S'),
+               'mix'      : mix_spec,
+               'requests' : no_requests,
+               'runs'     : [run(n, mix) for n in vuser_counts],
+            }
+
+   s = json.dumps(report, indent=2, sort_keys=True)
+
+   print s
+
+   if output_file:
+      f = open(output_file, 'w')
+      f.write(s + '\n')
+      f.close()
+
+#---------------------------------------------------------------------
+
+def usage():
+   print __doc__
+
+#---------------------------------------------------------------------
+
+def main(argv):
+   global debug_level
+   global verbose_flg
+   global keep_flg
+   global PORT
+   global server_name
+   global engine
+   global protocol
+   global vuser_counts
+   global no_requests
+   global no_processes
+   global block_size
+   global journal_policy
+   global pool_workers
+   global mix_spec
+   global output_file
+
+   try:
+      opts, args = getopt.getopt(argv, "b:c:dE:hJ:km:n:o:p:P:t:u:vVW:?")
+   except getopt.error, msg:
+      usage()
+      return 1
+
+   for o, a in opts:
+      if o == '-b':
+         block_size       = int(a)
+      elif o == '-c':
+         no_processes     = max(int(a), 1)
+      elif o == '-d':
+         debug_level     += 1
+      elif o == '-E':
+         engine           = a
+      elif o == '-J':
+         journal_policy   = a
+      elif o == '-k':
+         keep_flg         = True
+      elif o == '-W':
+         pool_workers     = int(a)
+      elif o == '-m':
+         mix_spec         = a
+      elif o == '-n':
+         no_requests      = int(a)
+      elif o == '-o':
+         output_file      = a
+      elif o == '-p':
+         PORT             = int(a)
+      elif o == '-P':
+         protocol         = int(a)
+      elif o == '-t':
+         server_name      = a
+      elif o == '-u':
+         vuser_counts     = [int(u) for u in a.split(',')]
+      elif o == '-v':
+         verbose_flg      = True
+      elif o == '-V':
+         print "Version: %s" % __version__
+         return 0
+      elif o in ('-h', '-?'):
+         usage()
+         return 0
+
+   if server_name not in ('dserver', 'dshttpd'):
+      usage()
+      return 1
+
+   if server_name == 'dshttpd' and engine:
+      print "[benchmark]  -E only applies to dserver"
+      return 1
+
+   try:
+      parse_mix(mix_spec)
+   except ValueError, e:
+      print "[benchmark]  %s" % str(e)
+      return 1
+
+   benchmark()
+
+   return 0
+
+#---------------------------------------------------------------------
+
+if __name__ == '__main__' or __name__ == sys.argv[0]:
+   sys.exit(main(sys.argv[1:]))
+
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+#       Author:  Peter Harding  <plh@performiq.com.au>
+#                PerformIQ Pty. Ltd.
+#
+#                Mobile:  0418 375 085
+#
+#          Copyright (C) 1994-2016, Peter Harding
+#                        All rights reserved
+#
+#---------------------------------------------------------------------
+"""
+Contention benchmark for the data server row claim primitives.
+
+  Usage:
+
+    # bm_claim.py [-n <requests>] [-t <threads>] [-s <sources>]
+
+      -n <requests>   Requests issued by each thread (default 20000)
+      -t <threads>    Comma separated thread counts (default 1,2,4,8)
+      -s <sources>    CSV sources to spread load over (default 8)
+
+  Drives dserver.process() directly (no sockets) from a number of
+  threads against scratch CSV, Keyed and Sequence sources and checks
+  every row / value handed out is unique.  Two workloads are run for
+  each thread count:
+
+    shared  - all threads claim from the same source
+    spread  - each thread claims from its own source
+
+  Throughput is reported along with the scaling factor relative to a
+  single thread.
+"""
+#---------------------------------------------------------------------
+
+import os
+import re
+import sys
+import time
+import getopt
+import shutil
+import tempfile
+import threading
+
+import dserver
+
+#---------------------------------------------------------------------
+
+__id__            = "@(#)  bm_claim.py  [1.0.0]  2026-10-18"
+__version__       = re.search(r'.*\[([^\]]*)\].*', __id__).group(1)
+
+debug_level       = 0
+verbose_flg       = False
+
+no_requests       = 20000
+thread_counts     = [1, 2, 4, 8]
+no_sources        = 8
+
+GROUP             = 'G'
+
+#=====================================================================
+
+def make_environment(no_rows):
+   "Write scratch .dat files - returns the environment directory"
+
+   environment = tempfile.mkdtemp(prefix='bm_claim_')
+
+   for i in range(no_sources):
+      f = open("%s/CSV%d.dat" % (environment, i), 'w')
+      for j in xrange(no_rows):
+         f.write("csv%d,%08d\n" % (i, j))
+      f.close()
+
+      f = open("%s/Keyed%d.dat" % (environment, i), 'w')
+      f.write("[%s]\n" % GROUP)
+      for j in xrange(no_rows):
+         f.write("keyed%d,%08d\n" % (i, j))
+      f.close()
+
+      f = open("%s/Sequence%d.dat" % (environment, i), 'w')
+      f.write("1\n")
+      f.close()
+
+   return environment
+
+#---------------------------------------------------------------------
+
+def load_sources(environment):
+   del dserver.sources[:]
+
+   handles = {}
+
+   for i in range(no_sources):
+      for (prefix, source_type) in (('CSV', 'CSV'), ('Keyed', 'Keyed'), ('Sequence', 'Sequence')):
+         name = "%s%d" % (prefix, i)
+         handles[name] = len(dserver.sources)
+         dserver.sources.append(dserver.Source(name, environment, source_type))
+
+   return handles
+
+#---------------------------------------------------------------------
+
+def worker(msg, n, replies):
+   process = dserver.process
+
+   for i in xrange(n):
+      replies.append(process(msg))
+
+#---------------------------------------------------------------------
+
+def run(label, messages, n):
+   "Run one thread per message - returns (elapsed, replies)"
+
+   replies = [[] for msg in messages]
+   threads = [threading.Thread(target=worker, args=(messages[i], n, replies[i]))
+                 for i in range(len(messages))]
+
+   t_start = time.time()
+
+   for t in threads: t.start()
+   for t in threads: t.join()
+
+   elapsed = time.time() - t_start
+
+   return (elapsed, replies)
+
+#---------------------------------------------------------------------
+
+def check(messages, replies):
+   "Returns the number of duplicated (per source) or exhausted replies"
+
+   by_source = {}
+
+   for i in range(len(messages)):
+      by_source.setdefault(messages[i], []).extend(replies[i])
+
+   bad = 0
+
+   for source_replies in by_source.values():
+      bad += len([r for r in source_replies if r.startswith('*')])
+      bad += len(source_replies) - len(set(source_replies))
+
+   return bad
+
+#---------------------------------------------------------------------
+
+def benchmark():
+   max_threads = max(thread_counts)
+   no_rows     = max_threads * no_requests
+
+   print "Building %d rows x %d sources..." % (no_rows, no_sources)
+
+   environment = make_environment(no_rows)
+
+   try:
+      print
+      print "%-14s %-7s %8s %12s %8s %6s" % ('Op', 'Load', 'Threads', 'Req/sec', 'Scaling', 'Dups')
+      print "%-14s %-7s %8s %12s %8s %6s" % ('==', '====', '=======', '=======', '=======', '====')
+
+      for (op, prefix, fmt) in (('GETN',  'CSV',      'GETN|%d'),
+                                ('GETK',  'Keyed',    'GETK|%d|' + GROUP),
+                                ('GETN',  'Sequence', 'GETN|%d')):
+         for load in ('shared', 'spread'):
+            base = None
+
+            for t in thread_counts:
+               handles = load_sources(environment)   # Fresh data for every run
+
+               if load == 'shared':
+                  messages = [fmt % handles["%s0" % prefix]] * t
+               else:
+                  messages = [fmt % handles["%s%d" % (prefix, i % no_sources)] for i in range(t)]
+
+               (elapsed, replies) = run(load, messages, no_requests)
+
+               dups = check(messages, replies)
+
+               rate = (t * no_requests) / elapsed
+
+               if base == None: base = rate
+
+               print "%-14s %-7s %8d %12.0f %8.2f %6s" % ("%s/%s" % (op, prefix), load, t, rate, rate / base, dups)
+
+            print
+   finally:
+      shutil.rmtree(environment)
+
+#---------------------------------------------------------------------
+
+def usage():
+   print __doc__
+
+#---------------------------------------------------------------------
+
+def main(argv):
+   global debug_level
+   global verbose_flg
+   global no_requests
+   global thread_counts
+   global no_sources
+
+   try:
+      opts, args = getopt.getopt(argv, "dhn:s:t:vV?")
+   except getopt.error, msg:
+      usage()
+      return 1
+
+   for o, a in opts:
+      if o == '-d':
+         debug_level     += 1
+      elif o == '-n':
+         no_requests      = int(a)
+      elif o == '-s':
+         no_sources       = int(a)
+      elif o == '-t':
+         thread_counts    = [int(t) for t in a.split(',')]
+      elif o == '-v':
+         verbose_flg      = True
+      elif o == '-V':
+         print "Version: %s" % __version__
+         return 0
+      elif o in ('-h', '-?'):
+         usage()
+         return 0
+
+   benchmark()
+
+   return 0
+
+#---------------------------------------------------------------------
+
+if __name__ == '__main__' or __name__ == sys.argv[0]:
+   sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+#       Author:  Peter Harding  <plh@performiq.com.au>
+#                PerformIQ Pty. Ltd.
+#
+#                Mobile:  0418 375 085
+#
+#          Copyright (C) 1994-2016, Peter Harding
+#                        All rights reserved
+#
+#---------------------------------------------------------------------
+"""
+Load time and memory benchmark for CSV source storage modes.
+
+  Usage:
+
+    # bm_load.py [-n <rows>] [-w <row width>]
+
+      -n <rows>       Rows in the scratch CSV file (default 1000000)
+      -w <width>      Approximate row width in bytes (default 60)
+
+  Writes a scratch CSV .dat file and loads it as a dserver Source once
+  with the default (list) storage and once with {'storage':'mmap'}.
+  Each load is done in a forked child so the peak RSS reported is for
+  that mode alone.  A run of GETN and GETI requests is timed too.
+"""
+#---------------------------------------------------------------------
+
+import os
+import re
+import sys
+import time
+import getopt
+import shutil
+import marshal
+import resource
+import tempfile
+
+import dserver
+
+#---------------------------------------------------------------------
+
+__id__            = "@(#)  bm_load.py  [1.0.0]  2026-10-18"
+__version__       = re.search(r'.*\[([^\]]*)\].*', __id__).group(1)
+
+debug_level       = 0
+verbose_flg       = False
+
+no_rows           = 1000000
+row_width         = 60
+no_requests       = 100000
+
+#=====================================================================
+
+def make_environment():
+   "Write a scratch CSV .dat file - returns the environment directory"
+
+   environment = tempfile.mkdtemp(prefix='bm_load_')
+
+   padding = 'x' * max(row_width - 20, 0)
+
+   f = open("%s/CSV.dat" % environment, 'w')
+   for i in xrange(no_rows):
+      f.write("csv,%08d,%s\n" % (i, padding))
+   f.close()
+
+   return environment
+
+#---------------------------------------------------------------------
+
+def measure(environment, attributes):
+   "Load the source and time requests - runs in a child process"
+
+   rss_base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+   t_start = time.time()
+
+   dserver.sources.append(dserver.Source('CSV', environment, 'CSV', attributes))
+
+   t_load = time.time() - t_start
+
+   rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_base
+
+   requests = min(no_requests, no_rows)
+
+   t_start = time.time()
+
+   for i in xrange(requests):
+      dserver.process('GETN|0')
+
+   for i in xrange(requests):
+      dserver.process('GETI|0|%d' % ((i * 7919) % no_rows))
+
+   rate = (2 * requests) / (time.time() - t_start)
+
+   return (t_load, rss, rate)
+
+#---------------------------------------------------------------------
+
+def run(environment, attributes):
+   (r, w) = os.pipe()
+
+   pid = os.fork()
+
+   if pid == 0:
+      os.close(r)
+      os.write(w, marshal.dumps(measure(environment, attributes)))
+      os._exit(0)
+
+   os.close(w)
+
+   result = ''
+
+   while True:
+      data = os.read(r, 4096)
+      if not data: break
+      result += data
+
+   os.close(r)
+   os.waitpid(pid, 0)
+
+   return marshal.loads(result)
+
+#---------------------------------------------------------------------
+
+def benchmark():
+   print "Building %d rows..." % no_rows
+
+   environment = make_environment()
+
+   try:
+      print
+      print "%-8s %10s %12s %12s" % ('Storage', 'Load (s)', 'RSS (KB)', 'Req/sec')
+      print "%-8s %10s %12s %12s" % ('=======', '========', '========', '=======')
+
+      for (label, attributes) in (('list', {}), ('mmap', {dserver.STORAGE : 'mmap'})):
+         (t_load, rss, rate) = run(environment, attributes)
+
+         print "%-8s %10.2f %12d %12.0f" % (label, t_load, rss, rate)
+
+      print
+   finally:
+      shutil.rmtree(environment)
+
+#---------------------------------------------------------------------
+
+def usage():
+   print __doc__
+
+#---------------------------------------------------------------------
+
+def main(argv):
+   global debug_level
+   global verbose_flg
+   global no_rows
+   global row_width
+
+   try:
+      opts, args = getopt.getopt(argv, "dhn:vVw:?")
+   except getopt.error, msg:
+      usage()
+      return 1
+
+   for o, a in opts:
+      if o == '-d':
+         debug_level     += 1
+      elif o == '-n':
+         no_rows          = int(a)
+      elif o == '-v':
+         verbose_flg      = True
+      elif o == '-V':
+         print "Version: %s" % __version__
+         return 0
+      elif o == '-w':
+         row_width        = int(a)
+      elif o in ('-h', '-?'):
+         usage()
+         return 0
+
+   benchmark()
+
+   return 0
+
+#---------------------------------------------------------------------
+
+if __name__ == '__main__' or __name__ == sys.argv[0]:
+   sys.exit(main(sys.argv[1:]))
+
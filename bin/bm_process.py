@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+#       Author:  Peter Harding  <plh@performiq.com.au>
+#                PerformIQ Pty. Ltd.
+#
+#                Mobile:  0418 375 085
+#
+#          Copyright (C) 1994-2016, Peter Harding
+#                        All rights reserved
+#
+#---------------------------------------------------------------------
+"""
+Request dispatch benchmark for the data server process() function.
+
+  Usage:
+
+    # bm_process.py [-m <module>] [-n <requests>] [-s <sources>] [-J <policy>]
+
+      -m <module>     Server module to drive - dserver or dshttpd
+                      (default dserver)
+      -n <requests>   Requests issued for each opcode (default 50000)
+      -s <sources>    Number of sources to register (default 32)
+      -J <policy>     Audit journal policy - sync, records:<n> or
+                      interval:<ms> (default sync)
+
+  Calls process() directly (no sockets) from a single thread for a mix
+  of opcodes against scratch CSV, Keyed, Sequence and Hashed sources.
+  The handle used is the last source registered so any lookup which
+  is linear in the number of sources shows up in the results.
+"""
+#---------------------------------------------------------------------
+
+import re
+import sys
+import time
+import getopt
+import shutil
+import tempfile
+
+#---------------------------------------------------------------------
+
+__id__            = "@(#)  bm_process.py  [1.0.0]  2026-10-18"
+__version__       = re.search(r'.*\[([^\]]*)\].*', __id__).group(1)
+
+debug_level       = 0
+verbose_flg       = False
+
+module_name       = 'dserver'
+no_requests       = 50000
+no_sources        = 32
+journal_policy    = 'sync'
+
+GROUP             = 'G'
+KEY               = 'K'
+
+#=====================================================================
+
+def make_environment(no_rows):
+   "Write scratch .dat files - returns the environment directory"
+
+   environment = tempfile.mkdtemp(prefix='bm_process_')
+
+   f = open("%s/CSV.dat" % environment, 'w')
+   for j in xrange(no_rows):
+      f.write("csv,%08d\n" % j)
+   f.close()
+
+   f = open("%s/Keyed.dat" % environment, 'w')
+   f.write("[%s]\n" % GROUP)
+   for j in xrange(no_rows):
+      f.write("keyed,%08d\n" % j)
+   f.close()
+
+   f = open("%s/Sequence.dat" % environment, 'w')
+   f.write("1\n")
+   f.close()
+
+   f = open("%s/Hashed.dat" % environment, 'w')
+   f.write("%s:value\n" % KEY)
+   f.close()
+
+   return environment
+
+#---------------------------------------------------------------------
+
+def load_sources(server, environment):
+   "Register no_sources sources - the ones exercised are added last"
+
+   del server.sources[:]
+   server.source_index.clear()
+
+   types = ('CSV', 'Keyed', 'Sequence', 'Hashed')
+
+   for i in range(no_sources - len(types)):
+      types = ('Sequence',) + types
+
+   handles = {}
+
+   for i in range(len(types)):
+      source_type = types[i]
+      name        = "%s%d" % (source_type, i)
+      source      = server.Source(source_type, environment, source_type)
+      source.Name = name
+      handles[source_type]      = len(server.sources)
+      server.source_index[name] = len(server.sources)
+      server.sources.append(source)
+
+   return handles
+
+#---------------------------------------------------------------------
+
+def benchmark():
+   server = __import__(module_name)
+
+   if not server.set_journal_policy(journal_policy):
+      print "Bad journal policy '%s'" % journal_policy
+      return
+
+   environment = make_environment(no_requests)
+
+   try:
+      handles = load_sources(server, environment)
+
+      server.init_journal()
+      process = server.process
+
+      print
+      print "%-10s %-14s %-12s %12s" % ('Module', 'Journal', 'Op', 'Req/sec')
+      print "%-10s %-14s %-12s %12s" % ('======', '=======', '==', '=======')
+
+      for (op, msg) in (('REG',   'REG|Hashed%d' % handles['Hashed']),
+                        ('GETN',  'GETN|%d' % handles['CSV']),
+                        ('GETN',  'GETN|%d' % handles['Sequence']),
+                        ('GETK',  'GETK|%d|%s' % (handles['Keyed'], GROUP)),
+                        ('GETH',  'GETH|%d|%s' % (handles['Hashed'], KEY)),
+                        ('GETI',  'GETI|%d|0' % handles['CSV']),
+                        ('STOC',  'STOC|%d|data' % handles['CSV'])):
+         t_start = time.time()
+
+         for i in xrange(no_requests):
+            process(msg)
+
+         elapsed = time.time() - t_start
+
+         print "%-10s %-14s %-12s %12.0f" % (module_name, journal_policy, msg.split('|')[0], no_requests / elapsed)
+
+      print
+   finally:
+      server.stop_journal()
+      shutil.rmtree(environment)
+
+#---------------------------------------------------------------------
+
+def usage():
+   print __doc__
+
+#---------------------------------------------------------------------
+
+def main(argv):
+   global debug_level
+   global verbose_flg
+   global module_name
+   global no_requests
+   global no_sources
+   global journal_policy
+
+   try:
+      opts, args = getopt.getopt(argv, "dhJ:m:n:s:vV?")
+   except getopt.error, msg:
+      usage()
+      return 1
+
+   for o, a in opts:
+      if o == '-d':
+         debug_level     += 1
+      elif o == '-J':
+         journal_policy   = a
+      elif o == '-m':
+         module_name      = a
+      elif o == '-n':
+         no_requests      = int(a)
+      elif o == '-s':
+         no_sources       = int(a)
+      elif o == '-v':
+         verbose_flg      = True
+      elif o == '-V':
+         print "Version: %s" % __version__
+         return 0
+      elif o in ('-h', '-?'):
+         usage()
+         return 0
+
+   if module_name not in ('dserver', 'dshttpd'):
+      usage()
+      return 1
+
+   benchmark()
+
+   return 0
+
+#---------------------------------------------------------------------
+
+if __name__ == '__main__' or __name__ == sys.argv[0]:
+   sys.exit(main(sys.argv[1:]))
+
@@ -38,9 +38,18 @@ Purpose:
               sp  = ds.GetNextKeyed(type_ref, key)
           elif Indexed:
               sp  = ds.GetIndexed(type_ref, index)
+          elif Weighted:
+              sp  = ds.GetWeighted(type_ref)
           else:
               sp  = ds.GetNext(type_ref)
 
+        or a block of rows in one round trip:
+
+          rows = ds.GetNextBlock(type_ref, n)
+          rows = ds.GetNextKeyedBlock(type_ref, key, n)
+          rows = ds.GetIndexedRange(type_ref, start, n)
+          rows = ds.GetWeightedBlock(type_ref, n)
+
     a)  Storing data:
 
           if Keyed:
@@ -50,7 +59,47 @@ Purpose:
 
    Notes:
 
-   i)    For an indexed type the atributes returned are:
+   i)    To use the framed (v2) wire protocol - which supports rows of
+         any size - open the connection with:
+
+           ds = client.Connection(port=PORT, protocol=2)
+
+         The methods below are unchanged.  Use the framed protocol
+         with the block methods (GetNextBlock etc.) - under the text
+         protocol a reply is limited to a single 1024 byte recv().
+
+   ii)   GetNext() can be served from a local read-ahead buffer which
+         is refilled with GETNB in the background:
+
+           ds.EnablePrefetch(type_ref, block=100)
+
+         Rows still buffered when the connection is closed are
+         returned to a CSV source with STOC (other types are logged
+         to stderr).  Needs protocol 2.
+
+   iii)  Multi-threaded drivers can share warm, already registered
+         connections through a pool instead of opening one each:
+
+           pool = client.ConnectionPool(port=PORT, size=8, types=('Customers',))
+
+           (type_ref, attributes) = pool.RegisterType('Customers')
+
+           with pool.Connection() as ds:
+              row = ds.GetNext(type_ref)
+
+   iv)   asyncio based (Python 3) drivers should use AsyncConnection
+         in aclient.py which offers the same methods as coroutines.
+
+   v)    A CSV row can be leased rather than taken for good:
+
+           (lease, sp) = ds.Checkout(type_ref, ttl=60)
+           ...
+           ds.Commit(type_ref, lease)      # or ds.Release(type_ref, lease)
+
+         A row neither committed nor released within ttl seconds (the
+         server's LeaseTTL if not given) goes back to the source.
+
+   vi)   For an indexed type the atributes returned are:
 
          {
            'type'     : 'Indexed',
@@ -65,8 +114,14 @@ import os
 import re
 import sys
 import copy
+import time
+import Queue
 import getopt
+import struct
 import marshal
+import threading
+import contextlib
+import collections
 
 #---------------------------------------------------------------------
 
@@ -83,6 +138,55 @@ PORT              = 9578
 debug_level       = 0
 verbose_flg       = False
 
+PROTOCOL_V1       = 1              #  Pipe delimited text - one message per recv()
+PROTOCOL_V2       = 2              #  Length prefixed frames with binary header
+
+FRAME_HEADER      = struct.Struct('!I')       #  Frame body length
+REQUEST_HEADER    = struct.Struct('!Bi')      #  Opcode, source handle
+
+OPCODES           = {
+                       'INIT'  : 1,
+                       'REG'   : 2,
+                       'REGK'  : 3,
+                       'REGI'  : 4,
+                       'GETN'  : 5,
+                       'GETKS' : 6,
+                       'GETK'  : 7,
+                       'GETKR' : 8,
+                       'GETH'  : 9,
+                       'GETI'  : 10,
+                       'STOC'  : 11,
+                       'STOK'  : 12,
+                       'GETNB' : 13,
+                       'GETKB' : 14,
+                       'GETIR' : 15,
+                       'STATS' : 16,
+                       'FLUSH' : 17,
+                       'COMPACT' : 18,
+                       'GETW'  : 19,
+                       'GETWB' : 20,
+                       'CHECKOUT' : 21,
+                       'COMMIT' : 22,
+                       'RELEASE' : 23,
+                    }
+
+ROW_SEPARATOR     = '\n'           #  Between rows in block replies
+
+UNHANDLED_OPS     = ('INIT', 'REG', 'REGK', 'REGI', 'STATS', 'FLUSH')   # Take no source handle
+
+#---------------------------------------------------------------------
+
+class Prefetch:
+   "Read-ahead buffer of rows claimed with GETNB for one source"
+
+   def __init__(self, block, low_water):
+      self.Block     = block
+      self.LowWater  = low_water
+      self.Rows      = collections.deque()
+      self.Lock      = threading.Lock()     # Guards Rows and Fetching
+      self.Fetching  = None                 # Refill thread while one is running
+      self.Exhausted = None                 # Last '*...*' GETNB reply
+
 #---------------------------------------------------------------------
 
 class Connection:
@@ -92,26 +196,38 @@ class Connection:
    sockobj        = None
    Fields         = None
 
-   def __init__(self, server=HOST, port=PORT, debug=0):
+   def __init__(self, server=HOST, port=PORT, debug=0, protocol=PROTOCOL_V1, exit_on_error=True):
       global debug_level
 
       "Initialize TCP/IP socket object and make connection to server:port"
 
       self.ServerHostname = server
       self.ServerPort     = port
+      self.protocol       = PROTOCOL_V1
+      self.Lock           = threading.Lock()     # One request on the socket at a time
+      self.prefetch       = {}
       debug_level         = debug
 
       self.sockobj = socket(AF_INET, SOCK_STREAM) 
 
       try:
          self.sockobj.connect((self.ServerHostname, self.ServerPort))
-      except SocketError, e:
+      except error, e:
          sys.stderr.write('[client]  Connect failed: %s\n' % str(e))
+         if not exit_on_error:
+            raise
          sys.exit(1)
 
-      msg        = "INIT|Python"
+      if protocol == PROTOCOL_V2:
+         # The INIT itself is plain text - the reply is the first frame
 
-      attributes = self.Get(msg)
+         self.sockobj.sendall("INIT|Python|%d" % PROTOCOL_V2)
+         self.protocol = PROTOCOL_V2
+         attributes    = self.ReadFrame()
+      else:
+         msg        = "INIT|Python"
+
+         attributes = self.Get(msg)
 
 #      try:
 #         attributes = self.Get(msg)
@@ -129,10 +245,18 @@ class Connection:
    def Get(self, s):
       "Send s to server and get back response"
 
+      if self.protocol == PROTOCOL_V2:
+         msg = s.split('|')
+         if msg[0] in UNHANDLED_OPS:
+            return self.Request(msg[0], -1, *msg[1:])
+         else:
+            return self.Request(msg[0], int(msg[1]), *msg[2:])
+
       if self.sockobj != None:
-         self.sockobj.send(s)
+         with self.Lock:
+            self.sockobj.send(s)
 
-         data = self.sockobj.recv(1024)
+            data = self.sockobj.recv(1024)
 
          if debug_level > 0: print '[Client::Get]  Sent:  "%s"  Received: "%s"' % (s, data)
 
@@ -142,22 +266,69 @@ class Connection:
 
    #------------------------------------------------------------------
 
+   def Request(self, op, type_ref=-1, *args):
+      "Send a single request and return the reply - in either protocol"
+
+      if self.sockobj == None:
+         return None
+
+      if self.protocol == PROTOCOL_V1:
+         fields = [op]
+         if type_ref >= 0 or op not in UNHANDLED_OPS:
+            fields.append(str(type_ref))
+         fields.extend([str(arg) for arg in args])
+         return self.Get('|'.join(fields))
+
+      body = REQUEST_HEADER.pack(OPCODES[op], type_ref) + '|'.join([str(arg) for arg in args])
+
+      with self.Lock:
+         self.sockobj.sendall(FRAME_HEADER.pack(len(body)) + body)
+
+         data = self.ReadFrame()
+
+      if debug_level > 0: print '[Client::Request]  Sent:  %s %d %s  Received: "%s"' % (op, type_ref, args, data)
+
+      return data
+
+   #------------------------------------------------------------------
+
+   def ReadFrame(self):
+      (length,) = FRAME_HEADER.unpack(self.ReadExactly(FRAME_HEADER.size))
+
+      return self.ReadExactly(length)
+
+   #------------------------------------------------------------------
+
+   def ReadExactly(self, n):
+      chunks = []
+
+      while n > 0:
+         chunk = self.sockobj.recv(min(n, 65536))
+         if not chunk:
+            raise error('Connection closed by data server')
+         chunks.append(chunk)
+         n -= len(chunk)
+
+      return ''.join(chunks)
+
+   #------------------------------------------------------------------
+
    def Close(self):
       "close socket to send eof to server"
 
       if self.sockobj != None:
+         self.ReturnPrefetched()
+
          self.sockobj.close()
          self.sockobj = None
 
    #------------------------------------------------------------------
 
    def RegisterType(self, type):
-      msg    = "REG|%s" % type
-
       # Should I really be using a try: here?   - PLH 2008-05-10
 
       try:
-         response = self.Get(msg)
+         response = self.Request("REG", -1, type)
       except:
          type_ref = -1
 
@@ -172,17 +343,107 @@ class Connection:
    #------------------------------------------------------------------
 
    def GetNext(self, type_ref):
-      msg      = "GETN|%d" % type_ref
-      csv_data = self.Get(msg)
+      p = self.prefetch.get(type_ref)
+
+      if p:
+         csv_data = self.NextPrefetched(type_ref, p)
+      else:
+         csv_data = self.Request("GETN", type_ref)
+
       data     = csv_data.split(self.DELIM)
 
       return data
 
    #------------------------------------------------------------------
 
+   def EnablePrefetch(self, type_ref, block=100, low_water=None):
+      "Serve GetNext(type_ref) from rows claimed block at a time in the background"
+
+      if self.protocol != PROTOCOL_V2:
+         sys.stderr.write('[client]  Prefetch needs protocol %d\n' % PROTOCOL_V2)
+         return False
+
+      if low_water == None:
+         low_water = block / 4
+
+      self.prefetch[type_ref] = Prefetch(block, low_water)
+
+      return True
+
+   #------------------------------------------------------------------
+
+   def NextPrefetched(self, type_ref, p):
+      while True:
+         with p.Lock:
+            if p.Rows:
+               row = p.Rows.popleft()
+
+               if (len(p.Rows) <= p.LowWater) and not (p.Fetching or p.Exhausted):
+                  p.Fetching = threading.Thread(target=self.Refill, args=(type_ref, p))
+                  p.Fetching.setDaemon(True)
+                  p.Fetching.start()
+
+               return row
+
+            fetching = p.Fetching
+
+         if fetching:
+            fetching.join()
+         else:
+            self.Refill(type_ref, p)
+
+            with p.Lock:
+               if not p.Rows:
+                  return p.Exhausted   # Nothing left on the server either
+
+   #------------------------------------------------------------------
+
+   def Refill(self, type_ref, p):
+      try:
+         reply = self.Request("GETNB", type_ref, p.Block)
+      except error, e:
+         reply = '*ERROR*%s*' % str(e)
+
+      with p.Lock:
+         if reply.startswith('*'):
+            p.Exhausted = reply
+         else:
+            p.Exhausted = None
+            p.Rows.extend(reply.split(ROW_SEPARATOR))
+
+         if p.Fetching == threading.currentThread():
+            p.Fetching = None
+
+   #------------------------------------------------------------------
+
+   def ReturnPrefetched(self):
+      "Hand rows claimed but not used back to CSV sources - log any others"
+
+      for (type_ref, p) in self.prefetch.items():
+         fetching = p.Fetching
+
+         if fetching:
+            fetching.join()
+
+         rows = list(p.Rows)
+
+         p.Rows.clear()
+
+         if not rows:
+            continue
+
+         if self.sources.get(type_ref, {}).get('Type') == 'CSV':
+            for row in rows:
+               self.Request("STOC", type_ref, row)
+         else:
+            sys.stderr.write('[client]  %d unused prefetched rows for type %d: %s\n' % (len(rows), type_ref, rows))
+
+      self.prefetch = {}
+
+   #------------------------------------------------------------------
+
    def GetHashed(self, type_ref, key):
-      msg      = "GETH|%d|%s" % (type_ref, key)
-      csv_data = self.Get(msg)
+      csv_data = self.Request("GETH", type_ref, key)
       data     = csv_data.split(self.DELIM)
 
       return data
@@ -190,8 +451,7 @@ class Connection:
    #------------------------------------------------------------------
 
    def GetNextKeyed(self, type_ref, key):
-      msg      = "GETK|%d|%s" % (type_ref, key)
-      csv_data = self.Get(msg)
+      csv_data = self.Request("GETK", type_ref, key)
       data     = csv_data.split(self.DELIM)
 
       return data
@@ -199,8 +459,7 @@ class Connection:
    #------------------------------------------------------------------
 
    def GetRandomKeyed(self, type_ref, key):
-      msg      = "GETKR|%d|%s" % (type_ref, key)
-      csv_data = self.Get(msg)
+      csv_data = self.Request("GETKR", type_ref, key)
       data     = csv_data.split(self.DELIM)
 
       return data
@@ -208,17 +467,135 @@ class Connection:
    #------------------------------------------------------------------
 
    def GetIndexed(self, type_ref, idx):
-      msg      = "GETI|%s|%s" % (type_ref, idx)
-      csv_data = self.Get(msg)
+      csv_data = self.Request("GETI", int(type_ref), idx)
       data     = csv_data.split(self.DELIM)
 
       return data
 
    #------------------------------------------------------------------
 
+   def GetWeighted(self, type_ref):
+      csv_data = self.Request("GETW", type_ref)
+      data     = csv_data.split(self.DELIM)
+
+      return data
+
+   #------------------------------------------------------------------
+
+   def GetBlock(self, op, type_ref, *args):
+      "Issue a block request - returns a list of rows, each split into fields"
+
+      reply = self.Request(op, type_ref, *args)
+
+      if reply.startswith('*'):           # *Exhausted* etc
+         return []
+
+      return [row.split(self.DELIM) for row in reply.split(ROW_SEPARATOR)]
+
+   #------------------------------------------------------------------
+
+   def GetNextBlock(self, type_ref, n):
+      return self.GetBlock("GETNB", type_ref, n)
+
+   #------------------------------------------------------------------
+
+   def GetNextKeyedBlock(self, type_ref, key, n):
+      return self.GetBlock("GETKB", type_ref, key, n)
+
+   #------------------------------------------------------------------
+
+   def GetIndexedRange(self, type_ref, start, n):
+      return self.GetBlock("GETIR", int(type_ref), start, n)
+
+   #------------------------------------------------------------------
+
+   def GetWeightedBlock(self, type_ref, n):
+      return self.GetBlock("GETWB", type_ref, n)
+
+   #------------------------------------------------------------------
+
+   def GetStats(self):
+      "Server metrics as text - use protocol 2 as the reply exceeds one recv()"
+
+      return self.Request("STATS")
+
+   #------------------------------------------------------------------
+
+   def Flush(self):
+      "Ask for a checkpoint of the changed sources - returns how many were queued"
+
+      reply   = self.Request("FLUSH")
+
+      try:
+         rc = int(reply)
+      except ValueError:
+         rc = -1
+
+      return rc
+
+   #------------------------------------------------------------------
+
+   def Compact(self, type_ref):
+      "Drop the rows already handed out from the source's .dat - at the next checkpoint"
+
+      reply   = self.Request("COMPACT", type_ref)
+
+      try:
+         rc = int(reply)
+      except ValueError:
+         rc = -1
+
+      return rc
+
+   #------------------------------------------------------------------
+
+   def Checkout(self, type_ref, ttl=None):
+      "Lease the next row - returns (lease, data), lease None if there was no row"
+
+      if ttl == None:
+         reply = self.Request("CHECKOUT", type_ref)
+      else:
+         reply = self.Request("CHECKOUT", type_ref, ttl)
+
+      if reply.startswith('*'):           # *Exhausted* etc
+         return (None, reply.split(self.DELIM))
+
+      (lease, row) = reply.split(ROW_SEPARATOR, 1)
+
+      return (lease, row.split(self.DELIM))
+
+   #------------------------------------------------------------------
+
+   def Commit(self, type_ref, lease):
+      "The leased row has been used - returns 1, or -1 if the lease had run out"
+
+      reply   = self.Request("COMMIT", type_ref, lease)
+
+      try:
+         rc = int(reply)
+      except ValueError:
+         rc = -1
+
+      return rc
+
+   #------------------------------------------------------------------
+
+   def Release(self, type_ref, lease):
+      "Give the leased row back unused - returns 1, or -1 if the lease had run out"
+
+      reply   = self.Request("RELEASE", type_ref, lease)
+
+      try:
+         rc = int(reply)
+      except ValueError:
+         rc = -1
+
+      return rc
+
+   #------------------------------------------------------------------
+
    def StoreCsvData(self, type_ref, data):
-      msg     = "STOC|%d|%s" % (type_ref, data)
-      reply   = self.Get(msg)
+      reply   = self.Request("STOC", type_ref, data)
 
       try:
          rc = int(reply)
@@ -230,8 +607,7 @@ class Connection:
    #------------------------------------------------------------------
 
    def StoreKeyedData(self, type_ref, key_ref, data):
-      msg     = "STOK|%d|%s|%s" % (type_ref, key_ref, data)
-      reply   = self.Get(msg)
+      reply   = self.Request("STOK", type_ref, key_ref, data)
 
       try:
          rc = int(reply)
@@ -250,6 +626,170 @@ class Connection:
 
 #---------------------------------------------------------------------
 
+class ConnectionPool:
+   """
+   Thread safe pool of Connections.  At most size connections are open
+   at once - Get() blocks (up to timeout seconds) when they are all
+   borrowed.  Idle connections are checked with a REGI round trip before
+   being handed out again if unused for check_after seconds, and any
+   that fail (or are put back as broken) are replaced.
+   """
+
+   def __init__(self, server=HOST, port=PORT, size=8, types=(), warm=0,
+                protocol=PROTOCOL_V1, timeout=None, check_after=30.0):
+      self.ServerHostname = server
+      self.ServerPort     = port
+      self.Size           = size
+      self.Protocol       = protocol
+      self.Timeout        = timeout
+      self.CheckAfter     = check_after
+      self.Idle           = Queue.LifoQueue()          # (connection, time returned)
+      self.Slots          = threading.BoundedSemaphore(size)
+      self.Lock           = threading.Lock()           # Guards Types
+      self.Types          = {}                         # name -> (type_ref, attributes)
+      self.Closed         = False
+
+      for name in types:
+         self.Types[name] = None
+
+      warm = [self.Get() for i in range(min(warm, size))]
+
+      for conn in warm:
+         self.Put(conn)
+
+   #------------------------------------------------------------------
+
+   def Open(self):
+      "New connection with every known type registered"
+
+      conn = Connection(self.ServerHostname, self.ServerPort, protocol=self.Protocol, exit_on_error=False)
+
+      with self.Lock:
+         names = self.Types.keys()
+
+      for name in names:
+         registration = conn.RegisterType(name)
+
+         with self.Lock:
+            self.Types[name] = registration
+
+      return conn
+
+   #------------------------------------------------------------------
+
+   def Healthy(self, conn):
+      try:
+         return conn.Request("REGI", -1, "ping") == "0"
+      except error:
+         return False
+
+   #------------------------------------------------------------------
+
+   def Get(self, timeout=None):
+      "Borrow a connection - raises error if none is free within timeout"
+
+      if self.Closed:
+         raise error('Connection pool closed')
+
+      if timeout == None:
+         timeout = self.Timeout
+
+      if not self.Acquire(timeout):
+         raise error('No free connection within %s seconds' % timeout)
+
+      try:
+         while True:
+            try:
+               (conn, returned) = self.Idle.get_nowait()
+            except Queue.Empty:
+               return self.Open()
+
+            if (time.time() - returned < self.CheckAfter) or self.Healthy(conn):
+               return conn
+
+            conn.Close()
+      except:
+         self.Slots.release()
+         raise
+
+   #------------------------------------------------------------------
+
+   def Acquire(self, timeout):
+      if timeout == None:
+         return self.Slots.acquire()
+
+      t_limit = time.time() + timeout
+
+      while not self.Slots.acquire(False):
+         if time.time() >= t_limit:
+            return False
+         time.sleep(0.005)
+
+      return True
+
+   #------------------------------------------------------------------
+
+   def Put(self, conn, broken=False):
+      "Return a borrowed connection - broken ones are closed, not reused"
+
+      try:
+         if broken or self.Closed or conn.sockobj == None:
+            conn.Close()
+         else:
+            self.Idle.put((conn, time.time()))
+      finally:
+         self.Slots.release()
+
+   #------------------------------------------------------------------
+
+   @contextlib.contextmanager
+   def Connection(self, timeout=None):
+      "with pool.Connection() as ds: ... - the connection is always returned"
+
+      conn = self.Get(timeout)
+
+      try:
+         yield conn
+      except:
+         self.Put(conn, broken=True)
+         raise
+      else:
+         self.Put(conn)
+
+   #------------------------------------------------------------------
+
+   def RegisterType(self, name):
+      "(type_ref, attributes) for name - connections opened later register it too"
+
+      with self.Lock:
+         registration = self.Types.get(name)
+
+      if registration == None:
+         with self.Connection() as conn:
+            registration = conn.RegisterType(name)
+
+         with self.Lock:
+            self.Types[name] = registration
+
+      return registration
+
+   #------------------------------------------------------------------
+
+   def Close(self):
+      "Close the idle connections - borrowed ones are closed when put back"
+
+      self.Closed = True
+
+      while True:
+         try:
+            (conn, returned) = self.Idle.get_nowait()
+         except Queue.Empty:
+            break
+
+         conn.Close()
+
+#---------------------------------------------------------------------
+
 def main(argv):
    global debug_level
    global verbose_flg
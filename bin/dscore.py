@@ -0,0 +1,1343 @@
+#!/usr/bin/env python
+#
+#       Author:  Peter Harding  <plh@performiq.com.au>
+#                PerformIQ Pty. Ltd.
+#
+#                Mobile:  0418 375 085
+#
+#          Copyright (C) 1994-2016, Peter Harding
+#                        All rights reserved
+#
+#---------------------------------------------------------------------
+"""
+  Purpose:  Data Server core shared by dserver.py and dshttpd.py
+
+  Usage:
+
+      import dscore
+
+      from dscore import Journal, Group, Persistence, ...
+
+  Notes:
+
+    The two servers only differ in how requests reach process() -
+    the sources they serve and how those are persisted live here:
+
+      Journal        .used/.stored audit logs and their group commit
+      Checkpoint     Writing dirty sources back while serving
+      Leases         Rows handed out by CHECKOUT
+      Metrics        Request counters behind STATS (and /metrics)
+      MappedRows     Rows sliced out of a memory mapped .dat
+      Permutation    The shuffled order of a CSV source
+      alias_table    Weighted draws in constant time
+      Group          The rows of a Keyed group
+      Persistence    Snapshots, cursors and compaction of a Source
+
+    sources is the list the server serves - each server's own
+    sources is this same list.  Settings are handed in through
+    set_journal_policy(), init_checkpoint() and the log and
+    verbose_flg globals.
+"""
+#---------------------------------------------------------------------
+
+import os
+import re
+import sys
+import time
+import mmap
+import shutil
+import threading
+import marshal
+import collections
+import array
+import itertools
+import zlib
+import heapq
+import random
+
+#---------------------------------------------------------------------
+
+from datetime import datetime
+
+#---------------------------------------------------------------------
+
+__id__            = "@(#)  dscore.py  [1.0.0]  2026-10-18"
+__version__       = re.search(r'.*\[([^\]]*)\].*', __id__).group(1)
+
+verbose_flg       = False
+log               = None           #  The server's logger, once init_logging() has run
+
+sources           = []             #  Every Source, by handle
+journals          = []             #  Every open .used/.stored Journal
+journal_event     = threading.Event()
+journal_thread    = None           #  Background writer (not used for 'sync')
+
+journal_policy    = 'sync'         #  'sync', 'records' or 'interval'
+journal_records   = 100            #  Records pending before a commit ('records')
+journal_interval  = 1.0            #  Seconds between commits by the writer
+
+checkpoint_interval = 0            #  Seconds between checkpoints - 0 only on FLUSH
+checkpoint_types  = ()             #  Source types a checkpoint rewrites
+checkpoint_event  = threading.Event()
+checkpoint_lock   = threading.Lock()     #  One checkpoint (or the final flush) at a time
+checkpoint_thread = None           #  Writes dirty sources back to their .dat
+lease_event       = threading.Event()
+lease_thread      = None           #  Gives rows whose lease has run out back
+
+JOURNAL_POLICIES  = ('sync', 'records', 'interval')
+SNAPSHOT_TYPES    = ('CSV', 'KeyedSequence', 'Hashed', 'Indexed', 'Keyed', 'Weighted')
+CURSOR_BLOCK      = 4096           #  Bytes of the .dat up to the cursor's size checked against it
+NO_SOURCE_OPS     = ('INIT', 'REG', 'REGK', 'REGI', 'STATS', 'FLUSH')   #  Take no source handle
+
+p_comment         = re.compile('^#')
+
+#=====================================================================
+
+def INFO(msg):
+   if log: log.info(' ' + msg)
+   if verbose_flg: print "[dscore]  %s" % msg
+
+#---------------------------------------------------------------------
+
+def ERROR(msg):
+   if log: log.error(msg)
+   sys.stderr.write('[dscore]  %s\n' % msg)
+
+#---------------------------------------------------------------------
+
+def WARNING(msg):
+   if log: log.warning('*****' + msg + '*****')
+   if verbose_flg: print "[dscore]  %s" % msg
+
+#---------------------------------------------------------------------
+
+def get_source(hdl):
+   "Source for a handle - either an int (v2) or the text of one (v1)"
+
+   try:
+      hdl = int(hdl)
+   except:
+      return None
+
+   if hdl < 0: return None
+
+   try:
+      source = sources[hdl]
+   except:
+      return None
+
+   if source.Valid or source.load():
+      return source
+
+   return None
+
+#=====================================================================
+
+class Journal:
+   "Audit log (.used or .stored) - records are group committed by journal_writer()"
+
+   def __init__(self, path):
+      self.Path       = path
+      self.Pending    = []
+      self.Lock       = threading.Lock()     # Guards Pending
+      self.CommitLock = threading.Lock()     # Keeps commits in order
+      self.fh         = open(path, 'a+')
+
+      journals.append(self)
+
+   def write(self, record):
+      if journal_policy == 'sync':
+         with self.CommitLock:
+            self.fh.write(record)
+            self.fh.flush()
+         return
+
+      with self.Lock:
+         self.Pending.append(record)
+         pending = len(self.Pending)
+
+      if (journal_policy == 'records') and (pending >= journal_records):
+         journal_event.set()
+
+   def commit(self):
+      "Write and flush everything pending with a single write()"
+
+      with self.CommitLock:
+         with self.Lock:
+            (pending, self.Pending) = (self.Pending, [])
+
+         if pending:
+            self.fh.write("".join(pending))
+            self.fh.flush()
+
+   def close(self):
+      self.commit()
+      self.fh.close()
+
+#---------------------------------------------------------------------
+
+def set_journal_policy(spec):
+   "Parse 'sync', 'records:<n>' or 'interval:<ms>' - returns False if invalid"
+
+   global journal_policy, journal_records, journal_interval
+
+   (policy, arg) = (spec.strip().split(':', 1) + [None])[:2]
+
+   if policy not in JOURNAL_POLICIES:
+      return False
+
+   try:
+      if policy == 'records' and arg:
+         journal_records  = max(int(arg), 1)
+      elif policy == 'interval' and arg:
+         journal_interval = max(int(arg), 1) / 1000.0
+   except ValueError:
+      return False
+
+   journal_policy = policy
+
+   return True
+
+#---------------------------------------------------------------------
+
+def commit_journals():
+   for journal in journals[:]:
+      journal.commit()
+
+#---------------------------------------------------------------------
+
+def journal_writer():
+   "Background group commit - wakes every journal_interval or when records are due"
+
+   while journal_thread:
+      journal_event.wait(journal_interval)
+      journal_event.clear()
+
+      try:
+         commit_journals()
+      except IOError, e:
+         ERROR("[dscore::journal_writer]  Commit failed: %s" % str(e))
+
+#---------------------------------------------------------------------
+
+def init_journal():
+   global journal_thread
+
+   INFO("Journal policy %s (records %d, interval %.3fs)" % (journal_policy, journal_records, journal_interval))
+
+   if journal_policy != 'sync':
+      journal_thread = threading.Thread(target=journal_writer, name='journal')
+      journal_thread.setDaemon(True)
+      journal_thread.start()
+
+#---------------------------------------------------------------------
+
+def stop_journal():
+   "Stop the writer and commit anything still pending"
+
+   global journal_thread
+
+   (writer, journal_thread) = (journal_thread, None)
+
+   if writer:
+      journal_event.set()
+      writer.join(5.0)
+
+   commit_journals()
+
+#---------------------------------------------------------------------
+
+def checkpoint():
+   "Write every dirty source back to its .dat - returns how many were written"
+
+   with checkpoint_lock:
+      t_start = time.time()
+
+      commit_journals()            # The audit trail reaches disk first
+
+      for source in sources:
+         if source.Compact:
+            source.compact()
+
+      dirty = [source for source in sources if source.Dirty and source.Type in checkpoint_types]
+
+      for source in dirty:
+         source.flush(final=False)
+
+   if dirty:
+      INFO("Checkpointed %d sources in %.3fs" % (len(dirty), time.time() - t_start))
+
+   return len(dirty)
+
+#---------------------------------------------------------------------
+
+def checkpointer():
+   "Background checkpoint - wakes every checkpoint_interval or on FLUSH"
+
+   while checkpoint_thread:
+      checkpoint_event.wait(checkpoint_interval or None)
+      checkpoint_event.clear()
+
+      if checkpoint_thread:
+         checkpoint()
+
+#---------------------------------------------------------------------
+
+def init_checkpoint(interval, types):
+   "Start the checkpoint thread - every interval seconds (0 only on FLUSH) for sources of types"
+
+   global checkpoint_thread, checkpoint_interval, checkpoint_types
+
+   (checkpoint_interval, checkpoint_types) = (interval, types)
+
+   if checkpoint_interval > 0:
+      INFO("Checkpoint every %.1fs" % checkpoint_interval)
+
+   checkpoint_thread = threading.Thread(target=checkpointer, name='checkpoint')
+   checkpoint_thread.setDaemon(True)
+   checkpoint_thread.start()
+
+#---------------------------------------------------------------------
+
+def stop_checkpoint():
+   "Stop the checkpoint thread - letting a checkpoint in progress finish"
+
+   global checkpoint_thread
+
+   (writer, checkpoint_thread) = (checkpoint_thread, None)
+
+   if writer:
+      checkpoint_event.set()
+      writer.join(5.0)
+
+#---------------------------------------------------------------------
+
+def lease_reaper():
+   "Give back the rows of leases that run out - wakes when the next is due or on CHECKOUT"
+
+   while lease_thread:
+      lease_event.wait(leases.due())
+      lease_event.clear()
+
+      if lease_thread:
+         leases.expire()
+
+#---------------------------------------------------------------------
+
+def init_leases():
+   global lease_thread
+
+   lease_thread = threading.Thread(target=lease_reaper, name='leases')
+   lease_thread.setDaemon(True)
+   lease_thread.start()
+
+#---------------------------------------------------------------------
+
+def stop_leases():
+   "Stop the reaper and give back every row still out on lease"
+
+   global lease_thread
+
+   (reaper, lease_thread) = (lease_thread, None)
+
+   if reaper:
+      lease_event.set()
+      reaper.join(5.0)
+
+   leases.expire(float('inf'))
+
+#---------------------------------------------------------------------
+
+def replace_file(path, lines):
+   "Atomically replace path with lines - temp file, fsync, rename"
+
+   tmp_file = path + '.tmp'            # The old file may be mapped
+
+   f = open(tmp_file, 'wb')
+
+   try:
+      f.writelines("%s\n" % line for line in lines)
+      f.flush()
+      os.fsync(f.fileno())
+   finally:
+      f.close()
+
+   os.rename(tmp_file, path)
+
+   fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)   # Make the rename durable
+
+   try:
+      os.fsync(fd)
+   finally:
+      os.close(fd)
+
+#---------------------------------------------------------------------
+
+def cursor_key(path, size=None):
+   """
+   (inode, size, crc) of a .dat - the crc is of the CURSOR_BLOCK bytes
+   that end at size, which appending rows leaves alone.  None if the
+   .dat is now shorter than size (it has been replaced).
+   """
+
+   st = os.stat(path)
+
+   if size == None:
+      size = st.st_size
+   elif st.st_size < size:
+      return None
+
+   start = max(size - CURSOR_BLOCK, 0)
+
+   f = open(path, 'rb')
+
+   try:
+      f.seek(start)
+      crc = zlib.crc32(f.read(size - start)) & 0xffffffff
+   finally:
+      f.close()
+
+   return (st.st_ino, size, crc)
+
+#=====================================================================
+
+class Metrics:
+   """
+   Request counters and latency histograms for process().  Recording is
+   a handful of dict updates under one lock so it can be left on.
+   Latency buckets are powers of two microseconds - bucket i counts
+   requests taking less than 2**i us and the last bucket the rest.
+   """
+
+   BUCKETS     = 24
+   MAX_REPLIES = 64                # Distinct error replies tracked
+
+   def __init__(self):
+      self.Lock     = threading.Lock()
+      self.Started  = time.time()
+      self.Ops      = {}           # op -> [count, errors, seconds, buckets]
+      self.Sources  = {}           # source name -> requests
+      self.Replies  = {}           # error reply -> count
+
+   def record(self, msg, reply, elapsed):
+      op     = msg[0]
+      bucket = min(int(elapsed * 1000000).bit_length(), self.BUCKETS - 1)
+      source = None
+
+      if (op not in NO_SOURCE_OPS) and (len(msg) > 1):
+         source = get_source(msg[1])
+
+      with self.Lock:
+         stats = self.Ops.get(op)
+
+         if stats == None:
+            stats = self.Ops[op] = [0, 0, 0.0, [0] * self.BUCKETS]
+
+         stats[0]         += 1
+         stats[2]         += elapsed
+         stats[3][bucket] += 1
+
+         if reply[:1] == '*':
+            stats[1] += 1
+
+            if self.Replies.has_key(reply) or len(self.Replies) < self.MAX_REPLIES:
+               self.Replies[reply] = self.Replies.get(reply, 0) + 1
+
+         if source != None:
+            self.Sources[source.Name] = self.Sources.get(source.Name, 0) + 1
+
+   def text(self):
+      "Prometheus style text exposition of the counters and gauges"
+
+      with self.Lock:
+         ops     = dict([(op, stats[:3] + [stats[3][:]]) for (op, stats) in self.Ops.items()])
+         counts  = self.Sources.copy()
+         replies = self.Replies.copy()
+
+      lines = []
+
+      lines.append('# TYPE dserver_uptime_seconds gauge')
+      lines.append('dserver_uptime_seconds %.3f' % (time.time() - self.Started))
+
+      lines.append('# TYPE dserver_requests_total counter')
+      for op in sorted(ops):
+         lines.append('dserver_requests_total{op="%s"} %d' % (op, ops[op][0]))
+
+      lines.append('# TYPE dserver_errors_total counter')
+      for op in sorted(ops):
+         lines.append('dserver_errors_total{op="%s"} %d' % (op, ops[op][1]))
+
+      lines.append('# TYPE dserver_request_seconds histogram')
+      for op in sorted(ops):
+         (count, errors, seconds, buckets) = ops[op]
+         cumulative = 0
+         for i in range(self.BUCKETS - 1):
+            cumulative += buckets[i]
+            lines.append('dserver_request_seconds_bucket{op="%s",le="%.6f"} %d' % (op, (1 << i) / 1000000.0, cumulative))
+         lines.append('dserver_request_seconds_bucket{op="%s",le="+Inf"} %d' % (op, count))
+         lines.append('dserver_request_seconds_sum{op="%s"} %.6f' % (op, seconds))
+         lines.append('dserver_request_seconds_count{op="%s"} %d' % (op, count))
+
+      lines.append('# TYPE dserver_error_replies_total counter')
+      for reply in sorted(replies):
+         lines.append('dserver_error_replies_total{reply="%s"} %d' % (reply.replace('"', "'"), replies[reply]))
+
+      lines.append('# TYPE dserver_source_requests_total counter')
+      for name in sorted(counts):
+         lines.append('dserver_source_requests_total{source="%s"} %d' % (name, counts[name]))
+
+      lines.append('# TYPE dserver_rows_remaining gauge')
+      for source in sources:
+         remaining = source.remaining()
+         if remaining != None:
+            lines.append('dserver_rows_remaining{source="%s"} %d' % (source.Name, remaining))
+
+      keyed = [(source.Name, source.group_sizes()) for source in sources if source.Valid and source.Type == "Keyed"]
+
+      lines.append('# TYPE dserver_keyed_groups gauge')
+      for (name, sizes) in keyed:
+         lines.append('dserver_keyed_groups{source="%s"} %d' % (name, len(sizes)))
+
+      lines.append('# TYPE dserver_keyed_largest_group_rows gauge')
+      for (name, sizes) in keyed:
+         lines.append('dserver_keyed_largest_group_rows{source="%s"} %d' % (name, max([rows for (group, rows, size) in sizes] or [0])))
+
+      lines.append('# TYPE dserver_keyed_bytes gauge')
+      for (name, sizes) in keyed:
+         lines.append('dserver_keyed_bytes{source="%s"} %d' % (name, sum([size for (group, rows, size) in sizes])))
+
+      (held, expired) = leases.counts()
+
+      lines.append('# TYPE dserver_leases_held gauge')
+      for name in sorted(held):
+         lines.append('dserver_leases_held{source="%s"} %d' % (name, held[name]))
+
+      lines.append('# TYPE dserver_leases_expired_total counter')
+      for name in sorted(expired):
+         lines.append('dserver_leases_expired_total{source="%s"} %d' % (name, expired[name]))
+
+      rss = resident_bytes()
+
+      if rss != None:
+         lines.append('# TYPE dserver_resident_bytes gauge')
+         lines.append('dserver_resident_bytes %d' % rss)
+
+      return '\n'.join(lines) + '\n'
+
+#---------------------------------------------------------------------
+
+def resident_bytes():
+   "Resident set size of the server - None where /proc is not available"
+
+   try:
+      f = open('/proc/self/statm', 'r')
+      try:
+         pages = int(f.read().split()[1])
+      finally:
+         f.close()
+   except (IOError, ValueError, IndexError):
+      return None
+
+   return pages * os.sysconf('SC_PAGE_SIZE')
+
+#=====================================================================
+
+class Leases:
+   """
+   Rows handed out by CHECKOUT, which go back to their source unless
+   they are COMMITted before the lease runs out.  Expiry is a heap of
+   (deadline, lease) so only leases that are due are ever looked at -
+   COMMIT and RELEASE just drop the lease from Held, and its heap entry
+   is skipped when it comes to the top.
+   """
+
+   def __init__(self):
+      self.Lock    = threading.Lock()     # Guards all of the below
+      self.Held    = {}            # lease -> (source, row, deadline)
+      self.Expiry  = []            # Heap of (deadline, lease)
+      self.Next    = int(time.time() * 1000)    # Not reusing the leases of an earlier run
+      self.Count   = {}            # source name -> leases held
+      self.Expired = {}            # source name -> leases that ran out
+
+   def checkout(self, source, row, ttl):
+      "Lease row out for ttl seconds - returns the lease"
+
+      deadline = time.time() + ttl
+
+      with self.Lock:
+         self.Next += 1
+
+         lease = "%d" % self.Next
+
+         self.Held[lease]        = (source, row, deadline)
+         self.Count[source.Name] = self.Count.get(source.Name, 0) + 1
+
+         heapq.heappush(self.Expiry, (deadline, lease))
+
+         first = (self.Expiry[0][1] == lease)
+
+      if first:                        # Due before the reaper was going to wake
+         lease_event.set()
+
+      return lease
+
+   def end(self, source, lease):
+      "Take a lease back (COMMIT, RELEASE) - its row, None if source does not hold it"
+
+      with self.Lock:
+         held = self.Held.get(lease)
+
+         if (held == None) or (held[0] is not source):
+            return None
+
+         del self.Held[lease]
+
+         self.Count[source.Name] -= 1
+
+      return held[1]
+
+   def due(self):
+      "Seconds until the next lease runs out - None while none are held"
+
+      with self.Lock:
+         while self.Expiry and not self.Held.has_key(self.Expiry[0][1]):   # Ended already
+            heapq.heappop(self.Expiry)
+
+         if not self.Expiry:
+            return None
+
+         return max(self.Expiry[0][0] - time.time(), 0)
+
+   def expire(self, now=None):
+      "Give the rows of the leases run out by now back to their sources"
+
+      if now == None:
+         now = time.time()
+
+      expired = []
+
+      with self.Lock:
+         while self.Expiry and (self.Expiry[0][0] <= now):
+            (deadline, lease) = heapq.heappop(self.Expiry)
+
+            held = self.Held.pop(lease, None)
+
+            if held != None:
+               name = held[0].Name
+
+               self.Count[name]   -= 1
+               self.Expired[name]  = self.Expired.get(name, 0) + 1
+
+               expired.append(held)
+
+      for (source, row, deadline) in expired:
+         source.give_back(row)
+
+      return len(expired)
+
+   def counts(self):
+      "(held, expired) - source name -> leases"
+
+      with self.Lock:
+         return (self.Count.copy(), self.Expired.copy())
+
+#---------------------------------------------------------------------
+
+leases            = Leases()
+
+#=====================================================================
+
+class MappedRows:
+   """
+   Read only row list over a memory mapped .dat file.  Only an array of
+   line offsets is held in memory - rows are sliced out of the mapping
+   when they are asked for.  Rows added by STOC are kept in Extra.
+   """
+
+   def __init__(self, path, comments, skip_blank=False):
+      self.Path     = path
+      self.Offsets  = array.array('L')
+      self.Extra    = []
+      self.fh       = open(path, 'rb')
+
+      offset = 0
+
+      for line in self.fh:
+         stripped = line.strip()
+
+         if p_comment.match(stripped):
+            comments.append(stripped)
+         elif stripped or not skip_blank:
+            self.Offsets.append(offset)
+
+         offset += len(line)
+
+      if offset > 0:
+         self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+      else:
+         self.mm = ''                # Can not map an empty file
+
+   def __len__(self):
+      return len(self.Offsets) + len(self.Extra)
+
+   def row(self, i):
+      start = self.Offsets[i]
+      end   = self.mm.find('\n', start)
+
+      if end < 0: end = len(self.mm)
+
+      return self.mm[start:end].strip()
+
+   def __getitem__(self, i):
+      if isinstance(i, slice):
+         return [self[j] for j in xrange(*i.indices(len(self)))]
+
+      if i < 0: i += len(self)
+
+      if i < len(self.Offsets):
+         if i < 0: raise IndexError("row index out of range")
+         return self.row(i)
+      else:
+         return self.Extra[i - len(self.Offsets)]
+
+   def __iter__(self):
+      for i in xrange(len(self)):
+         yield self[i]
+
+   def append(self, row):
+      self.Extra.append(row)
+
+   def drop(self, n):
+      "Forget the first n rows - compact() has dropped them from the .dat"
+
+      k = min(n, len(self.Offsets))
+
+      self.Offsets = self.Offsets[k:]
+      self.Extra   = self.Extra[n - k:]
+
+#=====================================================================
+
+class Permutation:
+   """
+   Seeded pseudo-random order of the positions 0 .. Size-1, worked out
+   one position at a time so that only the round keys are held.  A
+   balanced Feistel network over the smallest even number of bits that
+   covers Size is a bijection of that range - positions it sends past
+   Size are put through it again (cycle walking) until they land in
+   range.  Positions from Size on map to themselves, so rows stored
+   after the order was fixed are handed out as they arrive.
+   """
+
+   ROUNDS = 4
+
+   def __init__(self, size, seed):
+      self.Size = size
+      self.Seed = seed
+      bits      = 2
+
+      while (1 << bits) < size:
+         bits += 2
+
+      self.Half = bits // 2
+      self.Mask = (1 << self.Half) - 1
+      self.Keys = [zlib.crc32("%d:%d" % (seed, r)) & 0xffffffff for r in xrange(self.ROUNDS)]
+
+   def encipher(self, x):
+      half = self.Half
+      mask = self.Mask
+
+      for key in self.Keys:
+         (left, right) = (x >> half, x & mask)
+
+         h  = ((right ^ key) * 0x9e3779b1) & 0xffffffff
+         h ^= h >> 15
+         h  = (h * 0x85ebca6b) & 0xffffffff
+         h ^= h >> 13
+
+         x = (right << half) | (left ^ (h & mask))
+
+      return x
+
+   def __getitem__(self, i):
+      if i >= self.Size:
+         return i
+
+      i = self.encipher(i)
+
+      while i >= self.Size:
+         i = self.encipher(i)
+
+      return i
+
+#=====================================================================
+
+def alias_table(weights):
+   """
+   Vose's alias method - (Prob, Alias) arrays from which row i is drawn
+   with probability weights[i] / sum(weights) in constant time: pick a
+   column at random, then keep it with probability Prob[column] or else
+   take Alias[column].  Each column is topped up to an even share from
+   one of the rows with more than theirs.
+   """
+
+   n     = len(weights)
+   prob  = array.array('d', [1.0]) * n
+   alias = array.array('l', xrange(n))
+
+   if n == 0:
+      return (prob, alias)
+
+   total  = float(sum(weights))
+   scaled = [weight * n / total for weight in weights]
+   small  = [i for i in xrange(n) if scaled[i] <  1.0]
+   large  = [i for i in xrange(n) if scaled[i] >= 1.0]
+
+   while small and large:
+      s = small.pop()
+      l = large.pop()
+
+      prob[s]    = scaled[s]
+      alias[s]   = l
+      scaled[l] -= 1.0 - scaled[s]
+
+      if scaled[l] < 1.0:
+         small.append(l)
+      else:
+         large.append(l)
+
+   return (prob, alias)                # What is left in either list keeps its whole column
+
+#=====================================================================
+
+class Group:
+   """
+   The rows of one Keyed group, oldest first.  Rows are popped off the
+   deque as they are handed out, so a group that is being stored to and
+   claimed from at the same rate stays the same size.  Idx counts the
+   rows of the group in the .dat that have been handed out (what the
+   cursor records) and FileRows those in the .dat - the rows stored
+   since the last flush are the last len(Data) - (FileRows - Idx).
+   """
+
+   Name     = None
+   Idx      = None
+   Data     = None
+   Comments = None
+   FileRows = 0                    # Rows of the group in the .dat
+
+   def __init__(self, name):
+      self.Name       = name
+      self.Idx        = 0
+      self.Data       = collections.deque()
+      self.Comments   = []
+      self.Lock       = threading.Lock()
+      self.Taken      = 0          # Rows ever popped - see Source.flush_keyed()
+      self.Bytes      = 0          # Size of the rows held
+
+   def __str__(self):
+      s = "Grp %s  Len %d" % (self.Name, len(self.Data))
+      return s
+
+   def append_comments(self, s):
+      self.Comments.append(s)
+
+   def append_data(self, s):
+      self.Data.append(s)
+
+   def set_idx(self, base=0):
+      "All the rows held are in the .dat - base rows before them were handed out"
+
+      self.Idx      = base
+      self.FileRows = base + len(self.Data)
+      self.Bytes    = sum([len(row) for row in self.Data])
+
+   def claim(self, n=1):
+      "Atomically claim up to n unconsumed rows - returns a (possibly empty) list"
+
+      with self.Lock:
+         n    = min(n, len(self.Data))
+         rows = [self.Data.popleft() for i in xrange(n)]
+
+         self.Idx    = min(self.Idx + n, self.FileRows)
+         self.Taken += n
+         self.Bytes -= sum([len(row) for row in rows])
+
+         return rows
+
+   def store(self, data):
+      "Append a row (STOK)"
+
+      with self.Lock:
+         self.Data.append(data)
+         self.Bytes += len(data)
+
+   def pick(self):
+      "A row chosen at random, left in the group - None if it is empty"
+
+      with self.Lock:                 # claim() may be popping rows meanwhile
+         if not self.Data:
+            return None
+
+         return self.Data[random.randint(0, len(self.Data) - 1)]
+
+   def skip(self, n):
+      "Drop the first n rows of the .dat - handed out by an earlier run"
+
+      if n > self.Idx:
+         self.claim(n - self.Idx)
+
+   def pending(self):
+      "The rows stored since the last flush - call with Lock held"
+
+      n = len(self.Data) - (self.FileRows - self.Idx)
+
+      return [self.Data[-i] for i in xrange(n, 0, -1)]
+
+#=====================================================================
+
+class Persistence:
+   """
+   How a Source is kept on disk, apart from its type specific parsing
+   and flush: loading from a snapshot, the cursor that records how far
+   a CSV or Keyed source has been handed out, appending stored rows to
+   the .dat and compacting it.  The Source supplies File, Snapshot,
+   Cursor, Environment and the rest of its state, and snapshot_key()
+   and export().
+   """
+
+   def adopt(self, state):
+      "Take over rows parsed elsewhere - the other half of export()"
+
+      self.Idx      = state['Idx']
+      self.Comments = state['Comments']
+
+      if self.Type == "Keyed":
+         self.Data = {}
+
+         for (name, (data, comments, base)) in state['Data'].items():
+            group          = Group(name)
+            group.Data     = collections.deque(data)
+            group.Comments = comments
+            group.set_idx(base)
+
+            self.Data[name] = group
+      elif self.Type == "Weighted":
+         (self.Data, prob, alias) = state['Data']
+
+         self.Prob  = array.array('d', prob)
+         self.Alias = array.array('l', alias)
+      else:
+         self.Data = state['Data']
+
+         self.FileRows = len(self.Data)
+
+   #------------------------------------------------------------------
+
+   def read_snapshot(self):
+      "(rc, export()) from the snapshot - None if there isn't a current one"
+
+      if (self.Type not in SNAPSHOT_TYPES) or (self.Storage == 'mmap'):
+         return None
+
+      try:
+         f = open(self.Snapshot, 'rb')
+      except IOError:
+         return None
+
+      try:
+         try:
+            if marshal.load(f) != self.snapshot_key():
+               INFO("Snapshot for %s is stale - parsing %s" % (self.Name, self.File))
+               return None
+
+            return marshal.load(f)
+         except (EOFError, ValueError, TypeError, OSError), e:
+            WARNING("[dscore]  Bad snapshot %s: %s" % (self.Snapshot, str(e)))
+            return None
+      finally:
+         f.close()
+
+   #------------------------------------------------------------------
+
+   def write_snapshot(self):
+      "Snapshot the source as it stands in the .dat"
+
+      if (self.Type not in SNAPSHOT_TYPES) or (self.Storage == 'mmap'):
+         return
+
+      key = self.snapshot_key()
+
+      try:                             # .dat unchanged - the snapshot is still current
+         f = open(self.Snapshot, 'rb')
+         try:
+            if marshal.load(f) == key: return
+         finally:
+            f.close()
+      except (IOError, EOFError, ValueError, TypeError):
+         pass
+
+      tmp_file = self.Snapshot + '.tmp'
+
+      try:
+         f = open(tmp_file, 'wb')
+         marshal.dump(key, f)
+         marshal.dump((True, self.export()), f)
+         f.close()
+         os.rename(tmp_file, self.Snapshot)
+      except (IOError, OSError, ValueError), e:
+         WARNING("[dscore]  Snapshot of %s failed: %s" % (self.Name, str(e)))
+
+   #------------------------------------------------------------------
+
+   def cursor_key(self, size=None):
+      return cursor_key(self.File, size)
+
+   #------------------------------------------------------------------
+
+   def restore_cursor(self):
+      "Pick up where the last run got to - if the cursor file matches the .dat"
+
+      try:
+         f = open(self.Cursor, 'r')
+      except IOError:
+         return
+
+      key       = None
+      positions = {}                   # Group name (None for CSV) -> rows handed out
+      order     = None                 # (seed, rows) of a shuffled CSV source
+
+      try:
+         try:
+            for line in f:
+               line = line.strip()
+
+               if p_comment.match(line) or not line:
+                  continue
+               elif line.startswith('dat '):
+                  key = tuple([int(field) for field in line.split()[1:4]])
+               elif line.startswith('row '):
+                  positions[None] = int(line.split()[1])
+               elif line.startswith('shuffle '):
+                  order = tuple([int(field) for field in line.split()[1:3]])
+               elif line.startswith('group '):
+                  (name, n) = line[6:].rsplit(' ', 1)
+                  positions[name] = int(n)
+         finally:
+            f.close()
+      except (ValueError, IndexError), e:
+         WARNING("[dscore]  Bad cursor %s: %s - serving %s from the start" % (self.Cursor, str(e), self.Name))
+         return
+
+      if (key == None) or (len(key) != 3) or (key != self.cursor_key(key[1])):
+         WARNING("[dscore]  Cursor %s does not match %s - serving it from the start" % (self.Cursor, self.File))
+         return
+
+      if self.Type == "CSV":
+         if self.Idx != None:
+            self.Idx = min(positions.get(None, 0), len(self.Data))
+
+         if self.Idx and (order != self.order()):     # Keep to the order already begun
+            if (order == None) == (self.Order == 'shuffled') or (order and order[0] != self.Seed):
+               WARNING("[dscore]  Cursor %s is for another order - serving the rest of %s in it" % (self.Cursor, self.Name))
+
+            if order:
+               self.Shuffle = Permutation(order[1], order[0])
+            else:
+               self.Shuffle = None
+      else:
+         for (name, n) in positions.items():
+            group = self.Data.get(name)
+
+            if group != None:
+               group.skip(n)
+
+   #------------------------------------------------------------------
+
+   def write_cursor(self, lines):
+      "Record where the source has got to in the .dat"
+
+      header = [
+                  "# Rows of %s handed out - delete this file to start again" % self.File,
+                  "dat %d %d %d" % self.cursor_key(),
+               ]
+
+      try:
+         replace_file(self.Cursor, header + lines)
+      except (IOError, OSError), e:
+         sys.stderr.write('[dscore]  Cursor write for %s failed: %s\n' % (self.Name, str(e)))
+         return 0
+
+      return 1
+
+   #------------------------------------------------------------------
+
+   def append_rows(self, lines):
+      "Add lines to the end of the .dat - synced before a cursor counts them"
+
+      if not lines:
+         return 1
+
+      try:
+         f = open(self.File, 'r+b')
+
+         try:
+            f.seek(0, 2)
+
+            if f.tell() > 0:
+               f.seek(-1, 2)
+
+               if f.read(1) != '\n':    # Finish a last line with no newline
+                  lines = [''] + lines
+
+               f.seek(0, 2)
+
+            f.writelines("%s\n" % line for line in lines)
+            f.flush()
+            os.fsync(f.fileno())
+         finally:
+            f.close()
+      except (IOError, OSError), e:
+         sys.stderr.write('[dscore]  Append to %s failed: %s\n' % (self.File, str(e)))
+         return 0
+
+      return 1
+
+   #------------------------------------------------------------------
+
+   def order(self):
+      "(seed, rows) of the shuffled order rows are handed out in - None for file order"
+
+      if self.Shuffle:
+         return (self.Shuffle.Seed, self.Shuffle.Size)
+      else:
+         return None
+
+   #------------------------------------------------------------------
+
+   def map_rows(self, skip_blank=False):
+      try:
+         return MappedRows(self.File, self.Comments, skip_blank)
+      except (IOError, mmap.error), e:
+         sys.stderr.write('[dscore]  Map failed: %s\n' % str(e))
+         sys.exit(1)
+
+   #------------------------------------------------------------------
+
+   def read_rows(self):
+      try:
+         f = open(self.File, 'r')
+      except IOError, e:
+         sys.stderr.write('[dscore]  Open failed: %s\n' % str(e))
+         sys.exit(1)
+
+      data = []
+
+      while True:
+         line = f.readline()
+
+         if not line: break
+
+         line = line.strip()
+
+         if p_comment.match(line):
+            self.Comments.append(line)
+            continue
+
+         data.append(line)
+
+      f.close()
+
+      return data
+
+   #------------------------------------------------------------------
+
+   def backup(self):
+      "Keep the .dat as it was loaded - once per run, as a hard link if possible"
+
+      if self.BackedUp or not os.path.exists(self.File):
+         return
+
+      ts     = datetime.now().strftime('%Y%m%d%H%M%S')
+      backup = "%s/tmp/%s_%s.bak" % (self.Environment, ts, self.Name)
+
+      try:
+         os.link(self.File, backup)    # The .dat is only ever replaced by rename
+      except OSError:
+         shutil.copy2(self.File, backup)
+
+      self.BackedUp = True
+
+   #------------------------------------------------------------------
+
+   def rewrite(self, lines, backup=True):
+      "Atomically replace the .dat with lines - temp file, fsync, rename"
+
+      try:
+         if backup:
+            self.backup()
+
+         replace_file(self.File, lines)
+      except (IOError, OSError), e:
+         sys.stderr.write('[dscore]  Flush of %s failed: %s\n' % (self.Name, str(e)))
+         return 0
+
+      return 1
+
+   #------------------------------------------------------------------
+
+   def flush_csv(self):
+      "Append rows stored since the last flush, then move the cursor"
+
+      with self.Lock:
+         idx   = self.Idx or 0
+         rows  = self.Data[self.FileRows:]
+         order = self.order()
+
+      if not self.append_rows(rows):
+         return 0
+
+      self.FileRows += len(rows)
+
+      if order:
+         return self.write_cursor(["row %d" % idx, "shuffle %d %d" % order])
+
+      return self.write_cursor(["row %d" % idx])
+
+   #------------------------------------------------------------------
+
+   def flush_keyed(self):
+      "Append each group's stored rows as a further [group] section, then move the cursor"
+
+      groups = self.Data.items()       # group() may add to Data meanwhile
+
+      groups.sort()
+
+      lines   = []
+      pending = []
+
+      for (key, group) in groups:
+         with group.Lock:
+            rows  = group.pending()
+            idx   = group.Idx
+            taken = group.Taken
+
+         if rows:
+            lines.append("[%s]" % key)
+            lines.extend(rows)
+            lines.append("")
+            pending.append((group, len(rows), idx, taken))
+
+      if not self.append_rows(lines):
+         return 0
+
+      for (group, n, idx, taken) in pending:
+         with group.Lock:              # Rows popped meanwhile may be ones just written
+            group.FileRows += n
+            group.Idx       = min(idx + group.Taken - taken, group.FileRows)
+
+      return self.write_cursor(["group %s %d" % (key, group.Idx) for (key, group) in groups if group.Idx > 0])
+
+   #------------------------------------------------------------------
+
+   def compact(self):
+      "Rewrite the .dat without the rows already handed out (COMPACT)"
+
+      self.Compact = False
+
+      if not self.Valid:
+         return
+
+      t_start = time.time()
+
+      if self.Type == "CSV":
+         rc = self.compact_csv()
+      elif self.Type == "Keyed":
+         rc = self.compact_keyed()
+      else:
+         rc = 0
+
+      if rc:
+         INFO("Compacted %s in %.3fs" % (self.Name, time.time() - t_start))
+
+   #------------------------------------------------------------------
+
+   def compact_csv(self):
+      with self.Lock:
+         idx     = self.Idx or 0
+         n       = len(self.Data)
+         shuffle = self.Shuffle
+
+      if shuffle and not shuffle.Size:     # Already in the order left
+         shuffle = None
+
+      if shuffle:                      # Rows left go in the order they are to be handed out
+         rows = (self.Data[shuffle[i]] for i in xrange(idx, n))
+
+         if not isinstance(self.Data, MappedRows):
+            rows = list(rows)
+      else:
+         rows = (self.Data[i] for i in xrange(idx, n))     # Not a copy - mmap rows stay on disk
+
+      if not self.rewrite(itertools.chain(self.Comments, rows)):
+         return 0
+
+      if shuffle and isinstance(self.Data, MappedRows):
+         try:
+            mapped = MappedRows(self.File, [])
+         except (IOError, mmap.error), e:
+            sys.stderr.write('[dscore]  Map failed: %s\n' % str(e))
+            return 0
+
+      with self.Lock:                  # Keep Data indexed as the new .dat
+         if shuffle:
+            if isinstance(self.Data, MappedRows):
+               mapped.Extra = self.Data[n:]
+               self.Data    = mapped
+            else:
+               self.Data = rows + self.Data[n:]
+
+            self.Shuffle = Permutation(0, shuffle.Seed)     # The .dat is now in the order left
+         elif isinstance(self.Data, MappedRows):
+            self.Data.drop(idx)
+         else:
+            self.Data = self.Data[idx:]
+
+         if self.Idx != None:
+            self.Idx -= idx
+
+         self.FileRows = n - idx
+
+      return self.flush_csv()
+
+   #------------------------------------------------------------------
+
+   def compact_keyed(self):
+      groups = self.Data.items()
+
+      groups.sort()
+
+      lines    = list(self.Comments)
+      captured = []
+
+      for (key, group) in groups:
+         with group.Lock:
+            rows  = list(group.Data)
+            taken = group.Taken
+
+         lines.append("[%s]" % key)
+         lines.extend(group.Comments)
+         lines.extend(rows)
+         lines.append("")
+
+         captured.append((group, len(rows), taken))
+
+      if not self.rewrite(lines):
+         return 0
+
+      for (group, n, taken) in captured:
+         with group.Lock:              # The held rows are now the whole .dat
+            group.FileRows = n
+            group.Idx      = min(group.Taken - taken, n)
+
+      return self.flush_keyed()
+
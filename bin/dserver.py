@@ -53,6 +53,65 @@
     This is more portable than fork which exists on Windows only
     under such POSIX implementations as Cygwin.
 
+    Alternatively the server can be started with an event loop
+    engine (-E async) which services all client connections from
+    a single thread using asyncore.  Both engines serve the same
+    Source objects through process().
+
+      $ dserver.py -E async -w /path/to/data/
+
+    Wire protocol:
+
+    Clients start with the original pipe delimited text protocol
+    (e.g. "INIT|C", "GETN|3") in which each recv() is taken to be
+    a single message.  This is what the dcl.dll C clients use.
+
+    A client may instead ask for the framed (v2) protocol by sending
+    "INIT|Python|2".  The reply to the INIT and every message after
+    it is then sent as a length prefixed frame:
+
+      +-----------------+--------------------------------------+
+      | length (uint32) | body (length bytes)                  |
+      +-----------------+--------------------------------------+
+
+    Request bodies start with a binary header - opcode (uint8) and
+    source handle (int32, -1 if the opcode takes none) - followed by
+    any remaining arguments, '|' separated.  Reply bodies are the
+    same reply strings returned by the text protocol.  Framing
+    means rows of any size can be sent and requests pipelined on a
+    single socket are never merged together.
+
+    Audit logging:
+
+    Every row handed out and every row stored is recorded in the
+    data set's tmp/<name>.used and tmp/<name>.stored files.  The
+    Journal entry in the [Config] section of dserver.ini selects
+    when these are committed - sync (each record), records:<n> or
+    interval:<ms> (group committed by a background writer).
+
+    Loading:
+
+    By default every source is read in before the server listens.
+    With Load=lazy in the [Config] section a source is only read in
+    when it is first registered (or first used), and with
+    Load=background a thread reads the remaining sources in, in
+    dserver.ini order, once the server is listening.  Loaders=<n>
+    has an eager load parse the sources in n processes at once.
+    The async engine always loads eagerly, as a source read in by
+    the event loop would hold up every client until it was done.
+
+    With Snapshot=on each flush also writes the parsed source to
+    tmp/<name>.snap (marshal) along with the size and mtime of the
+    .dat just written.  While the .dat is unchanged the next start
+    loads the snapshot instead of parsing the text again.
+
+    Metrics:
+
+    process() counts every request by opcode and source and keeps a
+    latency histogram per opcode along with the error (*...*) replies
+    returned.  The STATS opcode returns these, plus the rows left in
+    each CSV and Keyed source, as Prometheus style text.
+
     This version has been extended to use the standard Python
     logging module.
 
@@ -67,17 +126,31 @@ import re
 import csv
 import sys
 import time
+import random
 import getopt
 import signal
+import errno
 import thread
+import threading
+import struct
+import asyncore
 import marshal
+import itertools
 import logging
+import zlib
+import multiprocessing
 
 #---------------------------------------------------------------------
 
 from socket   import *          # get socket constructor and constants
 from datetime import datetime
 
+import dscore
+
+from dscore   import Journal, Metrics, Group, Persistence, Permutation, alias_table, get_source, \
+                     set_journal_policy, init_journal, stop_journal, init_checkpoint, stop_checkpoint, \
+                     checkpoint_event, checkpoint_lock, leases, init_leases, stop_leases
+
 #---------------------------------------------------------------------
 
 __id__            = "@(#)  dserver.py  [2.2.0]  2011-06-30"
@@ -91,75 +164,136 @@ verbose_flg       = False
 wait_flg          = False
 
 debug_level       = 0
+engine            = 'threaded'     #  'threaded' or 'async' (event loop)
 
 HOST              = ''             #  Host server - '' means localhost
 PORT              = 9578           #  Listen on a non-reserved port number
+BACKLOG           = 128            #  Pending connects queued by listen()
 ENVIRONMENT       = 'SVT'
 
 sockobj           = None
 data_dir          = None
-client_language   = None
 log               = None
-sources           = []
+sources           = dscore.sources
+source_index      = {}             #  Source name -> handle
 attributes        = {}
+ts_cache          = (0, None)      #  (second, formatted audit timestamp)
+
+load_mode         = 'eager'        #  'eager', 'lazy' or 'background'
+loader_thread     = None           #  Loads deferred sources ('background')
+loaders           = 1              #  Processes parsing sources at startup ('eager')
+snapshot_flg      = False          #  Write tmp/<name>.snap at flush and load from it
+checkpoint_interval = 0            #  Seconds between checkpoints - 0 only on FLUSH
+lease_ttl         = 300.0          #  Seconds a CHECKOUT row is held before it goes back
+shutdown_flg      = False          #  Set by SIGTERM - the dispatcher stops and shuts down
 
 CONFIGFILE        = "dserver.ini"
 LOGFILE           = "dserver.log"
 PIDFILE           = "dserver.pid"
 
+ENGINES           = ('threaded', 'async')
+LOAD_MODES        = ('eager', 'lazy', 'background')
+SOURCE_TYPES      = ('CSV', 'Sequence', 'KeyedSequence', 'Hashed', 'Indexed', 'Keyed', 'Indexer', 'Counter', 'Weighted')
+DEFERRED_TYPES    = ('CSV', 'KeyedSequence', 'Hashed', 'Indexed', 'Keyed', 'Weighted')   #  Loaded lazily - the rest are tiny
+SNAPSHOT_VERSION  = 2
+CHECKPOINT_TYPES  = ('CSV', 'Sequence', 'KeyedSequence', 'Keyed')   #  Rewritten by a checkpoint
+CURSOR_TYPES      = ('CSV', 'Keyed')     #  .dat only appended to - progress kept in tmp/<name>.cur
+ORDERS            = ('file', 'shuffled')     #  Orders CSV rows can be handed out in
+
+PROTOCOL_V1       = 1              #  Pipe delimited text - one message per recv()
+PROTOCOL_V2       = 2              #  Length prefixed frames with binary header
+
+FRAME_HEADER      = struct.Struct('!I')       #  Frame body length
+REQUEST_HEADER    = struct.Struct('!Bi')      #  Opcode, source handle
+MAX_FRAME         = 64 * 1024 * 1024
+
+OPCODES           = {
+                       1  : 'INIT',
+                       2  : 'REG',
+                       3  : 'REGK',
+                       4  : 'REGI',
+                       5  : 'GETN',
+                       6  : 'GETKS',
+                       7  : 'GETK',
+                       8  : 'GETKR',
+                       9  : 'GETH',
+                       10 : 'GETI',
+                       11 : 'STOC',
+                       12 : 'STOK',
+                       13 : 'GETNB',
+                       14 : 'GETKB',
+                       15 : 'GETIR',
+                       16 : 'STATS',
+                       17 : 'FLUSH',
+                       18 : 'COMPACT',
+                       19 : 'GETW',
+                       20 : 'GETWB',
+                       21 : 'CHECKOUT',
+                       22 : 'COMMIT',
+                       23 : 'RELEASE',
+                    }
+
+ARG_SPLITS        = {                         #  Max splits of v2 arguments
+                       'REGK'  : 1,
+                       'STOK'  : 1,
+                       'GETKB' : 1,
+                       'GETIR' : 1,
+                    }
+
+ROW_SEPARATOR     = '\n'           #  Between rows in block (GETNB etc) replies
+MAX_DRAWS         = 100000         #  Rows a GETWB may ask for
+
+SESSION_OPS       = ('INIT', 'REG')     #  Replies depend on the connection's INIT
+
 INVALID           = 'INVALID'
 DELIMITER         = 'delimiter'
 TAG_DELIMITER     = 'tag_delimiter'
+STORAGE           = 'storage'      #  'mmap' - CSV/Indexed rows read from a mapped .dat
+ORDER             = 'order'        #  'shuffled' - CSV rows handed out in a seeded random order
+SEED              = 'seed'         #  Of the shuffled order - defaults to the source name
 
 p_comment         = re.compile('^#')
 
 #=====================================================================
 
-class Group:
-   Name     = None
-   Idx      = None
-   Data     = None
-
-   def __init__(self, name):
-      self.Name       = name
-      self.Idx        = 0
-      self.Data       = []
-      self.Comments   = []
-
-   def __str__(self):
-      s = "Grp %s  Len %d" % (self.Name, len(self.Data))
-      return s
-
-   def append_comments(self, s):
-      self.Comments.append(s)
-
-   def append_data(self, s):
-      self.Data.append(s)
-
-   def set_idx(self):
-      if len(self.Data) > 0:
-         self.Idx  = 0
-      else:
-         self.Idx  = -1
+metrics           = Metrics()
 
-#---------------------------------------------------------------------
+#=====================================================================
 
-class Source:
+class Source(Persistence):
    Count    = 0
    Valid    = False
    Name     = None
    Type     = None
    Idx      = None
    Data     = None
+   FileRows = 0                    # Rows of Data that are in the .dat (CSV)
 
-   def __init__(self, name, environment, source_type, attributes={}, delimiter=None):
+   TYPE_HANDLERS = {               # GETN and GETNB handlers for each type
+      'CSV'      : ('get_next_row',   'get_block_rows'),
+      'Sequence' : ('get_next_value', 'get_block_values'),
+      'Indexer'  : ('get_next_value', 'get_block_values'),
+      'Counter'  : ('get_counter',    'get_block_unsupported'),
+   }
+
+   def __init__(self, name, environment, source_type, attributes={}, delimiter=None, lazy=False):
       self.Name        = name
       self.Environment = environment
       self.Type        = source_type
       self.File        = "%s/%s.dat" % (environment, name)
       self.Used        = "%s/tmp/%s.used" % (environment, name)
       self.Stored      = "%s/tmp/%s.stored" % (environment, name)
+      self.Snapshot    = "%s/tmp/%s.snap" % (environment, name)
+      self.Cursor      = "%s/tmp/%s.cur" % (environment, name)
       self.Comments    = []
+      self.Lock        = thread.allocate_lock()     # Guards Idx/Data claims
+      self.Dirty       = False     # Changed since the .dat was last written
+      self.BackedUp    = False     # tmp/<ts>_<name>.bak taken this run
+      self.Compact     = False     # COMPACT asked for - done by the next checkpoint
+      self.Storage     = attributes.get(STORAGE)
+      self.Order       = attributes.get(ORDER, 'file')
+      self.Seed        = zlib.crc32(str(attributes.get(SEED, name))) & 0xffffffff
+      self.Shuffle     = None      # Permutation of the .dat rows when Order is shuffled
 
       # sys.stderr.write("Loading %s\n" % self.Name)
       # sys.stderr.flush()
@@ -181,6 +315,114 @@ class Source:
       else:
          self.Delimiter  = ','
 
+      if attributes.has_key(TAG_DELIMITER):      # KeyedSequence, Hashed and Weighted
+         self.tag_delimiter  = attributes[TAG_DELIMITER]
+      else:
+         self.tag_delimiter  = ':'
+
+      if self.Type not in SOURCE_TYPES:
+         print "[dserver]  Bad source_type [%s]" % source_type
+         sys.exit(1)
+
+      if (self.Order not in ORDERS) or (self.Order != 'file' and self.Type != "CSV"):
+         print "[dserver]  Bad order [%s] for %s" % (self.Order, name)
+         sys.exit(1)
+
+      self.Lazy        = lazy and (self.Type in DEFERRED_TYPES)
+      self.Failed      = False
+      self.LoadLock    = thread.allocate_lock()     # Held while the .dat is read in
+      self.Size        = None
+      self.Attributes  = {
+                            'Type'       : self.Type,
+                            'Delimiter'  : self.Delimiter,
+                            'Size'       : self.Size
+                         }
+
+      try:
+         self.ufh = Journal(self.Used)
+      except IOError, e:
+         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
+         sys.exit(1)
+
+      try:
+         self.sfh = Journal(self.Stored)
+      except IOError, e:
+         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
+         sys.exit(1)
+
+      if not self.Lazy:
+         self.load()
+      elif not os.path.exists(self.File):
+         sys.stderr.write('[dserver]  No data file: %s\n' % self.File)
+         sys.exit(1)
+
+   #------------------------------------------------------------------
+
+   def load(self, state=None):
+      """
+      Read the .dat file in (once) - False if a deferred load failed.
+      state is (rc, export()) from a loader process that has already
+      read it in (see load_parallel()).
+      """
+
+      if self.Valid:
+         return True
+
+      with self.LoadLock:
+         if self.Valid or self.Failed:
+            return self.Valid
+
+         t_start    = time.time()
+
+         if state == None and snapshot_flg:
+            state = self.read_snapshot()
+
+         try:
+            if state != None:
+               (rc, exported) = state
+               self.adopt(exported)
+            else:
+               rc = self.read_in()
+         except SystemExit:             # init_* exit on a bad .dat
+            if not self.Lazy: raise
+            rc = None
+
+         if not rc:
+            if not self.Lazy:
+               print "[dserver]  Bad source_type [%s]" % self.Type
+               sys.exit(1)
+
+            ERROR("[dserver]  Deferred load of %s failed" % self.Name)
+            self.Failed = True
+            return False
+
+         if self.Order == 'shuffled':
+            self.Shuffle = Permutation(self.FileRows, self.Seed)
+
+         if self.Type in CURSOR_TYPES:
+            self.restore_cursor()
+
+         self.bind_handlers()
+
+         self.Size        = len(self.Data)
+         self.Attributes  = {
+                               'Type'       : self.Type,
+                               'Delimiter'  : self.Delimiter,
+                               'Size'       : self.Size
+                            }
+
+         self.Valid       = True        # Last - get_source() only checks Valid
+
+         if self.Lazy:
+            INFO("Loaded %s in %.3fs" % (str(self), time.time() - t_start))
+
+      return True
+
+   #------------------------------------------------------------------
+
+   def read_in(self):
+      "Type specific read of the .dat file - True if it worked"
+
       rc = None
 
       if self.Type == "CSV":
@@ -190,17 +432,9 @@ class Source:
          rc = self.init_sequence()
 
       elif self.Type == "KeyedSequence":
-         if attributes.has_key(TAG_DELIMITER):
-            self.tag_delimiter  = attributes[TAG_DELIMITER]
-         else:
-            self.tag_delimiter  = ':'
          rc = self.init_keyed_sequence()
 
       elif self.Type == "Hashed":
-         if attributes.has_key(TAG_DELIMITER):
-            self.tag_delimiter  = attributes[TAG_DELIMITER]
-         else:
-            self.tag_delimiter  = ':'
          rc = self.init_hashed()
 
       elif self.Type == "Indexed":
@@ -209,37 +443,74 @@ class Source:
       elif self.Type == "Keyed":
          rc = self.init_keyed()
 
+      elif self.Type == "Weighted":
+         rc = self.init_weighted()
+
       elif self.Type == "Indexer":
          rc = self.init_indexer()
 
       elif self.Type == "Counter":
          rc = self.init_counter()
 
-      if rc:
-         self.Valid = True
+      return rc
+
+   #------------------------------------------------------------------
+
+   def export(self):
+      """
+      The rows as read from the .dat, as plain lists and dicts that
+      marshal can send.  How far they have been handed out is kept in
+      the cursor file - except for Keyed groups, which no longer hold
+      the rows they have handed out (see snapshot_key()).
+      """
 
+      idx = self.Idx
+
+      if self.Type == "Keyed":
+         data = {}
+
+         for (name, group) in self.Data.items():    # Rows still to be handed out
+            rows = itertools.islice(group.Data, 0, group.FileRows - group.Idx)
+
+            data[name] = (list(rows), group.Comments, group.Idx)
+
+      elif self.Type == "CSV":
+         data = self.Data[:self.FileRows]
+
+         if len(data) > 0:
+            idx = 0
+         else:
+            idx = None
+      elif self.Type == "Weighted":
+         data = (self.Data, self.Prob.tolist(), self.Alias.tolist())
       else:
-         print "[dserver]  Bad source_type [%s]" % source_type
-         sys.exit(1)
+         data = self.Data
 
-      self.Size        = len(self.Data)
-      self.Attributes  = {
-                            'Type'       : self.Type,
-                            'Delimiter'  : self.Delimiter,
-                            'Size'       : self.Size
-                         }
+      return {
+                'Data'     : data,
+                'Idx'      : idx,
+                'Comments' : self.Comments,
+             }
 
-      try:
-         self.ufh = open(self.Used, 'a+')
-      except IOError, e:
-         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-         sys.exit(1)
+   #------------------------------------------------------------------
 
-      try:
-         self.sfh = open(self.Stored, 'a+')
-      except IOError, e:
-         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-         sys.exit(1)
+   def snapshot_key(self):
+      "What a snapshot must have been taken against to be used"
+
+      st  = os.stat(self.File)
+      key = (SNAPSHOT_VERSION, self.Type, self.tag_delimiter, st.st_size, st.st_mtime)
+
+      if self.Type == "Keyed":         # Handed out rows are not in it - nor can the cursor have moved
+         try:
+            f = open(self.Cursor, 'rb')
+            try:
+               key += (zlib.crc32(f.read()) & 0xffffffff,)
+            finally:
+               f.close()
+         except IOError:
+            key += (None,)
+
+      return key
 
    #------------------------------------------------------------------
 
@@ -250,6 +521,9 @@ class Source:
          s += " * "
          if self.Type == "CSV":
             s += " %9d rows" % len(self.Data)
+
+            if self.Shuffle:
+               s += " (shuffled)"
          elif self.Type == "Sequence":
             s += " Starting value %d" % self.Data[0]
          elif self.Type == "KeyedSequence":
@@ -260,10 +534,14 @@ class Source:
             s += " %9d rows"   % len(self.Data)
          elif self.Type == "Keyed":
             s += " %9d groups" % len(self.Data)
+         elif self.Type == "Weighted":
+            s += " %9d rows"   % len(self.Data)
          elif self.Type == "Indexer":
             s += " Starting value %d" % self.Data[0]
          elif self.Type == "Counter":
             s += " Starting value %d" % self.Data[0]
+      elif self.Lazy and not self.Failed:
+         s += "    (loads on first use)"
       else:
          s += "   "
 
@@ -271,35 +549,205 @@ class Source:
 
    #------------------------------------------------------------------
 
-   def init_csv(self):
-      try:
-         f = open(self.File, 'r')
-      except IOError, e:
-         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-         sys.exit(1)
+   def bind_handlers(self):
+      "Bind the type specific GETN/GETNB handlers - saves testing Type per request"
 
-      self.Data = []
+      (get_next, get_block) = self.TYPE_HANDLERS.get(self.Type,
+                                   ('get_next_unsupported', 'get_block_unsupported'))
 
-      while True:
-         line = f.readline()
+      self.get_next  = getattr(self, get_next)
+      self.get_block = getattr(self, get_block)
 
-         if not line: break
+   #------------------------------------------------------------------
 
-         line = line.strip()
+   def get_next_row(self):
+      rows = self.claim()
 
-         if p_comment.match(line):
-            self.Comments.append(line)
-            continue
+      if rows:
+         return rows[0]
+      else:
+         return "*Exhausted*"
 
-         self.Data.append(line)
+   def get_next_value(self):
+      return "%d" % self.next_value()
 
-      f.close()
+   def get_counter(self):
+      return "%d" % self.Data[0]
+
+   def get_next_unsupported(self):
+      return "*UNKNOWN*SOURCE*TYPE*"
+
+   #------------------------------------------------------------------
+
+   def get_block_rows(self, n):
+      "Returns (reply, rows) for a GETNB of up to n rows"
+
+      rows = self.claim(n)
+
+      if rows:
+         return (ROW_SEPARATOR.join(rows), rows)
+      else:
+         return ("*Exhausted*", rows)
+
+   def get_block_values(self, n):
+      start = self.next_value(n)
+      rows  = ["%d" % i for i in xrange(start, start + n)]
+
+      return (ROW_SEPARATOR.join(rows), rows)
+
+   def get_block_unsupported(self, n):
+      return ("*UNKNOWN*SOURCE*TYPE*", [])
+
+   #------------------------------------------------------------------
+
+   def group_sizes(self):
+      "(group, rows, bytes) for each group of a Keyed source, largest first"
+
+      with self.Lock:                     # group() may be adding one
+         groups = list(self.Data.values())
+
+      sizes = [(g.Name, len(g.Data), g.Bytes) for g in groups]
+
+      sizes.sort(key=lambda size: size[1], reverse=True)
+
+      return sizes
+
+   #------------------------------------------------------------------
+
+   def remaining(self):
+      "Unclaimed rows for CSV and Keyed sources - None for other types"
+
+      if not self.Valid:
+         return None
+      elif self.Type == "CSV":
+         return len(self.Data) - max(self.Idx or 0, 0)
+      elif self.Type == "Keyed":
+         with self.Lock:
+            groups = list(self.Data.values())
+
+         return sum([len(g.Data) for g in groups])
+      else:
+         return None
+
+   #------------------------------------------------------------------
+
+   def claim(self, n=1):
+      "Atomically claim up to n unconsumed CSV rows - returns a (possibly empty) list"
+
+      with self.Lock:
+         if self.Idx == None:
+            return []
+
+         start      = self.Idx
+         self.Idx   = min(start + n, len(self.Data))
+         self.Dirty = True
+
+         if self.Shuffle and start < self.Shuffle.Size:
+            return [self.Data[self.Shuffle[i]] for i in xrange(start, self.Idx)]
+
+         return self.Data[start:self.Idx]
+
+   #------------------------------------------------------------------
+
+   def draw(self, n=1):
+      "n rows of a Weighted source, each picked at random in proportion to its weight"
+
+      data  = self.Data
+      prob  = self.Prob
+      alias = self.Alias
+      size  = len(data)
+      rows  = []
+
+      for i in xrange(n):
+         u      = random.random() * size
+         column = int(u)
+
+         if (u - column) >= prob[column]:
+            column = alias[column]
+
+         rows.append(data[column])
+
+      return rows
+
+   #------------------------------------------------------------------
+
+   def next_value(self, n=1):
+      "Atomically advance a Sequence/Indexer by n - returns the first value"
+
+      with self.Lock:
+         value         = self.Data[0]
+         self.Data[0] += n
+         self.Dirty    = True
+
+         return value
+
+   #------------------------------------------------------------------
+
+   def next_keyed_value(self, key):
+      "Atomically advance a KeyedSequence - returns None for an unknown key"
+
+      with self.Lock:
+         value = self.Data.get(key)
+
+         if value != None:
+            self.Data[key] = value + 1
+            self.Dirty     = True
+
+         return value
+
+   #------------------------------------------------------------------
+
+   def store(self, data):
+      "Append a row to a CSV source"
+
+      with self.Lock:
+         self.Data.append(data)
+
+         self.Dirty = True
+
+         if self.Idx == None:
+            self.Idx = 0
+
+   #------------------------------------------------------------------
+
+   def give_back(self, row):
+      "A leased row comes back - handed out again after the rows still to come"
+
+      self.store(row)              # Never logged as used, so not logged as stored
+
+   #------------------------------------------------------------------
+
+   def group(self, name):
+      "Return the named Keyed group - creating it if need be"
+
+      g = self.Data.get(name)
+
+      if g == None:
+         with self.Lock:
+            g = self.Data.get(name)
+
+            if g == None:              # Add a new group!
+               g               = Group(name)
+               self.Data[name] = g
+               self.Dirty      = True
+
+      return g
+
+   #------------------------------------------------------------------
+
+   def init_csv(self):
+      if self.Storage == 'mmap':
+         self.Data = self.map_rows()
+      else:
+         self.Data = self.read_rows()
 
       if len(self.Data) > 0:
          self.Idx = 0
       else:
          self.Idx = None
 
+      self.FileRows = len(self.Data)
+
       if debug_level > 2: 
          INFO("Read in %d CSV rows - %s" % (len(self.Data), self.Name))
          if verbose_flg:  print "Read in %d CSV rows - %s" % (len(self.Data), self.Name)
@@ -374,7 +822,7 @@ class Source:
 
             tag = tag.strip()
 
-            self.Data[tag] = serial_no
+            self.Data[tag] = int(serial_no)
 
       f.close()
 
@@ -407,7 +855,7 @@ class Source:
 
          if (line.find("[") != -1):
             group_name            = line.replace('[','').replace(']','')
-            group                 = Group(group_name)
+            group                 = self.Data.get(group_name) or Group(group_name)
             self.Data[group_name] = group
             continue
 
@@ -480,6 +928,14 @@ class Source:
    #------------------------------------------------------------------
 
    def init_indexed(self):
+      if self.Storage == 'mmap':
+         self.Data = self.map_rows(skip_blank=True)
+
+         if debug_level > 2:
+            INFO("Mapped %d indexed rows - %s" % (len(self.Data), self.Name))
+
+         return len(self.Data)
+
       try:
          f = open(self.File, 'r')
       except IOError, e:
@@ -522,6 +978,60 @@ class Source:
 
    #------------------------------------------------------------------
 
+   def init_weighted(self):
+      try:
+         f = open(self.File, 'r')
+      except IOError, e:
+         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
+         sys.exit(1)
+
+      self.Data = []
+      weights   = []
+
+      while True:
+         line = f.readline()
+
+         if not line: break
+
+         line = line.strip()
+
+         if p_comment.match(line):
+            self.Comments.append(line)
+            continue
+
+         elif (len(line) == 0):
+            continue
+
+         try:
+            (weight, data) = line.split(self.tag_delimiter, 1)
+
+            weight = float(weight)
+         except ValueError:
+            weight = None
+
+         if not (0.0 <= weight < float('inf')):
+            sys.stderr.write('[dserver]  Bad weight in %s: %s\n' % (self.File, line))
+            sys.exit(1)
+
+         weights.append(weight)
+         self.Data.append(data)
+
+      f.close()
+
+      if self.Data and not (sum(weights) > 0.0):
+         sys.stderr.write('[dserver]  No row in %s has a weight\n' % self.File)
+         sys.exit(1)
+
+      (self.Prob, self.Alias) = alias_table(weights)
+
+      if debug_level > 2:
+         INFO("Read in %d weighted rows - %s" % (len(self.Data), self.Name))
+         if verbose_flg:  print "Read in %d weighted rows - %s" % (len(self.Data), self.Name)
+
+      return True
+
+   #------------------------------------------------------------------
+
    def init_counter(self):
       try:
          f = open(self.File, 'r')
@@ -556,132 +1066,62 @@ class Source:
 
    #------------------------------------------------------------------
 
-   def flush(self):
+   def flush(self, final=True):
+      "Write the source back to its .dat - at shutdown (final) or as a checkpoint"
+
       if not self.Valid:
          return
 
-      ts = datetime.now().strftime('%Y%m%d%H%M%S')
+      if final:
+         print "Flushing %s" % self.Name
 
-      self.BackupCmd  = "cp %s/%s.dat %s/tmp/%s_%s.bak" % (self.Environment, self.Name, self.Environment, ts, self.Name)
+      self.Dirty = False               # Changes from here on are caught next time
 
-      print "Flushing %s" % self.Name
+      rc = None
 
       if self.Type == "CSV":
-         self.flush_csv()
+         rc = self.flush_csv()
       elif self.Type == "Sequence":
-         self.flush_sequence()
+         rc = self.flush_sequence()
       elif self.Type == "KeyedSequence":
-         self.flush_keyed_sequence()
+         rc = self.flush_keyed_sequence()
       elif self.Type == "Keyed":
-         self.flush_keyed()
+         rc = self.flush_keyed()
       elif self.Type == "Hashed":
-         self.flush_hashed()
+         rc = self.flush_hashed()
       elif self.Type == "Indexed":
-         self.flush_indexed()
+         rc = self.flush_indexed()
       elif self.Type == "Indexer":
          pass  # DO nothing!
-      elif self.Type == "Counter":
-         self.flush_counter()
+      elif self.Type == "Counter" and final:   # Bump RunNo once per run
+         rc = self.flush_counter()
 
-   #------------------------------------------------------------------
+      if rc == 0:
+         self.Dirty = True             # Try again at the next checkpoint
 
-   def flush_csv(self):
-      os.system(self.BackupCmd)
-
-      try:
-         f = open(self.File, 'wb')
-      except IOError, e:
-         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-         return 0
-
-      for line in  self.Comments:
-         f.write("%s\n" % line)
-
-      l = len(self.Data)
-      if l > 0:
-         i = self.Idx
-         while i < len(self.Data):
-            f.write("%s\n" % self.Data[i])
-            i += 1
-
-      f.close()
+      if final and snapshot_flg and rc != 0:   # 0 - the flush failed
+         self.write_snapshot()
 
    #------------------------------------------------------------------
 
    def flush_sequence(self):
-      os.system(self.BackupCmd)
-
-      try:
-         f = open(self.File, 'wb')
-      except IOError, e:
-         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-         return 0
-
-      for line in  self.Comments:
-         f.write("%s\n" % line)
-
-      f.write("%d\n" % self.Data[0])
+      value = self.Data[0]
 
-      f.close()
+      return self.rewrite(self.Comments + ["%d" % value])
 
    #------------------------------------------------------------------
 
    def flush_keyed_sequence(self):
-      os.system(self.BackupCmd)
+      with self.Lock:
+         data = self.Data.copy()
 
-      try:
-         f = open(self.File, 'wb')
-      except IOError, e:
-         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-         return 0
-
-      group_keys = self.Data.keys()
+      group_keys = data.keys()
 
       group_keys.sort()
 
-      for line in  self.Comments:
-         f.write("%s\n" % line)
-
-      for key in group_keys:
-         f.write("%s%s%s\n" % (key, self.tag_delimiter, self.Data[key]))
+      lines = ["%s%s%s" % (key, self.tag_delimiter, data[key]) for key in group_keys]
 
-      f.close()
-
-   #------------------------------------------------------------------
-
-   def flush_keyed(self):
-      os.system(self.BackupCmd)
-
-      try:
-         f = open(self.File, 'wb')
-      except IOError, e:
-         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-         return 0
-
-      group_keys = self.Data.keys()
-
-      group_keys.sort()
-
-      for line in  self.Comments:
-         f.write("%s\n" % line)
-
-      for key in group_keys:
-         f.write("[%s]\n" % key)
-
-         group = self.Data[key]
-
-         for line in  group.Comments:
-            f.write("%s\n" % line)
-
-         i = group.Idx
-
-         while i < len(group.Data):
-            f.write("%s\n" % group.Data[i])
-            i += 1
-
-         f.write("\n")
-
-      f.close()
+      return self.rewrite(self.Comments + lines)
 
    #------------------------------------------------------------------
 
@@ -696,20 +1136,9 @@ class Source:
    #------------------------------------------------------------------
 
    def flush_counter(self):
-      try:
-         f = open(self.File, 'wb')
-      except IOError, e:
-         sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-         return 0
-
-      for line in  self.Comments:
-         f.write("%s\n" % line)
-
       i = int(self.Data[0]) + 1
 
-      f.write("%d\n" % i)
-
-      f.close()
+      return self.rewrite(self.Comments + ["%d" % i], backup=False)
 
 #=====================================================================
 
@@ -732,7 +1161,9 @@ def WARNING(msg):
 #=====================================================================
 
 def read_config():
-   global PORT, ENVIRONMENT
+   global PORT, BACKLOG, ENVIRONMENT
+   global load_mode, loaders
+   global snapshot_flg, checkpoint_interval, lease_ttl
 
    config_file = data_dir + '/' + CONFIGFILE
 
@@ -766,11 +1197,57 @@ def read_config():
 
           PORT = int(definition[1].strip())
 
+      elif (line.find("Backlog=") != -1):
+          definition  = line.split("=")
+
+          BACKLOG = max(int(definition[1].strip()), 1)
+
       elif (line.find("Environment=") != -1):
           definition  = line.split("=")
 
           ENVIRONMENT = definition[1].strip()
 
+      elif (line.find("Journal=") != -1):
+          definition  = line.split("=")
+
+          if not set_journal_policy(definition[1]):
+             WARNING("[dserver::read_config]  Bad journal policy '%s' - using %s" % (definition[1], dscore.journal_policy))
+
+      elif (line.find("Checkpoint=") != -1):
+          definition  = line.split("=")
+
+          checkpoint_interval = max(float(definition[1].strip()), 0)
+
+      elif (line.find("LeaseTTL=") != -1):
+          definition  = line.split("=")
+
+          lease_ttl = float(definition[1].strip())
+
+      elif (line.find("Snapshot=") != -1):
+          definition  = line.split("=")
+
+          snapshot_flg = definition[1].strip().lower() in ('on', 'yes', 'true', '1')
+
+      elif (line.find("Loaders=") != -1):
+          definition  = line.split("=")
+
+          loaders = max(int(definition[1].strip()), 1)
+
+      elif (line.find("Load=") != -1):
+          definition  = line.split("=")
+
+          if definition[1].strip() in LOAD_MODES:
+             load_mode = definition[1].strip()
+          else:
+             WARNING("[dserver::read_config]  Bad load mode '%s' - using %s" % (definition[1], load_mode))
+
+          if engine == 'async' and load_mode != 'eager':
+             # A deferred source is read in by whichever request first
+             # uses it - on the event loop that would stall every client
+
+             WARNING("[dserver::read_config]  Load=%s not supported by the async engine - using eager" % load_mode)
+             load_mode = 'eager'
+
       if (line.find("[Data]") != -1):
          definition_flg = True
 
@@ -784,307 +1261,656 @@ def read_config():
           except:
              attributes = {}
 
-          source = Source(name, ENVIRONMENT, source_type, attributes)
+          source = Source(name, ENVIRONMENT, source_type, attributes,
+                          lazy=(load_mode != 'eager') or (loaders > 1))
 
+          source_index[name] = len(sources)
           sources.append(source)
 
+          if source.Lazy and load_mode == 'eager':
+             continue                   # Reported by load_parallel()
+
           INFO(str(source))
 
-          print "Loaded %s" % str(source)
+          print "%s %s" % (source.Lazy and "Deferred" or "Loaded", str(source))
 
-   print "\nData Loaded...\n"
+   if load_mode == 'eager':
+      if loaders > 1:
+         load_parallel()
+
+      print "\nData Loaded...\n"
+   else:
+      print "\nData Deferred (%s)...\n" % load_mode
 
    f.close()
 
 #---------------------------------------------------------------------
 
 def get_source_index(name):
-   for i in range(len(sources)):
-      if (sources[i].Name == name):
-         return i
+   return source_index.get(name, -1)
+
+#---------------------------------------------------------------------
 
-   return -1
+def timestamp():
+   "Audit log timestamp - only formatted once a second"
+
+   global ts_cache
+
+   now = int(time.time())
+
+   (second, ts) = ts_cache
+
+   if now != second:
+      ts       = datetime.fromtimestamp(now).strftime('%Y%m%d%H%M%S')
+      ts_cache = (now, ts)
+
+   return ts
 
 #---------------------------------------------------------------------
 
-def process(s):
-   global client_language
+class Session:
+   """
+   What a client connection has agreed with the server - the protocol
+   and the client language given by its INIT.  Clients of both kinds
+   share a server, so neither may be kept globally.
+   """
 
-   msg = s.split("|")
-   l   = len(msg)
+   def __init__(self):
+      self.Protocol = PROTOCOL_V1
+      self.Language = None         # 'Python' or 'C' (None until INIT)
 
-   if debug_level > 1:  INFO("[dserver::process] len %d  msg %s" % (l, msg))
+direct_session    = Session()      #  For process() called without a connection (bm_*.py)
 
-   ts    = datetime.now().strftime('%Y%m%d%H%M%S')
-   reply = "None"
+#---------------------------------------------------------------------
 
-   if (msg[0] == "INIT"):
-      client_language = msg[1]
+def process(s, session=None):
+   return process_message(s.split("|"), session)
 
-      if client_language == 'Python':
-         reply = "%s" % marshal.dumps(attributes)
-      else:  # client_language == 'C'
-         reply = "0"
+#---------------------------------------------------------------------
 
-   elif (msg[0] == "REG"):
-      name = msg[1].replace('\n','').replace('\r','')
-      idx  = get_source_index(name)
-      if debug_level > 0:  INFO("[dserver::process]  REG '%s' -> %d" % (name, idx))
+def process_message(msg, session=None):
+   if debug_level > 1:  INFO("[dserver::process] len %d  msg %s" % (len(msg), msg))
 
-      if client_language == 'Python':
-         reply = "%d|%s" % (idx, marshal.dumps(sources[idx].Attributes))
-      else:  # client_language == 'C'
-         reply = "%d" % idx
+   handler = HANDLERS.get(msg[0])
 
-   elif (msg[0] == "REGK"):
-      if (len(msg) != 3):
-         ERROR("[dserver::process]  REGK -> Bad Message '%s'" % str(msg))
-         reply = "*BAD*MESSAGE*"
-      else:
-         reply = "0"
+   if handler == None:
+      return "None"
+
+   t_start = time.time()
 
-   elif (msg[0] == "REGI"):
-      if (len(msg) != 2):
-         ERROR("[dserver::process]  REGI -> Bad Message '%s'" % str(msg))
-         reply = "*BAD*MESSAGE*"
+   try:
+      if msg[0] in SESSION_OPS:
+         reply = handler(msg, session or direct_session)
       else:
-         reply = "0"
+         reply = handler(msg)
+   except (IndexError, ValueError, TypeError, AttributeError), e:
+      # Arguments missing or of the wrong kind - a malformed v2 frame
+      # must not take the connection (or the event loop) down with it
 
-   elif (msg[0] == "GETN"):
-      if (len(msg) == 2):
-         hdl  = int(msg[1])
+      ERROR("[dserver::process]  %s -> Bad Message %s (%s)" % (msg[0], str(msg), str(e)))
+      reply = "*BAD*MESSAGE*"
 
-         try:
-            source = sources[hdl]
-         except:
-            source = None
+   metrics.record(msg, reply, time.time() - t_start)
 
-         if source != None:
-            if source.Type == 'CSV':
-               if ((source.Idx != None) and (source.Idx < len(source.Data))):
-                  reply  = source.Data[source.Idx]
-                  source.Idx += 1
-               else:
-                  reply = "*Exhausted*"
-            elif source.Type == "Sequence":
-               reply = "%d" % source.Data[0]
-               source.Data[0] += 1
-            elif source.Type == "Indexer":
-               reply = "%d" % source.Data[0]
-               source.Data[0] += 1
-            elif source.Type == "Counter":
-               reply = "%d" % source.Data[0]
-            else:
-               reply = "*UNKNOWN*SOURCE*TYPE*"
-         else:
-            reply = "*BAD*SOURCE*INDEX*"
+   return reply
 
-         source.ufh.write("%s - %s\n" % (ts, reply))
-         source.ufh.flush()
+#---------------------------------------------------------------------
+
+def do_init(msg, session):
+   session.Language = msg[1]
+
+   if session.Language == 'Python':
+      return "%s" % marshal.dumps(attributes)
+   else:  # session.Language == 'C'
+      return "0"
+
+#---------------------------------------------------------------------
+
+def do_reg(msg, session):
+   name = msg[1].replace('\n','').replace('\r','')
+   idx  = get_source_index(name)
+   if debug_level > 0:  INFO("[dserver::process]  REG '%s' -> %d" % (name, idx))
+
+   if session.Language == 'Python':
+      if idx >= 0 and sources[idx].load():
+         source_attributes = sources[idx].Attributes
       else:
-         ERROR("[dserver::process]  GETN -> Bad Message '%s'" % str(msg))
-         reply = "*BAD*MESSAGE*"
+         source_attributes = {}
+      return "%d|%s" % (idx, marshal.dumps(source_attributes))
+   else:  # session.Language == 'C'
+      return "%d" % idx
 
-      if debug_level > 2:  INFO("[dserver::process]  GETN -> %s" % reply)
+#---------------------------------------------------------------------
 
-   elif (msg[0] == "GETKS"):
-      if (len(msg) == 3):
-         hdl  = int(msg[1])
-         grp  = msg[2]
+def do_regk(msg):
+   if (len(msg) != 3):
+      ERROR("[dserver::process]  REGK -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
 
-         try:
-            source = sources[hdl]
-         except:
-            source = None
+   return "0"
 
-         if source != None:
-            try:
-               g = source.Data[grp]
-            except:
-               g = None
-            if g != None:
-               reply  = g.Data[0]
-               g.Data[0] += 1
-               g.Idx += 1
-            else:
-               reply = "*INVALID*GROUP*"
+#---------------------------------------------------------------------
 
-         else:
-            reply = "*BAD*SOURCE*INDEX*"
+def do_regi(msg):
+   if (len(msg) != 2):
+      ERROR("[dserver::process]  REGI -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
 
-         source.ufh.write("%s - %s::%s\n" % (ts, grp, reply))
-         source.ufh.flush()
+   return "0"
+
+#---------------------------------------------------------------------
+
+def do_getn(msg):
+   if (len(msg) != 2):
+      ERROR("[dserver::process]  GETN -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+
+   if source != None:
+      reply = source.get_next()
+
+      source.ufh.write("%s - %s\n" % (timestamp(), reply))
+   else:
+      reply = "*BAD*SOURCE*INDEX*"
+
+   if debug_level > 2:  INFO("[dserver::process]  GETN -> %s" % reply)
+
+   return reply
+
+#---------------------------------------------------------------------
+
+def do_getks(msg):
+   if (len(msg) != 3):
+      ERROR("[dserver::process]  GETKS -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+   grp    = msg[2]
+
+   if source != None:
+      value = source.next_keyed_value(grp)
+
+      if value != None:
+         reply = "%d" % value
       else:
-         ERROR("[dserver::process]  GETKS -> Bad Message '%s'" % str(msg))
-         reply = "*BAD*MESSAGE*"
+         reply = "*INVALID*GROUP*"
 
-      if debug_level > 2:  INFO("[dserver::process]  GETKS %s -> %s" % (grp, reply))
+      source.ufh.write("%s - %s::%s\n" % (timestamp(), grp, reply))
+   else:
+      reply = "*BAD*SOURCE*INDEX*"
 
-   elif (msg[0] == "GETK"):
-      if (len(msg) == 3):
-         hdl  = int(msg[1])
-         grp  = msg[2]
+   if debug_level > 2:  INFO("[dserver::process]  GETKS %s -> %s" % (grp, reply))
 
-         try:
-            source = sources[hdl]
-         except:
-            source = None
+   return reply
 
-         if source != None:
-            try:
-               g = source.Data[grp]
-            except:
-               g = None
-
-            if g != None:
-               if (g.Idx < len(g.Data)):
-                  reply  = g.Data[g.Idx]
-                  g.Idx += 1
-               else:
-                  reply = "*GROUP*EXHAUSTED*"
-            else:
-               reply = "*INVALID*GROUP*"
+#---------------------------------------------------------------------
 
-         else:
-            reply = "*BAD*SOURCE*INDEX*"
+def do_getk(msg):
+   if (len(msg) != 3):
+      ERROR("[dserver::process]  GETK -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
 
-         source.ufh.write("%s - %s::%s\n" % (ts, grp, reply))
-         source.ufh.flush()
+   source = get_source(msg[1])
+   grp    = msg[2]
+
+   if source != None:
+      try:
+         g = source.Data[grp]
+      except:
+         g = None
+
+      if g != None:
+         rows = g.claim()
+         source.Dirty = True
+         if rows:
+            reply  = rows[0]
+         else:
+            reply = "*GROUP*EXHAUSTED*"
       else:
-         ERROR("[dserver::process]  GETK -> Bad Message '%s'" % str(msg))
-         reply = "*BAD*MESSAGE*"
+         reply = "*INVALID*GROUP*"
+
+      source.ufh.write("%s - %s::%s\n" % (timestamp(), grp, reply))
+   else:
+      reply = "*BAD*SOURCE*INDEX*"
+
+   if debug_level > 2:  INFO("[dserver::process]  GETK %s -> %s" % (grp, reply))
+
+   return reply
+
+#---------------------------------------------------------------------
+
+def do_geth(msg):
+   if (len(msg) != 3):
+      ERROR("[dserver::process]  GETH -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
 
-      if debug_level > 2:  INFO("[dserver::process]  GETK %s -> %s" % (grp, reply))
+   source = get_source(msg[1])
+   key    = msg[2]
+
+   if source != None:
+      try:
+         reply = source.Data[key]
+      except:
+         reply = "*UNDEFINED*HASH*"
+
+      source.ufh.write("%s - %s::%s\n" % (timestamp(), key, reply))
+   else:
+      reply = "*BAD*SOURCE*INDEX*"
 
-   elif (msg[0] == "GETH"):
-      if (len(msg) == 3):
-         hdl  = int(msg[1])
-         key  = msg[2]
+   if debug_level > 2:  INFO("[dserver::process]  GETH %s -> %s" % (key, reply))
 
+   return reply
+
+#---------------------------------------------------------------------
+
+def do_geti(msg):
+   if (len(msg) != 3):
+      ERROR("[dserver::process]  GETI -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+
+   try:
+      idx = int(msg[2])
+   except:
+      idx = None
+      ERROR("[dserver::process]  GETI -> Non integer index - [%s]" % msg[2])
+
+   if source != None:
+      if ((idx >= 0) and (idx < len(source.Data))):
          try:
-            source = sources[hdl]
+            reply = source.Data[idx]
          except:
-            source = None
+            reply = "*INDEX*OUT*OF*RANGE*"
+      else:
+         reply = "*INVALID*INDEX*"
 
-         if source != None:
-            try:
-               reply = source.Data[key]
-            except:
-               reply = "*UNDEFINED*HASH*"
+      source.ufh.write("%s - %s::%s\n" % (timestamp(), idx, reply))
+   else:
+      reply = "*BAD*SOURCE*INDEX*"
 
-         else:
-            reply = "*BAD*SOURCE*INDEX*"
+   if debug_level > 2:  INFO("[dserver::process]  GETI %s -> %s" % (idx, reply))
 
-         source.ufh.write("%s - %s::%s\n" % (ts, key, reply))
-         source.ufh.flush()
+   return reply
+
+#---------------------------------------------------------------------
+
+def do_getnb(msg):                 # Claim a block of up to n rows
+   if (len(msg) != 3):
+      ERROR("[dserver::process]  GETNB -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+   rows   = []
+
+   try:
+      n = int(msg[2])
+   except:
+      n = 0
+
+   if source == None:
+      reply = "*BAD*SOURCE*INDEX*"
+   elif n <= 0:
+      reply = "*BAD*COUNT*"
+   else:
+      (reply, rows) = source.get_block(n)
+
+   if source != None:
+      ts = timestamp()
+      if rows:
+         source.ufh.write("".join(["%s - %s\n" % (ts, row) for row in rows]))
       else:
-         ERROR("[dserver::process]  GETH -> Bad Message", msg)
-         reply = "*BAD*MESSAGE*"
+         source.ufh.write("%s - %s\n" % (ts, reply))
 
-      if debug_level > 2:  INFO("[dserver::process]  GETH %s -> %s" % (key, reply))
+   if debug_level > 2:  INFO("[dserver::process]  GETNB -> %s" % reply)
 
-   elif (msg[0] == "GETI"):
-      if (len(msg) == 3):
-         hdl    = int(msg[1])
+   return reply
 
-         try:
-            idx = int(msg[2])
-         except:
-            idx = None
-            ERROR("[dserver::process]  GETI -> Non integer index - [%s]" % msg[2])
+#---------------------------------------------------------------------
 
-         try:
-            source = sources[hdl]
-         except:
-            source = None
-
-         if source != None:
-            if ((idx >= 0) and (idx < len(source.Data))):
-               try:
-                  reply = source.Data[idx]
-               except:
-                  reply = "*INDEX*OUT*OF*RANGE*"
-            else:
-               reply = "*INVALID*INDEX*"
+def do_getkb(msg):                 # Claim a block of up to n rows from a group
+   if (len(msg) != 4):
+      ERROR("[dserver::process]  GETKB -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+   grp    = msg[2]
+   rows   = []
+
+   try:
+      n = int(msg[3])
+   except:
+      n = 0
+
+   if source != None:
+      try:
+         g = source.Data[grp]
+      except:
+         g = None
+
+      if g == None:
+         reply = "*INVALID*GROUP*"
+      elif n <= 0:
+         reply = "*BAD*COUNT*"
+      else:
+         rows = g.claim(n)
+         source.Dirty = True
+         if rows:
+            reply = ROW_SEPARATOR.join(rows)
          else:
-            reply = "*BAD*SOURCE*INDEX*"
+            reply = "*GROUP*EXHAUSTED*"
 
-         source.ufh.write("%s - %s::%s\n" % (ts, idx, reply))
-         source.ufh.flush()
+      ts = timestamp()
+      if rows:
+         source.ufh.write("".join(["%s - %s::%s\n" % (ts, grp, row) for row in rows]))
       else:
-         ERROR("[dserver::process]  GETI -> Bad Message '%s'" % str(msg))
-         reply = "*BAD*MESSAGE*"
+         source.ufh.write("%s - %s::%s\n" % (ts, grp, reply))
+   else:
+      reply = "*BAD*SOURCE*INDEX*"
 
-      if debug_level > 2:  INFO("[dserver::process]  GETI %s -> %s" % (idx, reply))
+   if debug_level > 2:  INFO("[dserver::process]  GETKB -> %s" % reply)
 
-   elif (msg[0] == "STOC"):
-      if (len(msg) == 3):
-         hdl   = int(msg[1])
-         data  = msg[2]
-         reply = "0"
+   return reply
 
-         try:
-            source = sources[hdl]
-         except:
-            source = None
-
-         if source != None:
-            source.Data.append(data)
-            if source.Idx == None:
-               source.Idx = 0
-            source.sfh.write("%s - %s\n" % (ts, data))
-            source.sfh.flush()
-            if debug_level > 1: INFO("STOC %s" % data)
-            reply = "1"
-         else:
-            reply = "*BAD*SOURCE*INDEX*"
+#---------------------------------------------------------------------
+
+def do_getir(msg):                 # Range of up to n rows from index start
+   if (len(msg) != 4):
+      ERROR("[dserver::process]  GETIR -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+   rows   = []
+
+   try:
+      idx = int(msg[2])
+      n   = int(msg[3])
+   except:
+      idx = None
+      n   = 0
+      ERROR("[dserver::process]  GETIR -> Non integer index or count - %s" % msg[2:])
+
+   if source != None:
+      if ((idx >= 0) and (idx < len(source.Data)) and (n > 0)):
+         rows  = source.Data[idx:idx + n]
+         reply = ROW_SEPARATOR.join(rows)
       else:
-         ERROR("[dserver::process]  STOC -> Bad Message '%s'" % str(msg))
-         reply = "*BAD*MESSAGE*"
+         reply = "*INVALID*INDEX*"
 
-      if debug_level > 2:  INFO("[dserver::process]  STOC %s -> %s" % (data, reply))
+      ts = timestamp()
+      if rows:
+         source.ufh.write("".join(["%s - %s::%s\n" % (ts, idx + i, rows[i]) for i in xrange(len(rows))]))
+      else:
+         source.ufh.write("%s - %s::%s\n" % (ts, idx, reply))
+   else:
+      reply = "*BAD*SOURCE*INDEX*"
 
-   elif (msg[0] == "STOK"):
-      if (len(msg) == 4):
-         hdl  = int(msg[1])
-         grp  = msg[2]
-         data = msg[3]
+   if debug_level > 2:  INFO("[dserver::process]  GETIR -> %s" % reply)
 
-         reply = "0"
+   return reply
 
-         try:
-            source = sources[hdl]
-         except:
-            source = None
+#---------------------------------------------------------------------
 
-         if source != None:
-            if source.Data.has_key(grp):
-               g                = source.Data[grp]
-            else:
-               g                = Group(grp)
-               source.Data[grp] = g
-            if g != None:
-               g.Data.append(data)
-               if debug_level > 1: INFO("STOK %s %s" % (grp, data))
-               source.sfh.write("%s - %s::%s\n" % (ts, grp, data))
-               source.sfh.flush()
-            reply = "1"
-         else:
-            reply = "*BAD*SOURCE*INDEX*"
+def do_getw(msg):                  # Draw a row in proportion to the weights
+   if (len(msg) != 2):
+      ERROR("[dserver::process]  GETW -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+
+   if source == None:
+      reply = "*BAD*SOURCE*INDEX*"
+   elif source.Type != "Weighted":
+      reply = "*UNKNOWN*SOURCE*TYPE*"
+   elif len(source.Data) == 0:
+      reply = "*Exhausted*"
+   else:                             # Not logged as used - a draw uses nothing up
+      reply = source.draw()[0]
+
+   if debug_level > 2:  INFO("[dserver::process]  GETW -> %s" % reply)
+
+   return reply
+
+#---------------------------------------------------------------------
+
+def do_getwb(msg):                 # Draw n rows in proportion to the weights
+   if (len(msg) != 3):
+      ERROR("[dserver::process]  GETWB -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+
+   try:
+      n = int(msg[2])
+   except:
+      n = 0
+
+   if source == None:
+      reply = "*BAD*SOURCE*INDEX*"
+   elif source.Type != "Weighted":
+      reply = "*UNKNOWN*SOURCE*TYPE*"
+   elif (n <= 0) or (n > MAX_DRAWS):
+      reply = "*BAD*COUNT*"
+   elif len(source.Data) == 0:
+      reply = "*Exhausted*"
+   else:                             # Not logged as used - see do_getw()
+      rows  = source.draw(n)
+      reply = ROW_SEPARATOR.join(rows)
+
+   if debug_level > 2:  INFO("[dserver::process]  GETWB -> %s" % reply)
+
+   return reply
+
+#---------------------------------------------------------------------
+
+def do_checkout(msg):              # Lease the next CSV row - back to the source unless COMMITted in time
+   if (len(msg) not in (2, 3)):
+      ERROR("[dserver::process]  CHECKOUT -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+
+   try:
+      if len(msg) == 3:
+         ttl = float(msg[2])
       else:
-         ERROR("[dserver::process]  STOK -> Bad Message '%s'" % str(msg))
-         reply = "*BAD*MESSAGE*"
+         ttl = lease_ttl
+   except ValueError:
+      ttl = 0
+
+   if source == None:
+      reply = "*BAD*SOURCE*INDEX*"
+   elif source.Type != "CSV":
+      reply = "*UNKNOWN*SOURCE*TYPE*"
+   elif not (0 < ttl < float('inf')):
+      reply = "*BAD*TTL*"
+   else:
+      rows = source.claim()
+
+      if rows:
+         reply = leases.checkout(source, rows[0], ttl) + ROW_SEPARATOR + rows[0]
+      else:
+         reply = "*Exhausted*"
+
+   if debug_level > 2:  INFO("[dserver::process]  CHECKOUT -> %s" % reply)
+
+   return reply
+
+#---------------------------------------------------------------------
+
+def do_commit(msg):                # A leased row is used - it does not go back
+   if (len(msg) != 3):
+      ERROR("[dserver::process]  COMMIT -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+   row    = None
+
+   if source != None:
+      row = leases.end(source, msg[2])
+
+   if source == None:
+      reply = "*BAD*SOURCE*INDEX*"
+   elif row == None:
+      reply = "*UNKNOWN*LEASE*"
+   else:
+      source.ufh.write("%s - %s\n" % (timestamp(), row))     # Only now is the row used
+      reply = "1"
+
+   if debug_level > 2:  INFO("[dserver::process]  COMMIT %s -> %s" % (msg[2], reply))
+
+   return reply
+
+#---------------------------------------------------------------------
+
+def do_release(msg):               # A leased row was not used - it goes back now
+   if (len(msg) != 3):
+      ERROR("[dserver::process]  RELEASE -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+   row    = None
+
+   if source != None:
+      row = leases.end(source, msg[2])
+
+   if source == None:
+      reply = "*BAD*SOURCE*INDEX*"
+   elif row == None:
+      reply = "*UNKNOWN*LEASE*"
+   else:
+      source.give_back(row)
+      reply = "1"
+
+   if debug_level > 2:  INFO("[dserver::process]  RELEASE %s -> %s" % (msg[2], reply))
+
+   return reply
+
+#---------------------------------------------------------------------
+
+def do_stoc(msg):
+   if (len(msg) != 3):
+      ERROR("[dserver::process]  STOC -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+   data   = msg[2]
+
+   if source != None:
+      source.store(data)
+      source.sfh.write("%s - %s\n" % (timestamp(), data))
+      if debug_level > 1: INFO("STOC %s" % data)
+      reply = "1"
+   else:
+      reply = "*BAD*SOURCE*INDEX*"
+
+   if debug_level > 2:  INFO("[dserver::process]  STOC %s -> %s" % (data, reply))
+
+   return reply
+
+#---------------------------------------------------------------------
+
+def do_stok(msg):
+   if (len(msg) != 4):
+      ERROR("[dserver::process]  STOK -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+   grp    = msg[2]
+   data   = msg[3]
+
+   if source != None:
+      g = source.group(grp)
+      if g != None:
+         g.store(data)
+         source.Dirty = True
+         if debug_level > 1: INFO("STOK %s %s" % (grp, data))
+         source.sfh.write("%s - %s::%s\n" % (timestamp(), grp, data))
+      reply = "1"
+   else:
+      reply = "*BAD*SOURCE*INDEX*"
 
-      if debug_level > 2:  INFO("[dserver::process]  STOK %s %s -> %s" % (grp, data, reply))
+   if debug_level > 2:  INFO("[dserver::process]  STOK %s %s -> %s" % (grp, data, reply))
 
    return reply
 
 #---------------------------------------------------------------------
 
+def do_stats(msg):                 # Counters, latency histograms and gauges
+   return metrics.text()
+
+#---------------------------------------------------------------------
+
+def do_flush(msg):                 # Checkpoint now - does not wait for it
+   dirty = len([source for source in sources if source.Dirty and source.Type in CHECKPOINT_TYPES])
+
+   checkpoint_event.set()
+
+   return "%d" % dirty
+
+#---------------------------------------------------------------------
+
+def do_compact(msg):               # Drop handed out rows from the .dat at the next checkpoint
+   if (len(msg) != 2):
+      ERROR("[dserver::process]  COMPACT -> Bad Message '%s'" % str(msg))
+      return "*BAD*MESSAGE*"
+
+   source = get_source(msg[1])
+
+   if source == None:
+      reply = "*BAD*SOURCE*INDEX*"
+   elif source.Type not in CURSOR_TYPES:
+      reply = "*UNKNOWN*SOURCE*TYPE*"
+   else:
+      source.Compact = True
+      checkpoint_event.set()
+      reply = "1"
+
+   if debug_level > 2:  INFO("[dserver::process]  COMPACT %s -> %s" % (msg[1], reply))
+
+   return reply
+
+#---------------------------------------------------------------------
+
+HANDLERS = {                       # process() dispatch table
+   'INIT'   : do_init,
+   'REG'    : do_reg,
+   'REGK'   : do_regk,
+   'REGI'   : do_regi,
+   'GETN'   : do_getn,
+   'GETKS'  : do_getks,
+   'GETK'   : do_getk,
+   'GETH'   : do_geth,
+   'GETI'   : do_geti,
+   'GETNB'  : do_getnb,
+   'GETKB'  : do_getkb,
+   'GETIR'  : do_getir,
+   'GETW'   : do_getw,
+   'GETWB'  : do_getwb,
+   'CHECKOUT': do_checkout,
+   'COMMIT' : do_commit,
+   'RELEASE': do_release,
+   'STOC'   : do_stoc,
+   'STOK'   : do_stok,
+   'STATS'  : do_stats,
+   'FLUSH'  : do_flush,
+   'COMPACT': do_compact,
+}
+
+#---------------------------------------------------------------------
+
 def sig_term(signum, frame):
-   "SIGTERM handler"
+   """
+   SIGTERM handler - only asks the dispatcher to stop.  The handler
+   runs on the main thread, which under the async engine may be part
+   way through a request holding a source, lease or journal lock, so
+   the flush is left to shutdown() once the dispatcher has returned.
+   """
 
-   shutdown()
+   global shutdown_flg
+
+   shutdown_flg = True
 
 #---------------------------------------------------------------------
 
@@ -1093,8 +1919,13 @@ def shutdown():
 
    print "\n"
 
-   for i in range(len(sources)):
-      sources[i].flush()
+   stop_leases()                    # Rows out on lease go back before the journals close
+   stop_journal()
+   stop_checkpoint()
+
+   with checkpoint_lock:
+      for i in range(len(sources)):
+         sources[i].flush()
 
    print "*SHUTDOWN*"
 
@@ -1208,10 +2039,102 @@ def init_logging():
    log.addHandler(hdlr)
    log.setLevel(logging.INFO)
 
+   dscore.log = log                 # The shared code logs to the same file
+
    INFO("Server startup at %s" % datetime.now())
 
 #---------------------------------------------------------------------
 
+def load_sources():
+   "Read in every deferred source, in dserver.ini order"
+
+   t_start = time.time()
+
+   for source in sources:
+      source.load()
+
+   INFO("All sources loaded in %.3fs" % (time.time() - t_start))
+
+#---------------------------------------------------------------------
+
+def parse_source(i):
+   "Run in a loader process - read source i in, return it marshalled"
+
+   source  = sources[i]
+   t_start = time.time()
+
+   try:
+      rc = source.read_in()
+   except SystemExit:
+      rc = None
+
+   if rc:
+      state = marshal.dumps((rc, source.export()))
+   else:
+      state = None
+
+   return (i, state, time.time() - t_start)
+
+#---------------------------------------------------------------------
+
+def load_parallel():
+   "Parse the deferred sources in loaders processes and adopt the results"
+
+   t_start  = time.time()
+   deferred = [source for source in sources if not source.Valid]
+   parallel = []
+
+   for i in range(len(sources)):
+      if sources[i].Valid:
+         continue
+
+      state = snapshot_flg and sources[i].read_snapshot()
+
+      if state or (sources[i].Storage == 'mmap'):     # Nothing to parse - or it can't be sent
+         sources[i].load(state or None)
+      else:
+         parallel.append(i)
+
+   no_loaders = min(loaders, len(parallel), multiprocessing.cpu_count())
+
+   if no_loaders < 2:                           # Not worth the transfer
+      for i in parallel:
+         sources[i].load()
+   else:
+      pool = multiprocessing.Pool(no_loaders)
+
+      try:
+         for (i, state, parsed) in pool.imap_unordered(parse_source, parallel):
+            INFO("Parsed %s in %.3fs by a loader" % (sources[i].Name, parsed))
+
+            if state:
+               sources[i].load(marshal.loads(state))
+      finally:
+         pool.close()
+         pool.join()
+
+   for source in deferred:
+      if not source.Valid:
+         print "[dserver]  Load failed [%s]" % source.Name
+         sys.exit(1)
+
+      INFO(str(source))
+
+      print "Loaded %s" % str(source)
+
+   INFO("All sources loaded in %.3fs by %d loaders" % (time.time() - t_start, max(no_loaders, 1)))
+
+#---------------------------------------------------------------------
+
+def start_loader():
+   global loader_thread
+
+   loader_thread = threading.Thread(target=load_sources, name='Loader')
+   loader_thread.setDaemon(True)
+   loader_thread.start()
+
+#---------------------------------------------------------------------
+
 def init_server():
    pid = check_running()
 
@@ -1229,12 +2152,21 @@ def init_server():
    if (not silent_flg):
       INFO("Server PID is %d" % pid)
 
+   init_journal()
+   init_checkpoint(checkpoint_interval, CHECKPOINT_TYPES)
+   init_leases()
+
    setup_connection()
 
-   print "[dserver]  Listening on port %s - Data from %s" % (PORT, os.getcwd())
+   if load_mode == 'background':
+      start_loader()
+
+   print "[dserver]  Listening on port %s - Data from %s (%s engine)" % (PORT, os.getcwd(), engine)
 
    dispatcher()
 
+   shutdown()
+
 #---------------------------------------------------------------------
 
 def terminate(pid=None):
@@ -1285,13 +2217,106 @@ def setup_connection():
    global sockobj
 
    sockobj = socket(AF_INET, SOCK_STREAM)  # make a TCP socket object
+   sockobj.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)   # restart without waiting out TIME_WAIT
    sockobj.bind((HOST, PORT))              # bind it to server port number
-   sockobj.listen(10)                      # allow upto 10 pending connects
+   sockobj.listen(BACKLOG)                 # vusers often all connect at once
+
+#---------------------------------------------------------------------
+
+def requested_protocol(request):
+   "Protocol version asked for by an 'INIT|<language>|<version>' message"
+
+   msg = request.split("|")
+
+   if msg[0] == "INIT" and len(msg) > 2 and msg[2].strip() == "2":
+      return PROTOCOL_V2
+
+   return PROTOCOL_V1
+
+#---------------------------------------------------------------------
+
+def encode_frame(reply):
+   return FRAME_HEADER.pack(len(reply)) + reply
+
+#---------------------------------------------------------------------
+
+def decode_request(body):
+   "Unpack a v2 request body into the message list used by process_message()"
+
+   if len(body) < REQUEST_HEADER.size:
+      ERROR("[dserver::decode_request]  Short request (%d bytes)" % len(body))
+      return None
+
+   (code, hdl) = REQUEST_HEADER.unpack_from(body)
+
+   op   = OPCODES.get(code, '*UNKNOWN*')
+   args = body[REQUEST_HEADER.size:]
+   msg  = [op]
+
+   if hdl >= 0:
+      msg.append(hdl)
+
+   if args:
+      msg.extend(args.split("|", ARG_SPLITS.get(op, 0)))
+
+   return msg
+
+#---------------------------------------------------------------------
+
+def recv_exactly(connection, n):
+   chunks = []
+
+   while n > 0:
+      chunk = connection.recv(min(n, 65536))
+      if not chunk: return None
+      chunks.append(chunk)
+      n -= len(chunk)
+
+   return ''.join(chunks)
+
+#---------------------------------------------------------------------
+
+def recv_frame(connection):
+   header = recv_exactly(connection, FRAME_HEADER.size)
+
+   if header is None: return None
+
+   (length,) = FRAME_HEADER.unpack(header)
+
+   if length > MAX_FRAME:
+      ERROR("[dserver::recv_frame]  Frame too large (%d bytes)" % length)
+      return None
+
+   return recv_exactly(connection, length)
 
 #---------------------------------------------------------------------
 
 def handle_client(connection):             # in spawned thread: reply
+   session = Session()
+
    while True:                             # read, write a client socket
+      if session.Protocol == PROTOCOL_V2:
+         try:
+            body = recv_frame(connection)
+         except:
+            break
+
+         if body is None: break
+
+         msg = decode_request(body)
+
+         if debug_level > 0: INFO('[dserver]  Request -> %s' % msg)
+
+         if msg is None:
+            reply = "*BAD*MESSAGE*"
+         else:
+            reply = process_message(msg, session)
+
+         if debug_level > 0: INFO('[dserver]  Reply   -> "%s..."' % reply[0:30])
+
+         connection.sendall(encode_frame(reply))
+         continue
+
       try:
          request = connection.recv(1024)
       except:
@@ -1301,25 +2326,157 @@ def handle_client(connection):             # in spawned thread: reply
 
       if not request: break
 
-      reply = process(request)
+      reply = process(request, session)
 
       if debug_level > 0: INFO('[dserver]  Reply   -> "%s..."' % reply[0:30])
 
-      connection.send(reply)
+      if request.startswith("INIT"):
+         session.Protocol = requested_protocol(request)
+
+      if session.Protocol == PROTOCOL_V2:
+         connection.sendall(encode_frame(reply))
+      else:
+         connection.send(reply)
 
    connection.close()
 
 #---------------------------------------------------------------------
 
 def dispatcher():
-   while True:
+   if engine == 'async':
+      async_dispatcher()
+      return
+
+   while not shutdown_flg:
       # Wait for next connection,
-      connection, address = sockobj.accept()
+      try:
+         connection, address = sockobj.accept()
+      except error, e:
+         if e.args[0] == errno.EINTR: continue     # SIGTERM - shutdown_flg is set
+         raise
 
       INFO('Host (%s) - Connected at %s' % (address[0], datetime.now()))
 
       thread.start_new(handle_client, (connection,))
 
+#==== Event Loop Server ==============================================
+
+class AsyncHandler(asyncore.dispatcher):
+   """
+   Services a single client connection from the shared event loop.
+   Each read is handed to process() exactly as handle_client() does
+   and the reply is queued until the socket is writable.  Requests
+   run on the loop thread, so nothing they do may block for long -
+   which is why sources are never loaded lazily under this engine.
+   """
+
+   def __init__(self, connection):
+      asyncore.dispatcher.__init__(self, connection)
+      self.session    = Session()
+      self.in_buffer  = ''
+      self.out_buffer = ''
+
+   def handle_read(self):
+      try:
+         request = self.recv(65536)
+      except:
+         self.close()
+         return
+
+      if not request: return          # recv() has already closed on EOF
+
+      if self.session.Protocol == PROTOCOL_V2:
+         self.in_buffer += request
+         self.handle_frames()
+         return
+
+      if debug_level > 0: INFO('[dserver]  Request -> "%s"' % request)
+
+      reply = process(request, self.session)
+
+      if debug_level > 0: INFO('[dserver]  Reply   -> "%s..."' % reply[0:30])
+
+      if request.startswith("INIT"):
+         self.session.Protocol = requested_protocol(request)
+
+      if self.session.Protocol == PROTOCOL_V2:
+         self.out_buffer += encode_frame(reply)
+      else:
+         self.out_buffer += reply
+
+   def handle_frames(self):
+      "Service every complete frame held in the input buffer"
+
+      offset = 0
+
+      while len(self.in_buffer) - offset >= FRAME_HEADER.size:
+         (length,) = FRAME_HEADER.unpack_from(self.in_buffer, offset)
+
+         if length > MAX_FRAME:
+            ERROR("[dserver::handle_frames]  Frame too large (%d bytes)" % length)
+            self.close()
+            return
+
+         start = offset + FRAME_HEADER.size
+
+         if len(self.in_buffer) < start + length: break
+
+         msg    = decode_request(self.in_buffer[start:start + length])
+         offset = start + length
+
+         if debug_level > 0: INFO('[dserver]  Request -> %s' % msg)
+
+         if msg is None:
+            reply = "*BAD*MESSAGE*"
+         else:
+            reply = process_message(msg, self.session)
+
+         if debug_level > 0: INFO('[dserver]  Reply   -> "%s..."' % reply[0:30])
+
+         self.out_buffer += encode_frame(reply)
+
+      self.in_buffer = self.in_buffer[offset:]
+
+   def writable(self):
+      return len(self.out_buffer) > 0
+
+   def handle_write(self):
+      sent            = self.send(self.out_buffer)
+      self.out_buffer = self.out_buffer[sent:]
+
+   def handle_close(self):
+      self.close()
+
+#---------------------------------------------------------------------
+
+class AsyncServer(asyncore.dispatcher):
+   def __init__(self, listener):
+      asyncore.dispatcher.__init__(self, listener)
+      self.accepting = True           # already bound and listening
+
+   def handle_accept(self):
+      pair = self.accept()
+
+      if pair is None: return
+
+      connection, address = pair
+
+      INFO('Host (%s) - Connected at %s' % (address[0], datetime.now()))
+
+      AsyncHandler(connection)
+
+#---------------------------------------------------------------------
+
+def async_dispatcher():
+   AsyncServer(sockobj)
+
+   # poll() rather than select() so we are not limited to FD_SETSIZE
+   # (typically 1024) concurrent client connections.  A SIGTERM cuts
+   # the poll short, so shutdown_flg is seen as soon as it is set
+
+   while not shutdown_flg:
+      asyncore.loop(timeout=30.0, use_poll=True, count=1)
+
 #=====================================================================
 
 def main():
@@ -1330,12 +2487,13 @@ def main():
    global wait_flg
    global debug_level
    global data_dir
+   global engine
 
    data_dir   = None
    pid        = None
 
    try:
-      opts, args = getopt.getopt(sys.argv[1:], "cdDp:sTvVw:W?")
+      opts, args = getopt.getopt(sys.argv[1:], "cdDE:p:sTvVw:W?")
    except getopt.error, msg:
       print __doc__
       return 1
@@ -1347,6 +2505,8 @@ def main():
          check_flg      = True
       elif o == '-D':
          daemon_flg     = True
+      elif o == '-E':
+         engine         = a
       elif o == '-p':
          pid            = int(a)
       elif o == '-s':
@@ -1355,6 +2515,7 @@ def main():
          terminate_flg  = True
       elif o == '-v':
          verbose_flg    = True
+         dscore.verbose_flg = True
       elif o == '-V':
          print "[dserver]  Version: %s" % __version__
          return 1
@@ -1366,6 +2527,10 @@ def main():
          print __doc__
          return 1
 
+   if engine not in ENGINES:
+      print "[dserver]  Unknown engine '%s' - use one of %s" % (engine, ', '.join(ENGINES))
+      return 1
+
    print "\n"
 
    wrk_path  = os.getcwd()
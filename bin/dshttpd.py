@@ -58,6 +58,7 @@
 import os
 import re
 import csv
+import json
 import sys
 import time
 import urllib
@@ -67,20 +68,30 @@ import shutil
 import mimetypes
 
 import random
+import itertools
 import getopt
 import signal
 import thread
 import marshal
 import logging
+import zlib
+import multiprocessing
 import socket
 import threading
 import SocketServer
+import Queue
 
 #--------------------------------------------------------------------------
 
 from datetime import datetime
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
+import dscore
+
+from dscore   import Journal, Group, Persistence, Permutation, alias_table, get_source, \
+                     set_journal_policy, init_journal, stop_journal, init_checkpoint, stop_checkpoint, \
+                     checkpoint_event, checkpoint_lock, leases, init_leases, stop_leases, resident_bytes
+
 #--------------------------------------------------------------------------
 
 __id__            = "@(#)  dshttpd.py  [2.3.1]  2011-07-25"
@@ -98,13 +109,30 @@ debug_level       = 0
 
 HOST              = ''             #  Host server - '' means localhost
 PORT              = 8000           #  Listen on a non-reserved port number
+IDLE_TIMEOUT      = 30             #  Seconds a keep-alive connection may sit idle
 ENVIRONMENT       = 'SVT'
 
 data_dir          = None
 client_language   = None
 log               = None
-sources           = []
+sources           = dscore.sources
+source_index      = {}             #  Source name -> handle
 attributes        = {}
+ts_cache          = (0, None)      #  (second, formatted audit timestamp)
+status_cache      = (0, None)      #  (time rendered, status page HTML)
+status_lock       = threading.Lock()
+status_interval   = 1.0            #  Seconds the status page is served from status_cache
+load_mode         = 'eager'        #  'eager', 'lazy' or 'background'
+loader_thread     = None           #  Loads deferred sources ('background')
+loaders           = 1              #  Processes parsing sources at startup ('eager')
+snapshot_flg      = False          #  Write tmp/<name>.snap at flush and load from it
+checkpoint_interval = 0            #  Seconds between checkpoints - 0 only on FLUSH
+lease_ttl         = 300.0          #  Seconds a CHECKOUT row is held before it goes back
+shutdown_flg      = False          #  Set by SIGTERM - serve() stops and shuts down
+
+pool_workers      = 0              #  Worker threads - 0 is a thread per connection
+pool_queue        = 64             #  Accepted connections waiting for a worker
+pool_overflow     = 'reject'       #  Queue full - 'reject' (503) or 'block'
 
 CONFIGFILE        = "dserver.ini"
 LOGFILE           = "dserver.log"
@@ -112,6 +140,27 @@ PIDFILE           = "dserver.pid"
 
 INVALID           = 'INVALID'
 
+POOL_OVERFLOWS    = ('reject', 'block')
+LOAD_MODES        = ('eager', 'lazy', 'background')
+SOURCE_TYPES      = ('CSV', 'Sequence', 'KeyedSequence', 'Hashed', 'Indexed', 'Keyed', 'Indexer', 'Counter', 'Barcodes', 'Weighted')
+DEFERRED_TYPES    = ('CSV', 'KeyedSequence', 'Hashed', 'Indexed', 'Keyed', 'Barcodes', 'Weighted')   #  Loaded lazily - the rest are tiny
+SNAPSHOT_VERSION  = 2
+CHECKPOINT_TYPES  = ('CSV', 'Sequence', 'KeyedSequence', 'Keyed', 'Barcodes')   #  Rewritten by a checkpoint
+CURSOR_TYPES      = ('CSV', 'Keyed')     #  .dat only appended to - progress kept in tmp/<name>.cur
+ORDERS            = ('file', 'shuffled')     #  Orders CSV rows can be handed out in
+
+BUSY_REPLY        = "HTTP/1.1 503 Service Unavailable\r\n" \
+                    "Content-Length: 0\r\n" \
+                    "Retry-After: 1\r\n" \
+                    "Connection: close\r\n\r\n"
+
+ROW_SEPARATOR     = '\n'           #  Between rows in block (GETNB etc) replies
+MAX_DRAWS         = 100000         #  Rows a GETWB may ask for
+MAX_BATCH         = 1000           #  Messages accepted in one POST /batch
+MAX_MESSAGE       = 64 * 1024      #  Longest message allowed for in a batch
+MAX_BATCH_BODY    = MAX_BATCH * MAX_MESSAGE    #  Largest POST /batch body read
+
+
 p_comment         = re.compile('^#')
 p_args            = re.compile(r'([^\?]*)\?(.*)')
 
@@ -120,7 +169,114 @@ barcode_factors   = (8, 6, 4, 2, 3, 5, 9, 7)
 #==========================================================================
 
 class MultiThreadedHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
-    pass
+    request_queue_size = 128           # listen() backlog - vusers all connect at once
+    daemon_threads     = True          # Idle keep-alive connections must not block shutdown
+
+#--------------------------------------------------------------------------
+
+class ThreadPoolMixIn(SocketServer.ThreadingMixIn):
+    """
+    Serve connections from a fixed set of worker threads rather than a
+    new thread for each one.  Accepted connections wait in a bounded
+    queue - when it is full the connection is either refused with a 503
+    ('reject') or the accept loop waits for room ('block') and further
+    clients back up in the listen() backlog.
+
+    A worker holds a keep-alive connection until it is closed, so while
+    connections are waiting the handlers close theirs after the current
+    response (see RequestHandler.end_headers) to give them a turn.
+    """
+
+    numThreads = 16
+    queueSize  = 64
+    overflow   = 'reject'
+
+    def start_pool(self):
+        self.requests  = Queue.Queue(self.queueSize)
+        self.PoolLock  = threading.Lock()
+        self.Busy      = 0
+        self.BusyPeak  = 0
+        self.Accepted  = 0
+        self.Rejected  = 0
+
+        for x in range(self.numThreads):
+            t = threading.Thread(target=self.process_request_thread, name='Worker-%d' % x)
+            t.setDaemon(1)
+            t.start()
+
+    def process_request(self, request, client_address):
+        "Called by the accept loop - queue the connection for a worker"
+
+        with self.PoolLock:
+            self.Accepted += 1
+
+        try:
+            if self.overflow == 'block':    # Wait for room - but not past a SIGTERM
+                while True:
+                    try:
+                        self.requests.put((request, client_address), True, 0.5)
+                        break
+                    except Queue.Full:
+                        if shutdown_flg: raise
+            else:
+                self.requests.put((request, client_address), False)
+        except Queue.Full:
+            with self.PoolLock:
+                self.Rejected += 1
+
+            WARNING('[dshttpd]  Pool busy - refused %s' % client_address[0])
+
+            try:
+                request.sendall(BUSY_REPLY)
+            except socket.error:
+                pass
+
+            self.shutdown_request(request)
+
+    def process_request_thread(self):
+        "Worker - take connections from the queue until the server exits"
+
+        while True:
+            (request, client_address) = self.requests.get()
+
+            with self.PoolLock:
+                self.Busy     += 1
+                self.BusyPeak  = max(self.BusyPeak, self.Busy)
+
+            try:
+                SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+            finally:
+                with self.PoolLock:
+                    self.Busy -= 1
+
+    def waiting(self):
+        return self.requests.qsize()
+
+    def metric_lines(self):
+        with self.PoolLock:
+            (busy, peak, accepted, rejected) = (self.Busy, self.BusyPeak, self.Accepted, self.Rejected)
+
+        return [
+                 '# TYPE dserver_pool_workers gauge',
+                 'dserver_pool_workers %d' % self.numThreads,
+                 '# TYPE dserver_pool_busy gauge',
+                 'dserver_pool_busy %d' % busy,
+                 '# TYPE dserver_pool_busy_peak gauge',
+                 'dserver_pool_busy_peak %d' % peak,
+                 '# TYPE dserver_pool_queued gauge',
+                 'dserver_pool_queued %d' % self.requests.qsize(),
+                 '# TYPE dserver_pool_queue_size gauge',
+                 'dserver_pool_queue_size %d' % self.queueSize,
+                 '# TYPE dserver_pool_connections_total counter',
+                 'dserver_pool_connections_total %d' % accepted,
+                 '# TYPE dserver_pool_rejected_total counter',
+                 'dserver_pool_rejected_total %d' % rejected,
+               ]
+
+#--------------------------------------------------------------------------
+
+class ThreadPoolHTTPServer(ThreadPoolMixIn, HTTPServer):
+    request_queue_size = 128
 
 #==========================================================================
 
@@ -135,25 +291,55 @@ class RequestHandler(BaseHTTPRequestHandler):
     The GET and HEAD requests are identical except that the HEAD
     request omits the actual contents of the file.
 
+    Connections are HTTP/1.1 persistent - every response carries a
+    Content-Length and a connection is closed once it has been idle
+    for IDLE_TIMEOUT seconds (or the client asks for it to be).
+    Responses are buffered and sent with a single write.
+
     """
 
-    server_version = "SimpleHTTP/" + __version__
+    server_version          = "SimpleHTTP/" + __version__
+    protocol_version        = "HTTP/1.1"
+    wbufsize                = -1       # Flushed once per request by handle_one_request()
+    disable_nagle_algorithm = True     # Don't hold back small replies on a kept-alive socket
+    timeout                 = IDLE_TIMEOUT
 
     #-----------------------------------------------------------------------
 
-    def do_GET(self):
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+
         INFO('Host (%s) - Connected at %s' % (self.client_address[0], datetime.now()))
 
+    #-----------------------------------------------------------------------
+
+    def end_headers(self):
+        # Hand a pooled worker back if connections are queued for one
+
+        if (not self.close_connection) and hasattr(self.server, 'waiting') and self.server.waiting() > 0:
+            self.send_header("Connection", "close")
+
+        BaseHTTPRequestHandler.end_headers(self)
+
+    #-----------------------------------------------------------------------
+
+    def log_message(self, format, *args):
+        if debug_level > 0:
+            INFO("[dshttpd]  %s - %s" % (self.client_address[0], format % args))
+
+    #-----------------------------------------------------------------------
+
+    def do_GET(self):
         """Serve a GET request."""
 
         if self.path == '/':  self.path = 'index.html'
 
-        # print "[do_GET]  self.path [%s]" % self.path
-
-        if self.client_address[0] == '10.3.7.214':
-            print ">>>> %s <<<<" % self.path
+        if self.path == '/metrics':
+            self.send_metrics()
             return
 
+        # print "[do_GET]  self.path [%s]" % self.path
+
         m = p_args.search(self.path)
 
         if m:
@@ -175,11 +361,96 @@ class RequestHandler(BaseHTTPRequestHandler):
     #-----------------------------------------------------------------------
 
     def do_HEAD(self):
-        """Serve a HEAD request."""
-        print __doc__
-        f = self.setup_headers()
-        if f:
-            f.close()
+        """Serve a HEAD request - the status page headers, messages are not processed"""
+
+        if p_args.search(self.path):
+            self.send_error(405, "Data server messages must use GET")
+            return
+
+        self.setup_headers(None)
+
+    #-----------------------------------------------------------------------
+
+    def do_POST(self):
+        """Serve a POST /batch - several messages, the replies in one response
+
+        The body is either one message per line (text/plain) or, with a
+        Content-Type of application/json, a JSON list of messages.  The
+        replies come back in the same order and the same form - one per
+        line or a JSON list.  Block replies (GETNB etc) contain newlines
+        so batches using them should be sent as JSON.
+        """
+
+        if self.path.split('?')[0] != '/batch':
+            self.send_error(404, "Only /batch accepts POST")
+            return
+
+        try:
+            length = int(self.headers.getheader('Content-Length'))
+        except (TypeError, ValueError):
+            self.send_error(411, "Content-Length required")
+            return
+
+        if length < 0 or length > MAX_BATCH_BODY:    # Not read - the connection is closed
+            self.send_error(413, "Batch body larger than %d bytes" % MAX_BATCH_BODY)
+            return
+
+        body     = self.rfile.read(length)
+        ctype    = (self.headers.getheader('Content-Type') or '').split(';')[0].strip()
+        json_flg = (ctype == 'application/json')
+
+        try:
+            if json_flg:
+                msgs = json.loads(body, encoding='latin-1')
+
+                if not isinstance(msgs, list): raise ValueError
+
+                for msg in msgs:
+                    if not isinstance(msg, basestring): raise ValueError
+
+                msgs = [msg.encode('latin-1') for msg in msgs]
+            else:
+                msgs = [msg for msg in body.replace('\r', '').split('\n') if msg]
+        except (ValueError, TypeError, UnicodeError):
+            self.send_error(400, "Batch body is not a JSON list of messages")
+            return
+
+        if len(msgs) > MAX_BATCH:
+            self.send_error(413, "More than %d messages in batch" % MAX_BATCH)
+            return
+
+        replies = []
+
+        for msg in msgs:
+            try:
+                replies.append(process(msg))
+            except:
+                ERROR("[dserver::do_POST]  Exception processing batch message '%s'" % msg)
+                replies.append("*ERROR*")
+
+        if json_flg:
+            s = json.dumps(replies, encoding='latin-1')
+        else:
+            s = '\n'.join(replies) + '\n'
+
+        self.send_response(200)
+        self.send_header("Content-type", json_flg and "application/json" or "text/plain")
+        self.send_header("Content-Length", str(len(s)))
+        self.end_headers()
+
+        self.wfile.write(s)
+
+    #-----------------------------------------------------------------------
+
+    def send_metrics(self):
+        s = metrics.text()
+
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(s)))
+        self.end_headers()
+
+        self.wfile.write(s)
 
     #-----------------------------------------------------------------------
 
@@ -208,40 +479,7 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.send_header("Content-Length", str(l))
             self.end_headers()
         else:
-            s  = "<html><head><title>Served Tables</title></head><body>"
-            s += "<hr>\n<table>\n"
-            s += '<tr><td width="100">Name</th><th width="100">Type</th><th width="200">Notes</th></tr>\n'
-
-            idx = 0
-
-            for source in sources:
-                if source.Type == 'Sequence':
-                    s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETN|%d">%s</a></td><td>%s</td><td>Starting value: %d</td></tr>\n' % (
-                           source.Name, idx, source.Name, source.Type, source.Data)
-                elif source.Type == 'Hashed':
-                    keys = source.Data.keys()
-                    s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETH|%d|%s">%s</a></td><td>%s</td><td>Length: %d</td></tr>' % (
-                           source.Name, idx, keys[random.randint(0, len(source.Data)-1)], source.Name, source.Type, len(source.Data))
-                elif source.Type == 'Indexed':
-                    s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETI|%d|%d">%s</a></td><td>%s</td><td>Length: %d</td></tr>' % (
-                           source.Name, idx, random.randint(0, len(source.Data)-1), source.Name, source.Type, len(source.Data))
-                elif source.Type == 'Keyed':
-                    keys = source.Data.keys()
-                    grp  = keys[random.randint(0, len(source.Data)-1)]
-                    l    = len(source.Data[grp].Data)
-                    s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETK|%d|%s">%s</a></td><td>%s</td><td>No groups: %d   Length \'%s\': %d</td></tr>' % (
-                           source.Name, idx, grp, source.Name, source.Type, len(source.Data), grp, l)
-                elif source.Type == 'Indexer':
-                    s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETN|%d">%s</a></td><td>%s</td><td>Data: %d</td></tr>' % (
-                           source.Name, idx, source.Name, source.Type, source.Data)
-                elif source.Type == 'Counter':
-                    s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETN|%d">%s</a></td><td>%s</td><td>Data: %d</td></tr>' % (
-                           source.Name, idx, source.Name, source.Type, source.Data)
-                else:  # CSV
-                    s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETN|%d">%s</a></td><td>%s</td><td>Length: %d</td></tr>' % (
-                           source.Name, idx, source.Name, source.Type, len(source.Data) - source.Idx)
-                idx += 1
-            s += "</table><hr></body></html>\n"
+            s = status_page()
 
             length = len(s)
 
@@ -253,36 +491,25 @@ class RequestHandler(BaseHTTPRequestHandler):
 
 #==========================================================================
 
-class Group:
-    Name     = None
-    Idx      = None
-    Data     = None
-    Comments = None
-
-    def __init__(self, name):
-        self.Name       = name
-        self.Idx        = 0
-        self.Data       = []
-        self.Comments   = []
+class Metrics(dscore.Metrics):
+    "The shared counters plus those of the worker pool"
 
-    def __str__(self):
-        s = "Grp %s  Len %d" % (self.Name, len(self.Data))
-        return s
+    Pool = None                     # ThreadPoolHTTPServer when pooled
 
-    def append_comments(self, s):
-        self.Comments.append(s)
+    def text(self):
+        s = dscore.Metrics.text(self)
 
-    def append_data(self, s):
-        self.Data.append(s)
+        if self.Pool:
+            s += '\n'.join(self.Pool.metric_lines()) + '\n'
 
-    def set_idx(self):
-        if len(self.Data) > 0:
-            self.Idx  = 0
-        else:
-            self.Idx  = -1
+        return s
 
 #--------------------------------------------------------------------------
 
+metrics           = Metrics()
+
+#==========================================================================
+
 class BarcodeGroup(Group):
     Prefix     = 'AA'
     Range      = 99
@@ -298,6 +525,7 @@ class BarcodeGroup(Group):
         self.Range      = int(range)
         self.Country    = country
         self.Serial     = None
+        self.Lock       = threading.Lock()
 
     #-----------------------------------------------------------------------
 
@@ -307,24 +535,51 @@ class BarcodeGroup(Group):
 
     #-----------------------------------------------------------------------
 
+    def next_serial(self):
+        with self.Lock:
+            serial       = self.Serial
+            self.Serial += 1
+
+            return serial
+
+    #-----------------------------------------------------------------------
+
 #--------------------------------------------------------------------------
 
-class Source:
+class Source(Persistence):
     Count    = 0
     Valid    = False
     Name     = None
     Type     = None
     Idx      = None
     Data     = None
+    FileRows = 0                    # Rows of Data that are in the .dat (CSV)
 
-    def __init__(self, name, environment, source_type, attributes={}, delimiter=None):
+    TYPE_HANDLERS = {               # GETN and GETNB handlers for each type
+        'CSV'      : ('get_next_row',   'get_block_rows'),
+        'Sequence' : ('get_next_value', 'get_block_values'),
+        'Indexer'  : ('get_next_value', 'get_block_values'),
+        'Counter'  : ('get_counter',    'get_block_unsupported'),
+    }
+
+    def __init__(self, name, environment, source_type, attributes={}, delimiter=None, lazy=False):
         self.Name        = name
         self.Environment = environment
         self.Type        = source_type
         self.File        = "%s/%s.dat" % (environment, name)
         self.Used        = "%s/tmp/%s.used" % (environment, name)
         self.Stored      = "%s/tmp/%s.stored" % (environment, name)
+        self.Snapshot    = "%s/tmp/%s.snap" % (environment, name)
+        self.Cursor      = "%s/tmp/%s.cur" % (environment, name)
         self.Comments    = []
+        self.Lock        = threading.Lock()     # Guards Idx/Data claims
+        self.Dirty       = False     # Changed since the .dat was last written
+        self.BackedUp    = False     # tmp/<ts>_<name>.bak taken this run
+        self.Compact     = False     # COMPACT asked for - done by the next checkpoint
+        self.Storage     = attributes.get('Storage')   # 'mmap' for CSV/Indexed
+        self.Order       = attributes.get('Order', 'file')   # 'shuffled' for CSV
+        self.Seed        = zlib.crc32(str(attributes.get('Seed', name))) & 0xffffffff
+        self.Shuffle     = None      # Permutation of the .dat rows when Order is shuffled
 
         # sys.stderr.write("Loading %s\n" % self.Name)
         # sys.stderr.flush()
@@ -346,7 +601,117 @@ class Source:
         else:
             self.Delimiter  = ','
 
-        rc = None
+        if attributes.has_key('TagDelimiter'):     # KeyedSequence, Hashed, Barcodes and Weighted
+            self.TagDelimiter  = attributes['TagDelimiter']
+        else:
+            self.TagDelimiter  = ':'
+
+        if self.Type not in SOURCE_TYPES:
+            print "[dserver]  Bad source type [%s]" % source_type
+            sys.exit(1)
+
+        if (self.Order not in ORDERS) or (self.Order != 'file' and self.Type != "CSV"):
+            print "[dserver]  Bad order [%s] for %s" % (self.Order, name)
+            sys.exit(1)
+
+        self.Options     = attributes
+        self.Lazy        = lazy and (self.Type in DEFERRED_TYPES)
+        self.Failed      = False
+        self.LoadLock    = threading.Lock()     # Held while the .dat is read in
+        self.Size        = None
+        self.Attributes  = {
+                               'Type'       : self.Type,
+                               'Delimiter'  : self.Delimiter,
+                               'Size'       : self.Size
+                           }
+
+        try:
+            self.ufh = Journal(self.Used)
+        except IOError, e:
+            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
+            sys.exit(1)
+
+        try:
+            self.sfh = Journal(self.Stored)
+        except IOError, e:
+            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
+            sys.exit(1)
+
+        if not self.Lazy:
+            self.load()
+        elif not os.path.exists(self.File):
+            sys.stderr.write('[dserver]  No data file: %s\n' % self.File)
+            sys.exit(1)
+
+    #-----------------------------------------------------------------------
+
+    def load(self, state=None):
+        """
+        Read the .dat file in (once) - False if a deferred load failed.
+        state is (rc, export()) from a loader process that has already
+        read it in (see load_parallel()).
+        """
+
+        if self.Valid:
+            return True
+
+        with self.LoadLock:
+            if self.Valid or self.Failed:
+                return self.Valid
+
+            t_start = time.time()
+
+            if state == None and snapshot_flg:
+                state = self.read_snapshot()
+
+            try:
+                if state != None:
+                    (rc, exported) = state
+                    self.adopt(exported)
+                else:
+                    rc = self.read_in()
+            except SystemExit:             # init_* exit on a bad .dat
+                if not self.Lazy: raise
+                rc = None
+
+            if not rc:
+                if not self.Lazy:
+                    print "[dserver]  Bad source type [%s]" % self.Type
+                    sys.exit(1)
+
+                ERROR("[dshttpd]  Deferred load of %s failed" % self.Name)
+                self.Failed = True
+                return False
+
+            if self.Order == 'shuffled':
+                self.Shuffle = Permutation(self.FileRows, self.Seed)
+
+            if self.Type in CURSOR_TYPES:
+                self.restore_cursor()
+
+            self.bind_handlers()
+
+            self.Size        = rc
+            self.Attributes  = {
+                                   'Type'       : self.Type,
+                                   'Delimiter'  : self.Delimiter,
+                                   'Size'       : rc
+                               }
+
+            self.Valid       = True        # Last - get_source() only checks Valid
+
+            if self.Lazy:
+                INFO("Loaded %s in %.3fs" % (str(self), time.time() - t_start))
+
+        return True
+
+    #-----------------------------------------------------------------------
+
+    def read_in(self):
+        "Type specific read of the .dat file - the size if it worked"
+
+        attributes = self.Options
+        rc         = None
 
         if self.Type == "CSV":
             rc = self.init_csv()
@@ -355,17 +720,9 @@ class Source:
             rc = self.init_sequence()
 
         elif self.Type == "KeyedSequence":
-            if attributes.has_key('TagDelimiter'):
-                self.TagDelimiter  = attributes['TagDelimiter']
-            else:
-                self.TagDelimiter  = ':'
             rc = self.init_keyed_sequence()
 
         elif self.Type == "Hashed":
-            if attributes.has_key('TagDelimiter'):
-                self.TagDelimiter  = attributes['TagDelimiter']
-            else:
-                self.TagDelimiter  = ':'
             rc = self.init_hashed()
 
         elif self.Type == "Indexed":
@@ -374,6 +731,9 @@ class Source:
         elif self.Type == "Keyed":
             rc = self.init_keyed()
 
+        elif self.Type == "Weighted":
+            rc = self.init_weighted()
+
         elif self.Type == "Indexer":
             if attributes.has_key('start'):
                 self.Data = attributes['start']
@@ -385,36 +745,67 @@ class Source:
             rc = self.init_counter()
 
         elif self.Type == "Barcodes":
-            if attributes.has_key('TagDelimiter'):
-                self.TagDelimiter  = attributes['TagDelimiter']
-            else:
-                self.TagDelimiter  = ':'
             rc = self.init_barcodes()
 
-        if rc:
-            self.Valid = True
+        return rc
+
+    #-----------------------------------------------------------------------
+
+    def export(self):
+        """
+        The rows as read from the .dat, as plain lists and dicts that
+        marshal can send.  How far they have been handed out is kept in
+        the cursor file - except for Keyed groups, which no longer hold
+        the rows they have handed out (see snapshot_key()).
+        """
+
+        idx = self.Idx
+
+        if self.Type == "Keyed":
+            data = {}
+
+            for (name, group) in self.Data.items():    # Rows still to be handed out
+                rows = itertools.islice(group.Data, 0, group.FileRows - group.Idx)
+
+                data[name] = (list(rows), group.Comments, group.Idx)
+
+        elif self.Type == "CSV":
+            data = self.Data[:self.FileRows]
+
+            if len(data) > 0:
+                idx = 0
+            else:
+                idx = None
+        elif self.Type == "Weighted":
+            data = (self.Data, self.Prob.tolist(), self.Alias.tolist())
         else:
-            print "[dserver]  Bad source type [%s]" % source_type
-            sys.exit(1)
+            data = self.Data
 
-        self.Size        = rc
-        self.Attributes  = {
-                               'Type'       : self.Type,
-                               'Delimiter'  : self.Delimiter,
-                               'Size'       : rc
-                           }
+        return {
+                    'Data'     : data,
+                    'Idx'      : idx,
+                    'Comments' : self.Comments,
+                }
 
-        try:
-            self.ufh = open(self.Used, 'a+')
-        except IOError, e:
-            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-            sys.exit(1)
+    #-----------------------------------------------------------------------
 
-        try:
-            self.sfh = open(self.Stored, 'a+')
-        except IOError, e:
-            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-            sys.exit(1)
+    def snapshot_key(self):
+        "What a snapshot must have been taken against to be used"
+
+        st  = os.stat(self.File)
+        key = (SNAPSHOT_VERSION, self.Type, self.TagDelimiter, st.st_size, st.st_mtime)
+
+        if self.Type == "Keyed":         # Handed out rows are not in it - nor can the cursor have moved
+            try:
+                f = open(self.Cursor, 'rb')
+                try:
+                    key += (zlib.crc32(f.read()) & 0xffffffff,)
+                finally:
+                    f.close()
+            except IOError:
+                key += (None,)
+
+        return key
 
     #-----------------------------------------------------------------------
 
@@ -425,6 +816,9 @@ class Source:
             s += " * "
             if self.Type == "CSV":
                 s += " %9d rows" % len(self.Data)
+
+                if self.Shuffle:
+                    s += " (shuffled)"
             elif self.Type == "Sequence":
                 s += " Starting value:  %d" % self.Data
             elif self.Type == "KeyedSequence":
@@ -435,12 +829,16 @@ class Source:
                 s += " %9d rows"   % len(self.Data)
             elif self.Type == "Keyed":
                 s += " %9d groups" % len(self.Data)
+            elif self.Type == "Weighted":
+                s += " %9d rows"   % len(self.Data)
             elif self.Type == "Indexer":
                 s += " Starting value:  %d" % self.Data
             elif self.Type == "Counter":
                 s += " Value:  %d" % self.Data
             elif self.Type == "Barcodes":
                 s += " %9d groups" % len(self.Data)
+        elif self.Lazy and not self.Failed:
+            s += "    (loads on first use)"
         else:
             s += "   "
 
@@ -448,81 +846,261 @@ class Source:
 
     #-----------------------------------------------------------------------
 
-    def init_csv(self):
-        try:
-            f = open(self.File, 'r')
-        except IOError, e:
-            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-            sys.exit(1)
+    def bind_handlers(self):
+        "Bind the type specific GETN/GETNB handlers - saves testing Type per request"
 
-        self.Data = []
+        (get_next, get_block) = self.TYPE_HANDLERS.get(self.Type,
+                                     ('get_next_unsupported', 'get_block_unsupported'))
 
-        while True:
-            line = f.readline()
+        self.get_next  = getattr(self, get_next)
+        self.get_block = getattr(self, get_block)
 
-            if not line: break
+    #-----------------------------------------------------------------------
 
-            line = line.strip()
+    def get_next_row(self):
+        rows = self.claim()
 
-            if p_comment.match(line):
-                self.Comments.append(line)
-                continue
+        if rows:
+            return rows[0]
+        else:
+            return "*Exhausted*"
 
-            self.Data.append(line)
+    def get_next_value(self):
+        return "%d" % self.next_value()
 
-        f.close()
+    def get_counter(self):
+        return "%d" % self.Data
 
-        if len(self.Data) > 0:
-            self.Idx = 0
+    def get_next_unsupported(self):
+        return "UNKNOWN"
+
+    #-----------------------------------------------------------------------
+
+    def get_block_rows(self, n):
+        "Returns (reply, rows) for a GETNB of up to n rows"
+
+        rows = self.claim(n)
+
+        if rows:
+            return (ROW_SEPARATOR.join(rows), rows)
         else:
-            self.Idx = None
+            return ("*Exhausted*", rows)
 
-        if debug_level > 2:
-            INFO("Read in %d CSV rows - %s" % (len(self.Data), self.Name))
-            if verbose_flg:  print "Read in %d CSV rows - %s" % (len(self.Data), self.Name)
+    def get_block_values(self, n):
+        start = self.next_value(n)
+        rows  = ["%d" % i for i in xrange(start, start + n)]
 
-        #return len(self.Data)
-        return True
+        return (ROW_SEPARATOR.join(rows), rows)
 
-    #-----------------------------------------------------------------------
+    def get_block_unsupported(self, n):
+        return ("UNKNOWN", [])
 
-    def init_sequence(self):
-        try:
-            f = open(self.File, 'r')
-        except IOError, e:
-            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-            sys.exit(1)
+    #-----------------------------------------------------------------------
 
-        while True:
-            line = f.readline()
+    def sample_key(self):
+        "Any one key (or group) of a Hashed or Keyed source - None if it is empty"
 
-            if not line: break
+        for key in self.Data:
+            return key
 
-            line = line.strip()
+        return None
 
-            if p_comment.match(line):
-                self.Comments.append(line)
-                continue
+    #-----------------------------------------------------------------------
 
-            elif (len(line) == 0):
-                continue
+    def group_sizes(self):
+        "(group, rows, bytes) for each group of a Keyed source, largest first"
 
-            try:
-                no = int(line)
-            except:
-                no = 0
+        with self.Lock:                     # group() may be adding one
+            groups = list(self.Data.values())
 
-            self.Data = no
+        sizes = [(g.Name, len(g.Data), g.Bytes) for g in groups]
 
-        f.close()
+        sizes.sort(key=lambda size: size[1], reverse=True)
 
-        return True
+        return sizes
 
     #-----------------------------------------------------------------------
 
-    def init_keyed_sequence(self):
-        try:
-            f = open(self.File, 'r')
+    def remaining(self):
+        "Unclaimed rows for CSV and Keyed sources - None for other types"
+
+        if not self.Valid:
+            return None
+        elif self.Type == "CSV":
+            return len(self.Data) - max(self.Idx or 0, 0)
+        elif self.Type == "Keyed":
+            with self.Lock:
+                groups = list(self.Data.values())
+
+            return sum([len(g.Data) for g in groups])
+        else:
+            return None
+
+    #-----------------------------------------------------------------------
+
+    def claim(self, n=1):
+        "Atomically claim up to n unconsumed CSV rows - returns a (possibly empty) list"
+
+        with self.Lock:
+            if self.Idx == None:
+                return []
+
+            start      = self.Idx
+            self.Idx   = min(start + n, len(self.Data))
+            self.Dirty = True
+
+            if self.Shuffle and start < self.Shuffle.Size:
+                return [self.Data[self.Shuffle[i]] for i in xrange(start, self.Idx)]
+
+            return self.Data[start:self.Idx]
+
+    #-----------------------------------------------------------------------
+
+    def draw(self, n=1):
+        "n rows of a Weighted source, each picked at random in proportion to its weight"
+
+        data  = self.Data
+        prob  = self.Prob
+        alias = self.Alias
+        size  = len(data)
+        rows  = []
+
+        for i in xrange(n):
+            u      = random.random() * size
+            column = int(u)
+
+            if (u - column) >= prob[column]:
+                column = alias[column]
+
+            rows.append(data[column])
+
+        return rows
+
+    #-----------------------------------------------------------------------
+
+    def next_value(self, n=1):
+        "Atomically advance a Sequence/Indexer by n - returns the first value"
+
+        with self.Lock:
+            value      = self.Data
+            self.Data += n
+            self.Dirty = True
+
+            return value
+
+    #-----------------------------------------------------------------------
+
+    def next_keyed_value(self, key):
+        "Atomically advance a KeyedSequence - returns None for an unknown key"
+
+        with self.Lock:
+            value = self.Data.get(key)
+
+            if value != None:
+                self.Data[key] = value + 1
+                self.Dirty     = True
+
+            return value
+
+    #-----------------------------------------------------------------------
+
+    def store(self, data):
+        "Append a row to a CSV source"
+
+        with self.Lock:
+            self.Data.append(data)
+
+            self.Dirty = True
+
+            if self.Idx == None:
+                self.Idx = 0
+
+    #-----------------------------------------------------------------------
+
+    def give_back(self, row):
+        "A leased row comes back - handed out again after the rows still to come"
+
+        self.store(row)              # Never logged as used, so not logged as stored
+
+    #-----------------------------------------------------------------------
+
+    def group(self, name):
+        "Return the named Keyed group - creating it if need be"
+
+        g = self.Data.get(name)
+
+        if g == None:
+            with self.Lock:
+                g = self.Data.get(name)
+
+                if g == None:              # Add a new group!
+                    g               = Group(name)
+                    self.Data[name] = g
+                    self.Dirty      = True
+
+        return g
+
+    #-----------------------------------------------------------------------
+
+    def init_csv(self):
+        if self.Storage == 'mmap':
+            self.Data = self.map_rows()
+        else:
+            self.Data = self.read_rows()
+
+        if len(self.Data) > 0:
+            self.Idx = 0
+        else:
+            self.Idx = None
+
+        self.FileRows = len(self.Data)
+
+        if debug_level > 2:
+            INFO("Read in %d CSV rows - %s" % (len(self.Data), self.Name))
+            if verbose_flg:  print "Read in %d CSV rows - %s" % (len(self.Data), self.Name)
+
+        #return len(self.Data)
+        return True
+
+    #-----------------------------------------------------------------------
+
+    def init_sequence(self):
+        try:
+            f = open(self.File, 'r')
+        except IOError, e:
+            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
+            sys.exit(1)
+
+        while True:
+            line = f.readline()
+
+            if not line: break
+
+            line = line.strip()
+
+            if p_comment.match(line):
+                self.Comments.append(line)
+                continue
+
+            elif (len(line) == 0):
+                continue
+
+            try:
+                no = int(line)
+            except:
+                no = 0
+
+            self.Data = no
+
+        f.close()
+
+        return True
+
+    #-----------------------------------------------------------------------
+
+    def init_keyed_sequence(self):
+        try:
+            f = open(self.File, 'r')
         except IOError, e:
             sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
             sys.exit(1)
@@ -584,7 +1162,7 @@ class Source:
 
             if (line.find("[") != -1):
                 group_name            = line.replace('[','').replace(']','')
-                group                 = Group(group_name)
+                group                 = self.Data.get(group_name) or Group(group_name)
                 self.Data[group_name] = group
                 continue
 
@@ -602,6 +1180,9 @@ class Source:
 
         f.close()
 
+        for group in self.Data.values():
+            group.set_idx()
+
         if debug_level > 2:
             INFO("Read in %d Keyed groups - %s" % (len(self.Data), self.Name))
             if verbose_flg:  print "Read in %d Keyed groups - %s" % (len(self.Data), self.Name)
@@ -643,14 +1224,22 @@ class Source:
         f.close()
 
         if debug_level > 2:
-        	  INFO("Read in %d hashed rows - %s" % (len(self.Data), self.Name))
-             if verbose_flg:  print "Read in %d hashed rows - %s" % (len(self.Data), self.Name)
+            INFO("Read in %d hashed rows - %s" % (len(self.Data), self.Name))
+            if verbose_flg:  print "Read in %d hashed rows - %s" % (len(self.Data), self.Name)
 
         return True
 
     #-----------------------------------------------------------------------
 
     def init_indexed(self):
+        if self.Storage == 'mmap':
+            self.Data = self.map_rows(skip_blank=True)
+
+            if debug_level > 2:
+                INFO("Mapped %d indexed rows - %s" % (len(self.Data), self.Name))
+
+            return True
+
         try:
             f = open(self.File, 'r')
         except IOError, e:
@@ -693,6 +1282,60 @@ class Source:
 
     #-----------------------------------------------------------------------
 
+    def init_weighted(self):
+        try:
+            f = open(self.File, 'r')
+        except IOError, e:
+            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
+            sys.exit(1)
+
+        self.Data = []
+        weights   = []
+
+        while True:
+            line = f.readline()
+
+            if not line: break
+
+            line = line.strip()
+
+            if p_comment.match(line):
+                self.Comments.append(line)
+                continue
+
+            elif (len(line) == 0):
+                continue
+
+            try:
+                (weight, data) = line.split(self.TagDelimiter, 1)
+
+                weight = float(weight)
+            except ValueError:
+                weight = None
+
+            if not (0.0 <= weight < float('inf')):
+                sys.stderr.write('[dserver]  Bad weight in %s: %s\n' % (self.File, line))
+                sys.exit(1)
+
+            weights.append(weight)
+            self.Data.append(data)
+
+        f.close()
+
+        if self.Data and not (sum(weights) > 0.0):
+            sys.stderr.write('[dserver]  No row in %s has a weight\n' % self.File)
+            sys.exit(1)
+
+        (self.Prob, self.Alias) = alias_table(weights)
+
+        if debug_level > 2:
+            INFO("Read in %d weighted rows - %s" % (len(self.Data), self.Name))
+            if verbose_flg:  print "Read in %d weighted rows - %s" % (len(self.Data), self.Name)
+
+        return True
+
+    #-----------------------------------------------------------------------
+
     def init_counter(self):
         try:
             f = open(self.File, 'r')
@@ -774,135 +1417,64 @@ class Source:
 
     #-----------------------------------------------------------------------
 
-    def flush(self):
+    def flush(self, final=True):
+        "Write the source back to its .dat - at shutdown (final) or as a checkpoint"
+
         if not self.Valid:
             return
 
-        ts = datetime.now().strftime('%Y%m%d%H%M%S')
+        if final:
+            print "Flushing %s" % self.Name
 
-        self.BackupCmd  = "cp %s/%s.dat %s/tmp/%s_%s.bak" % (self.Environment, self.Name, self.Environment, ts, self.Name)
+        self.Dirty = False               # Changes from here on are caught next time
 
-        print "Flushing %s" % self.Name
+        rc = None
 
         if self.Type == "CSV":
-            self.flush_csv()
+            rc = self.flush_csv()
         elif self.Type == "Sequence":
-            self.flush_sequence()
+            rc = self.flush_sequence()
         elif self.Type == "KeyedSequence":
-            self.flush_keyed_sequence()
+            rc = self.flush_keyed_sequence()
         elif self.Type == "Keyed":
-            self.flush_keyed()
+            rc = self.flush_keyed()
         elif self.Type == "Hashed":
-            self.flush_hashed()
+            rc = self.flush_hashed()
         elif self.Type == "Indexed":
-            self.flush_indexed()
+            rc = self.flush_indexed()
         elif self.Type == "Indexer":
             pass  # Do nothing
-        elif self.Type == "Counter":
-            self.flush_counter()
+        elif self.Type == "Counter" and final:   # Bump RunNo once per run
+            rc = self.flush_counter()
         elif self.Type == "Barcodes":
-            self.flush_barcodes()
-
-    #-----------------------------------------------------------------------
-
-    def flush_csv(self):
-        os.system(self.BackupCmd)
-
-        try:
-            f = open(self.File, 'wb')
-        except IOError, e:
-            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-            return 0
-
-        for line in  self.Comments:
-            f.write("%s\n" % line)
+            rc = self.flush_barcodes()
 
-        l = len(self.Data)
+        if rc == 0:
+            self.Dirty = True             # Try again at the next checkpoint
 
-        if l > 0:
-            i = self.Idx
-            while i < len(self.Data):
-                f.write("%s\n" % self.Data[i])
-                i += 1
-
-        f.close()
+        if final and snapshot_flg and rc != 0:   # 0 - the flush failed
+            self.write_snapshot()
 
     #-----------------------------------------------------------------------
 
     def flush_sequence(self):
-        os.system(self.BackupCmd)
-
-        try:
-            f = open(self.File, 'wb')
-        except IOError, e:
-            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-            return 0
+        value = self.Data
 
-        for line in  self.Comments:
-            f.write("%s\n" % line)
-
-        f.write("%d\n" % self.Data)
-
-        f.close()
+        return self.rewrite(self.Comments + ["%d" % value])
 
     #-----------------------------------------------------------------------
 
     def flush_keyed_sequence(self):
-        os.system(self.BackupCmd)
-
-        try:
-            f = open(self.File, 'wb')
-        except IOError, e:
-            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-            return 0
-
-        group_keys = self.Data.keys()
+        with self.Lock:
+            data = self.Data.copy()
 
-        group_keys.sort()
-
-        for line in  self.Comments:
-            f.write("%s\n" % line)
-
-        for key in group_keys:
-            f.write("%s%s%s\n" % (key, self.TagDelimiter, self.Data[key]))
-
-        f.close()
-
-    #-----------------------------------------------------------------------
-
-    def flush_keyed(self):
-        os.system(self.BackupCmd)
-
-        try:
-            f = open(self.File, 'wb')
-        except IOError, e:
-            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-            return 0
-
-        group_keys = self.Data.keys()
+        group_keys = data.keys()
 
         group_keys.sort()
 
-        for line in  self.Comments:
-            f.write("%s\n" % line)
-
-        for key in group_keys:
-            f.write("[%s]\n" % key)
-
-            group = self.Data[key]
-
-            for line in  group.Comments:
-                f.write("%s\n" % line)
+        lines = ["%s%s%s" % (key, self.TagDelimiter, data[key]) for key in group_keys]
 
-            i = group.Idx
-
-            while i < len(group.Data):
-                f.write("%s\n" % group.Data[i])
-                i += 1
-
-            f.write("\n")
-
-        f.close()
+        return self.rewrite(self.Comments + lines)
 
     #-----------------------------------------------------------------------
 
@@ -917,45 +1489,20 @@ class Source:
     #-----------------------------------------------------------------------
 
     def flush_counter(self):
-        os.system(self.BackupCmd)
-
-        try:
-            f = open(self.File, 'wb')
-        except IOError, e:
-            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-            return 0
-
-        for line in  self.Comments:
-            f.write("%s\n" % line)
-
         counter = self.Data + 1
 
-        f.write("%d\n" % counter)
-
-        f.close()
+        return self.rewrite(self.Comments + ["%d" % counter])
 
     #-----------------------------------------------------------------------
 
     def flush_barcodes(self):
-        os.system(self.BackupCmd)
-
-        try:
-            f = open(self.File, 'wb')
-        except IOError, e:
-            sys.stderr.write('[dserver]  Open failed: %s\n' % str(e))
-            return 0
-
         keys = self.Data.keys()
 
         keys.sort()
 
-        for line in  self.Comments:
-            f.write("%s\n" % line)
-
-        for key in keys:
-            f.write("%s%s%d\n" % (key, self.TagDelimiter, self.Data[key].Serial))
+        lines = ["%s%s%d" % (key, self.TagDelimiter, self.Data[key].Serial) for key in keys]
 
-        f.close()
+        return self.rewrite(self.Comments + lines)
 
 #==========================================================================
 
@@ -979,6 +1526,10 @@ def WARNING(msg):
 
 def read_config():
     global PORT, ENVIRONMENT
+    global pool_workers, pool_queue, pool_overflow
+    global status_interval
+    global load_mode, loaders
+    global snapshot_flg, checkpoint_interval, lease_ttl
 
     config_file = CONFIGFILE
 
@@ -1017,6 +1568,68 @@ def read_config():
 
              ENVIRONMENT = definition[1].strip()
 
+        elif (line.find("IdleTimeout=") != -1):
+             definition  = line.split("=")
+
+             RequestHandler.timeout = int(definition[1].strip())
+
+        elif (line.find("Checkpoint=") != -1):
+             definition  = line.split("=")
+
+             checkpoint_interval = max(float(definition[1].strip()), 0)
+
+        elif (line.find("LeaseTTL=") != -1):
+             definition  = line.split("=")
+
+             lease_ttl = float(definition[1].strip())
+
+        elif (line.find("Snapshot=") != -1):
+             definition  = line.split("=")
+
+             snapshot_flg = definition[1].strip().lower() in ('on', 'yes', 'true', '1')
+
+        elif (line.find("Loaders=") != -1):
+             definition  = line.split("=")
+
+             loaders = max(int(definition[1].strip()), 1)
+
+        elif (line.find("Load=") != -1):
+             definition  = line.split("=")
+
+             if definition[1].strip() in LOAD_MODES:
+                 load_mode = definition[1].strip()
+             else:
+                 WARNING("[dshttpd::read_config]  Bad load mode '%s' - using %s" % (definition[1], load_mode))
+
+        elif (line.find("StatusInterval=") != -1):
+             definition  = line.split("=")
+
+             status_interval = float(definition[1].strip())
+
+        elif (line.find("Workers=") != -1):
+             definition  = line.split("=")
+
+             pool_workers = int(definition[1].strip())
+
+        elif (line.find("WorkerQueue=") != -1):
+             definition  = line.split("=")
+
+             pool_queue = int(definition[1].strip())
+
+        elif (line.find("Overflow=") != -1):
+             definition  = line.split("=")
+
+             if definition[1].strip() in POOL_OVERFLOWS:
+                 pool_overflow = definition[1].strip()
+             else:
+                 WARNING("[dshttpd::read_config]  Bad overflow '%s' - using %s" % (definition[1], pool_overflow))
+
+        elif (line.find("Journal=") != -1):
+             definition  = line.split("=")
+
+             if not set_journal_policy(definition[1]):
+                 WARNING("[dshttpd::read_config]  Bad journal policy '%s' - using %s" % (definition[1], dscore.journal_policy))
+
         elif (line.find("[Data]") != -1):
             definition_flg = True
 
@@ -1030,387 +1643,799 @@ def read_config():
              except:
                  attributes = {}
 
-             source = Source(name, ENVIRONMENT, source_type, attributes)
+             source = Source(name, ENVIRONMENT, source_type, attributes,
+                             lazy=(load_mode != 'eager') or (loaders > 1))
 
+             source_index[name] = len(sources)
              sources.append(source)
 
+             if source.Lazy and load_mode == 'eager':
+                 continue                   # Reported by load_parallel()
+
              INFO(str(source))
 
-             print "Loaded %s" % str(source)
+             print "%s %s" % (source.Lazy and "Deferred" or "Loaded", str(source))
+
+    if load_mode == 'eager':
+        if loaders > 1:
+            load_parallel()
 
-    print "\nData Loaded...\n"
+        print "\nData Loaded...\n"
+    else:
+        print "\nData Deferred (%s)...\n" % load_mode
 
     f.close()
 
 #--------------------------------------------------------------------------
 
-def get_source_index(name):
-    for i in range(len(sources)):
-        if (sources[i].Name == name):
-            return i
-
-    return -1
+def render_status():
+    "The status page - one table row per source, O(1) work for each but Keyed (O(groups))"
+
+    s  = "<html><head><title>Served Tables</title></head><body>"
+    s += "<hr>\n<table>\n"
+    s += '<tr><td width="100">Name</th><th width="100">Type</th><th width="200">Notes</th></tr>\n'
+
+    idx  = 0
+    held = leases.counts()[0]
+
+    for source in sources:
+        if not source.Valid:
+            s += '<tr><td>%s</td><td>%s</td><td>Not loaded yet</td></tr>\n' % (source.Name, source.Type)
+        elif source.Type == 'Sequence':
+            s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETN|%d">%s</a></td><td>%s</td><td>Starting value: %d</td></tr>\n' % (
+                   source.Name, idx, source.Name, source.Type, source.Data)
+        elif source.Type == 'Hashed':
+            s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETH|%d|%s">%s</a></td><td>%s</td><td>Length: %d</td></tr>' % (
+                   source.Name, idx, source.sample_key(), source.Name, source.Type, len(source.Data))
+        elif source.Type == 'Indexed':
+            s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETI|%d|%d">%s</a></td><td>%s</td><td>Length: %d</td></tr>' % (
+                   source.Name, idx, random.randint(0, max(len(source.Data)-1, 0)), source.Name, source.Type, len(source.Data))
+        elif source.Type == 'Keyed':
+            sizes = source.group_sizes()
+            (grp, l, size) = (sizes or [(None, 0, 0)])[0]      # The largest group
+            s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETK|%d|%s">%s</a></td><td>%s</td><td>No groups: %d   Rows: %d   Bytes: %d   Largest \'%s\': %d</td></tr>' % (
+                   source.Name, idx, grp, source.Name, source.Type, len(sizes),
+                   sum([rows for (g, rows, b) in sizes]), sum([b for (g, rows, b) in sizes]), grp, l)
+        elif source.Type == 'Weighted':
+            s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETW|%d">%s</a></td><td>%s</td><td>Rows: %d</td></tr>' % (
+                   source.Name, idx, source.Name, source.Type, len(source.Data))
+        elif source.Type == 'Indexer':
+            s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETN|%d">%s</a></td><td>%s</td><td>Data: %d</td></tr>' % (
+                   source.Name, idx, source.Name, source.Type, source.Data)
+        elif source.Type == 'Counter':
+            s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETN|%d">%s</a></td><td>%s</td><td>Data: %d</td></tr>' % (
+                   source.Name, idx, source.Name, source.Type, source.Data)
+        else:  # CSV
+            length = source.remaining()
+            if length == None: length = len(source.Data)
+            s += '<tr><td><a href="?table=%s&action=GetNext&msg=GETN|%d">%s</a></td><td>%s</td><td>Length: %d   Leased: %d</td></tr>' % (
+                   source.Name, idx, source.Name, source.Type, length, held.get(source.Name, 0))
+        idx += 1
+    s += "</table><hr>\n"
+
+    rss = resident_bytes()
+
+    if rss != None:
+        s += "Resident memory: %.1f MB<hr>\n" % (rss / 1048576.0)
+
+    s += "</body></html>\n"
+
+    return s
 
 #--------------------------------------------------------------------------
 
-def process(s):
-    global client_language
+def status_page():
+    """
+    The status page as of at most status_interval seconds ago.  Only one
+    thread re-renders an expired page - the others serve the old one
+    meanwhile rather than queueing behind it.
+    """
 
-    msg = s.split("|")
-    l   = len(msg)
+    global status_cache
 
-    if debug_level > 1:  INFO("[dserver::process]  len %d  msg %s" % (l, msg))
+    (rendered, page) = status_cache
 
-    ts    = datetime.now().strftime('%Y%m%d%H%M%S')
-    reply = "None"
+    if (page == None) or (time.time() - rendered >= status_interval):
+        if status_lock.acquire(page == None):
+            try:
+                (rendered, page) = status_cache     # Another thread may have just rendered it
 
-    if (msg[0] == "INIT"):
-        client_language = msg[1]
+                if (page == None) or (time.time() - rendered >= status_interval):
+                    status_cache = (time.time(), render_status())
+            finally:
+                status_lock.release()
 
-        if client_language == 'Python':
-            reply = "%s" % marshal.dumps(attributes)
-        else:  # client_language == 'C'
-            reply = "0"
+            (rendered, page) = status_cache
 
-    elif (msg[0] == "REG"):
-        name = msg[1].replace('\n','').replace('\r','')
-        idx  = get_source_index(name)
-        if debug_level > 0:  INFO("[dserver::process]  REG '%s' -> %d" % (name, idx))
+    return page
 
-        if client_language == 'Python':
-            reply = "%d|%s" % (idx, marshal.dumps(sources[idx].Attributes))
-        else:  # client_language == 'C'
-            reply = "%d" % idx
+#--------------------------------------------------------------------------
 
-    elif (msg[0] == "REGK"):
-        if (len(msg) != 3):
-            ERROR("[dserver::process]  REGK -> Bad Message '%s'" % str(msg))
-            reply = "*BAD*MESSAGE*"
-        else:
-            reply = "*OK*"
+def get_source_index(name):
+    return source_index.get(name, -1)
+
+#--------------------------------------------------------------------------
+
+def timestamp():
+    "Audit log timestamp - only formatted once a second"
+
+    global ts_cache
+
+    now = int(time.time())
+
+    (second, ts) = ts_cache
+
+    if now != second:
+        ts       = datetime.fromtimestamp(now).strftime('%Y%m%d%H%M%S')
+        ts_cache = (now, ts)
+
+    return ts
+
+#--------------------------------------------------------------------------
+
+def process(s):
+    msg = s.split("|")
+
+    if debug_level > 1:  INFO("[dserver::process]  len %d  msg %s" % (len(msg), msg))
+
+    handler = HANDLERS.get(msg[0])
+
+    if handler == None:
+        return "None"
+
+    t_start = time.time()
 
-    elif (msg[0] == "REGI"):
-        if (len(msg) != 2):
-            ERROR("[dserver::process]  REGI -> Bad Message '%s'" % str(msg))
-            reply = "*BAD*MESSAGE*"
+    reply = handler(msg)
+
+    metrics.record(msg, reply, time.time() - t_start)
+
+    return reply
+
+#--------------------------------------------------------------------------
+
+def do_init(msg):
+    global client_language
+
+    client_language = msg[1]
+
+    if client_language == 'Python':
+        return "%s" % marshal.dumps(attributes)
+    else:  # client_language == 'C'
+        return "0"
+
+#--------------------------------------------------------------------------
+
+def do_reg(msg):
+    name = msg[1].replace('\n','').replace('\r','')
+    idx  = get_source_index(name)
+    if debug_level > 0:  INFO("[dserver::process]  REG '%s' -> %d" % (name, idx))
+
+    if client_language == 'Python':
+        if idx >= 0 and sources[idx].load():
+            source_attributes = sources[idx].Attributes
         else:
-            reply = "*OK*"
+            source_attributes = {}
+        return "%d|%s" % (idx, marshal.dumps(source_attributes))
+    else:  # client_language == 'C'
+        return "%d" % idx
 
-    elif (msg[0] == "GETN"):
-        if (len(msg) == 2):
-            hdl  = int(msg[1])
+#--------------------------------------------------------------------------
 
-            try:
-                source = sources[hdl]
-            except:
-                source = None
+def do_regk(msg):
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  REGK -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
 
-            if source != None:
-                if source.Type == 'CSV':
-                    if ((source.Idx != None) and (source.Idx < len(source.Data))):
-                        reply  = source.Data[source.Idx]
-                        source.Idx += 1
-                    else:
-                        reply = "*Exhausted*"
-                elif source.Type in ["Sequence", "Indexer"]:
-                    reply = "%d" % source.Data
-                    source.Data += 1
-                elif source.Type == "Counter":
-                    reply = "%d" % source.Data
-                else:
-                    reply = "UNKNOWN"
-            else:
-                reply = "*BAD*HANDLE*"
+    return "*OK*"
 
-            source.ufh.write("%s - %s\n" % (ts, reply))
-            source.ufh.flush()
+#--------------------------------------------------------------------------
+
+def do_regi(msg):
+    if (len(msg) != 2):
+        ERROR("[dserver::process]  REGI -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    return "*OK*"
+
+#--------------------------------------------------------------------------
+
+def do_getn(msg):
+    if (len(msg) != 2):
+        ERROR("[dserver::process]  GETN -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source = get_source(msg[1])
+
+    if source != None:
+        reply = source.get_next()
+
+        source.ufh.write("%s - %s\n" % (timestamp(), reply))
+    else:
+        reply = "*BAD*HANDLE*"
+
+    if debug_level > 2:  INFO("[dserver::process]  GETN -> %s" % reply)
+
+    return reply
+
+#--------------------------------------------------------------------------
+
+def do_getks(msg):
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  GETKS -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source = get_source(msg[1])
+    key    = msg[2]
+
+    if source != None:
+        value = source.next_keyed_value(key)
+
+        if value != None:
+            reply = "%d" % value
         else:
-            ERROR("[dserver::process]  GETN -> Bad Message '%s'" % str(msg))
-            reply = "*BAD*MESSAGE*"
+            reply = "*NO*VALID*KEY*"
 
-        if debug_level > 2:  INFO("[dserver::process]  GETN -> %s" % reply)
+        source.ufh.write("%s - %s::%s\n" % (timestamp(), key, reply))
+    else:
+        reply = "*BAD*SOURCE*INDEX*"
 
-    elif (msg[0] == "GETKS"):
-        if (len(msg) == 3):
-            hdl  = int(msg[1])
-            key  = msg[2]
+    if debug_level > 2:  INFO("[dserver::process]  GETKS %s -> %s" % (key, reply))
 
-            try:
-                source = sources[hdl]
-            except:
-                source = None
+    return reply
 
-            if source != None:
-                if source.Data.has_key(key):
-                    reply             = "%d" % source.Data[key]
-                    source.Data[key] += 1
-                else:
-                    reply = "*NO*VALID*KEY*"
+#--------------------------------------------------------------------------
+
+def do_getk(msg):
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  GETK -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source = get_source(msg[1])
+    grp    = msg[2]
+
+    if source != None:
+        try:
+            g = source.Data[grp]
+        except:
+            g = None
+
+        if g != None:
+            rows = g.claim()
+            source.Dirty = True
+            if rows:
+                reply  = rows[0]
             else:
-                reply = "*BAD*SOURCE*INDEX*"
+                reply = "*Exhausted*"
+        else:
+            reply = "*BAD*GROUP*"
+
+        source.ufh.write("%s - %s::%s\n" % (timestamp(), grp, reply))
+    else:
+        reply = "*BAD*HANDLE*"
+
+    if debug_level > 2:  INFO("[dserver::process]  GETK %s -> %s" % (grp, reply))
+
+    return reply
+
+#--------------------------------------------------------------------------
+
+def do_getkr(msg):                  # Pick random element from keyed group
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  GETKR -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
 
-            source.ufh.write("%s - %s::%s\n" % (ts, key, reply))
-            source.ufh.flush()
+    source = get_source(msg[1])
+    grp    = msg[2]
+
+    if source != None:
+        try:
+            g = source.Data[grp]
+        except:
+            g = None
+
+        if g != None:
+            reply = g.pick()
+
+            if reply == None:
+                reply = "*Exhausted*"
         else:
-            ERROR("[dserver::process]  GETKS -> Bad Message '%s'" % str(msg))
-            reply = "*BAD*MESSAGE*"
+            reply = "*BAD*GROUP*"
+
+        source.ufh.write("%s - %s::%s\n" % (timestamp(), grp, reply))
+    else:
+        reply = "*BAD*HANDLE*"
+
+    if debug_level > 2:  INFO("[dserver::process]  GETKR %s -> %s" % (grp, reply))
+
+    return reply
+
+#--------------------------------------------------------------------------
+
+def do_geth(msg):
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  GETH -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source = get_source(msg[1])
+    key    = msg[2]
+
+    if source != None:
+        try:
+            reply = source.Data[key]
+        except:
+            reply = "*UNDEFINED*HASH*"
 
-        if debug_level > 2:  INFO("[dserver::process]  GETKS %s -> %s" % (key, reply))
+        source.ufh.write("%s - %s::%s\n" % (timestamp(), key, reply))
+    else:
+        reply = "*BAD*HANDLE*"
+
+    if debug_level > 2:  INFO("[dserver::process]  GETH %s -> %s" % (key, reply))
 
-    elif (msg[0] == "GETK"):
-        if (len(msg) == 3):
-            hdl  = int(msg[1])
-            grp  = msg[2]
+    return reply
+
+#--------------------------------------------------------------------------
 
+def do_geti(msg):
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  GETI -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source = get_source(msg[1])
+
+    try:
+        idx = int(msg[2])
+    except:
+        idx = None
+        ERROR("[dserver::process]  GETI -> Non integer index - [%s]" % msg[2])
+
+    if source != None:
+        if idx >= 0:
             try:
-                source = sources[hdl]
+                reply = source.Data[idx]
             except:
-                source = None
+                reply = "*OUT*OF*RANGE*"
+        else:
+            reply = "*INVALID*INDEX*"
 
-            if source != None:
-                try:
-                    g = source.Data[grp]
-                except:
-                    g = None
+        source.ufh.write("%s - %s::%s\n" % (timestamp(), idx, reply))
+    else:
+        reply = "*BAD*HANDLE*"
 
-                if g != None:
-                    if (g.Idx < len(g.Data)):
-                        reply  = g.Data[g.Idx]
-                        g.Idx += 1
-                    else:
-                        reply = "*Exhausted*"
-                else:
-                    reply = "*BAD*GROUP*"
+    if debug_level > 2:  INFO("[dserver::process]  GETI %s -> %s" % (idx, reply))
+
+    return reply
+
+#--------------------------------------------------------------------------
+
+def do_getb(msg):
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  GETB -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source      = get_source(msg[1])
+    barcode_key = msg[2]
+
+    if source != None:
+        if source.Data.has_key(barcode_key):
+            barcode = source.Data[barcode_key]
+
+            no    = (int(barcode.Range) * 1000000) + barcode.next_serial()
+
+            source.Dirty = True
+
+            bytes = list("%08d" % no)
+
+            sum   = 0
+
+            for idx in range(len(barcode_factors)):
+                sum += barcode_factors[idx] * int(bytes[idx])
+
+            chksum = sum % 11
+
+            if debug_level > 2:  print no, chksum
+
+            if chksum == 0:
+                chksum = 5
+            elif chksum == 1:
+                chksum = 0
             else:
-                reply = "*BAD*HANDLE*"
+                chksum = 11 - chksum
 
-            source.ufh.write("%s - %s::%s\n" % (ts, grp, reply))
-            source.ufh.flush()
+            reply = '%s%08d%d%s' % (barcode.Prefix, no, chksum, barcode.Country)
         else:
-            ERROR("[dserver::process]  GETK -> Bad Message '%s'" % str(msg))
-            reply = "*BAD*MESSAGE*"
+            reply = "*NO*VALID*KEY*"
 
-        if debug_level > 2:  INFO("[dserver::process]  GETK %s -> %s" % (grp, reply))
+        source.ufh.write("%s - %s::%s\n" % (timestamp(), barcode_key, reply))
+    else:
+        reply = "*BAD*SOURCE*INDEX*"
 
-    elif (msg[0] == "GETKR"):  # Pick random element from keyed group
-        if (len(msg) == 3):
-            hdl  = int(msg[1])
-            grp  = msg[2]
+    if debug_level > 2:  INFO("[dserver::process]  GETB %s -> %s" % (barcode_key, reply))
 
-            try:
-                source = sources[hdl]
-            except:
-                source = None
+    return reply
 
-            if source != None:
-                try:
-                    g = source.Data[grp]
-                except:
-                    g = None
+#--------------------------------------------------------------------------
 
-                if g != None:
-                    len_data = len(g.Data)
-                    if len_data > 0:
-                        idx = random.randint(0, len_data - 1)
-                        reply  = g.Data[idx]
-                    else:
-                        reply = "*Exhausted*"
-                else:
-                    reply = "*BAD*GROUP*"
-  
-            else:
-                reply = "*BAD*HANDLE*"
+def do_getnb(msg):                  # Claim a block of up to n rows
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  GETNB -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
 
-            source.ufh.write("%s - %s::%s\n" % (ts, grp, reply))
-            source.ufh.flush()
+    source = get_source(msg[1])
+    rows   = []
+
+    try:
+        n = int(msg[2])
+    except:
+        n = 0
+
+    if source == None:
+        reply = "*BAD*HANDLE*"
+    elif n <= 0:
+        reply = "*BAD*COUNT*"
+    else:
+        (reply, rows) = source.get_block(n)
+
+    if source != None:
+        ts = timestamp()
+        if rows:
+            source.ufh.write("".join(["%s - %s\n" % (ts, row) for row in rows]))
         else:
-            ERROR("[dserver::process]  GETK -> Bad Message '%s'" % str(msg))
-            reply = "*BAD*MESSAGE*"
+            source.ufh.write("%s - %s\n" % (ts, reply))
 
-        if debug_level > 2:  INFO("[dserver::process]  GETK %s -> %s" % (grp, reply))
+    if debug_level > 2:  INFO("[dserver::process]  GETNB -> %s" % reply)
 
-    elif (msg[0] == "GETH"):
-        if (len(msg) == 3):
-            hdl  = int(msg[1])
-            key  = msg[2]
+    return reply
 
-            try:
-                source = sources[hdl]
-            except:
-                source = None
+#--------------------------------------------------------------------------
 
-            if source != None:
-                try:
-                    reply = source.Data[key]
-                except:
-                    reply = "*UNDEFINED*HASH*"
+def do_getkb(msg):                  # Claim a block of up to n rows from a group
+    if (len(msg) != 4):
+        ERROR("[dserver::process]  GETKB -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source = get_source(msg[1])
+    grp    = msg[2]
+    rows   = []
+
+    try:
+        n = int(msg[3])
+    except:
+        n = 0
+
+    if source != None:
+        try:
+            g = source.Data[grp]
+        except:
+            g = None
+
+        if g == None:
+            reply = "*BAD*GROUP*"
+        elif n <= 0:
+            reply = "*BAD*COUNT*"
+        else:
+            rows = g.claim(n)
+            source.Dirty = True
+            if rows:
+                reply = ROW_SEPARATOR.join(rows)
             else:
-                reply = "*BAD*HANDLE*"
+                reply = "*Exhausted*"
 
-            source.ufh.write("%s - %s::%s\n" % (ts, key, reply))
-            source.ufh.flush()
+        ts = timestamp()
+        if rows:
+            source.ufh.write("".join(["%s - %s::%s\n" % (ts, grp, row) for row in rows]))
         else:
-            ERROR("[dserver::process]  GETH -> Bad Message", msg)
-            return "*BAD*MESSAGE*"
+            source.ufh.write("%s - %s::%s\n" % (ts, grp, reply))
+    else:
+        reply = "*BAD*HANDLE*"
 
-        if debug_level > 2:  INFO("[dserver::process]  GETH %s -> %s" % (key, reply))
+    if debug_level > 2:  INFO("[dserver::process]  GETKB -> %s" % reply)
 
-    elif (msg[0] == "GETI"):
-        if (len(msg) == 3):
-            hdl    = int(msg[1])
+    return reply
 
-            try:
-                idx = int(msg[2])
-            except:
-                idx = None
-                ERROR("[dserver::process]  GETI -> Non integer index - [%s]" % msg[2])
+#--------------------------------------------------------------------------
 
-            try:
-                source = sources[hdl]
-            except:
-                source = None
+def do_getir(msg):                  # Range of up to n rows from index start
+    if (len(msg) != 4):
+        ERROR("[dserver::process]  GETIR -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
 
-            if source != None:
-                if idx >= 0:
-                    try:
-                        reply = source.Data[idx]
-                    except:
-                        reply = "*OUT*OF*RANGE*"
-                else:
-                    reply = "*INVALID*INDEX*"
-            else:
-                reply = "*BAD*HANDLE*"
+    source = get_source(msg[1])
+    rows   = []
 
-            source.ufh.write("%s - %s::%s\n" % (ts, idx, reply))
-            source.ufh.flush()
+    try:
+        idx = int(msg[2])
+        n   = int(msg[3])
+    except:
+        idx = None
+        n   = 0
+        ERROR("[dserver::process]  GETIR -> Non integer index or count - %s" % msg[2:])
+
+    if source != None:
+        if ((idx >= 0) and (idx < len(source.Data)) and (n > 0)):
+            rows  = source.Data[idx:idx + n]
+            reply = ROW_SEPARATOR.join(rows)
+        elif idx >= 0:
+            reply = "*OUT*OF*RANGE*"
         else:
-            ERROR("[dserver::process]  GETI -> Bad Message '%s'" % str(msg))
-            reply = "*BAD*MESSAGE*"
+            reply = "*INVALID*INDEX*"
 
-        if debug_level > 2:  INFO("[dserver::process]  GETI %s -> %s" % (idx, reply))
+        ts = timestamp()
+        if rows:
+            source.ufh.write("".join(["%s - %s::%s\n" % (ts, idx + i, rows[i]) for i in xrange(len(rows))]))
+        else:
+            source.ufh.write("%s - %s::%s\n" % (ts, idx, reply))
+    else:
+        reply = "*BAD*HANDLE*"
 
-    elif (msg[0] == "GETB"):
-        if (len(msg) == 3):
-            hdl         = int(msg[1])
-            barcode_key = msg[2]
+    if debug_level > 2:  INFO("[dserver::process]  GETIR -> %s" % reply)
 
-            try:
-                source = sources[hdl]
-            except:
-                source = None
+    return reply
 
-            if source != None:
-                if source.Data.has_key(barcode_key):
-                    barcode = source.Data[barcode_key]
+#--------------------------------------------------------------------------
 
-                    no    = (int(barcode.Range) * 1000000) + barcode.Serial
+def do_getw(msg):                  # Draw a row in proportion to the weights
+    if (len(msg) != 2):
+        ERROR("[dserver::process]  GETW -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
 
-                    bytes = list("%08d" % no)
+    source = get_source(msg[1])
 
-                    sum   = 0
+    if source == None:
+        reply = "*BAD*SOURCE*INDEX*"
+    elif source.Type != "Weighted":
+        reply = "*UNKNOWN*SOURCE*TYPE*"
+    elif len(source.Data) == 0:
+        reply = "*Exhausted*"
+    else:                             # Not logged as used - a draw uses nothing up
+        reply = source.draw()[0]
 
-                    for idx in range(len(barcode_factors)):
-                        sum += barcode_factors[idx] * int(bytes[idx])
+    if debug_level > 2:  INFO("[dserver::process]  GETW -> %s" % reply)
 
-                    chksum = sum % 11
+    return reply
 
-                    print no, chksum
+#--------------------------------------------------------------------------
 
-                    if chksum == 0:
-                        chksum = 5
-                    elif chksum == 1:
-                        chksum = 0
-                    else:
-                        chksum = 11 - chksum
+def do_getwb(msg):                 # Draw n rows in proportion to the weights
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  GETWB -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
 
-                    reply = '%s%08d%d%s' % (barcode.Prefix, no, chksum, barcode.Country)
+    source = get_source(msg[1])
 
-                    barcode.Serial += 1
-                else:
-                    reply = "*NO*VALID*KEY*"
-            else:
-                reply = "*BAD*SOURCE*INDEX*"
+    try:
+        n = int(msg[2])
+    except:
+        n = 0
+
+    if source == None:
+        reply = "*BAD*SOURCE*INDEX*"
+    elif source.Type != "Weighted":
+        reply = "*UNKNOWN*SOURCE*TYPE*"
+    elif (n <= 0) or (n > MAX_DRAWS):
+        reply = "*BAD*COUNT*"
+    elif len(source.Data) == 0:
+        reply = "*Exhausted*"
+    else:                             # Not logged as used - see do_getw()
+        rows  = source.draw(n)
+        reply = ROW_SEPARATOR.join(rows)
+
+    if debug_level > 2:  INFO("[dserver::process]  GETWB -> %s" % reply)
+
+    return reply
+
+#--------------------------------------------------------------------------
+
+def do_checkout(msg):              # Lease the next CSV row - back to the source unless COMMITted in time
+    if (len(msg) not in (2, 3)):
+        ERROR("[dserver::process]  CHECKOUT -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source = get_source(msg[1])
+
+    try:
+        if len(msg) == 3:
+            ttl = float(msg[2])
+        else:
+            ttl = lease_ttl
+    except ValueError:
+        ttl = 0
+
+    if source == None:
+        reply = "*BAD*SOURCE*INDEX*"
+    elif source.Type != "CSV":
+        reply = "*UNKNOWN*SOURCE*TYPE*"
+    elif not (0 < ttl < float('inf')):
+        reply = "*BAD*TTL*"
+    else:
+        rows = source.claim()
 
-            source.ufh.write("%s - %s::%s\n" % (ts, barcode_key, reply))
-            source.ufh.flush()
+        if rows:
+            reply = leases.checkout(source, rows[0], ttl) + ROW_SEPARATOR + rows[0]
         else:
-            ERROR("[dserver::process]  GETB -> Bad Message '%s'" % str(msg))
-            reply = "*BAD*MESSAGE*"
+            reply = "*Exhausted*"
 
-        if debug_level > 2:  INFO("[dserver::process]  GETB %s -> %s" % (barcode_key, reply))
+    if debug_level > 2:  INFO("[dserver::process]  CHECKOUT -> %s" % reply)
 
-    elif (msg[0] == "STOC"):
-        if (len(msg) == 3):
-            hdl   = int(msg[1])
-            data  = msg[2]
-            reply = "0"
+    return reply
 
-            try:
-                source = sources[hdl]
-            except:
-                source = None
+#--------------------------------------------------------------------------
 
-            if source != None:
-                source.Data.append(data)
+def do_commit(msg):                # A leased row is used - it does not go back
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  COMMIT -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
 
-                if source.Idx == None:
-                    source.Idx = 0
+    source = get_source(msg[1])
+    row    = None
 
-                source.sfh.write("%s - %s\n" % (ts, data))
-                source.sfh.flush()
+    if source != None:
+        row = leases.end(source, msg[2])
 
-                if debug_level > 1:  INFO("STOC %s" % data)
+    if source == None:
+        reply = "*BAD*SOURCE*INDEX*"
+    elif row == None:
+        reply = "*UNKNOWN*LEASE*"
+    else:
+        source.ufh.write("%s - %s\n" % (timestamp(), row))     # Only now is the row used
+        reply = "1"
 
-                reply = "1"
-            else:
-                reply = "*BAD*HANDLE*"
-        else:
-            ERROR("[dserver::process]  STOC -> Bad Message '%s'" % str(msg))
-            reply = "*BAD*MESSAGE*"
+    if debug_level > 2:  INFO("[dserver::process]  COMMIT %s -> %s" % (msg[2], reply))
+
+    return reply
 
-        if debug_level > 2:  INFO("[dserver::process]  STOC %s -> %s" % (data, reply))
+#--------------------------------------------------------------------------
 
-    elif (msg[0] == "STOK"):
-        if (len(msg) == 4):
-            hdl  = int(msg[1])
-            grp  = msg[2]
-            data = msg[3]
+def do_release(msg):               # A leased row was not used - it goes back now
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  RELEASE -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
 
-            reply = "0"
+    source = get_source(msg[1])
+    row    = None
 
-            try:
-                source = sources[hdl]
-            except:
-                source = None
-
-            if source != None:
-                if source.Data.has_key(grp):
-                    g                = source.Data[grp]
-                else:  # Add a new group!
-                    g                = Group(grp)
-                    source.Data[grp] = g
-                if g != None:
-                    g.Data.append(data)
-                    if debug_level > 1:  INFO("STOK %s %s" % (grp, data))
-                    source.sfh.write("%s - %s::%s\n" % (ts, grp, data))
-                    source.sfh.flush()
-                reply = "1"
-            else:
-                reply = "*BAD*HANDLE*"
-        else:
-            ERROR("[dserver::process]  STOK -> Bad Message '%s'" % str(msg))
-            reply = "*BAD*MESSAGE*"
+    if source != None:
+        row = leases.end(source, msg[2])
 
-        if debug_level > 2:  INFO("[dserver::process]  STOK %s %s -> %s" % (grp, data, reply))
+    if source == None:
+        reply = "*BAD*SOURCE*INDEX*"
+    elif row == None:
+        reply = "*UNKNOWN*LEASE*"
+    else:
+        source.give_back(row)
+        reply = "1"
+
+    if debug_level > 2:  INFO("[dserver::process]  RELEASE %s -> %s" % (msg[2], reply))
 
     return reply
 
 #--------------------------------------------------------------------------
 
+def do_stoc(msg):
+    if (len(msg) != 3):
+        ERROR("[dserver::process]  STOC -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source = get_source(msg[1])
+    data   = msg[2]
+
+    if source != None:
+        source.store(data)
+
+        source.sfh.write("%s - %s\n" % (timestamp(), data))
+
+        if debug_level > 1:  INFO("STOC %s" % data)
+
+        reply = "1"
+    else:
+        reply = "*BAD*HANDLE*"
+
+    if debug_level > 2:  INFO("[dserver::process]  STOC %s -> %s" % (data, reply))
+
+    return reply
+
+#--------------------------------------------------------------------------
+
+def do_stok(msg):
+    if (len(msg) != 4):
+        ERROR("[dserver::process]  STOK -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source = get_source(msg[1])
+    grp    = msg[2]
+    data   = msg[3]
+
+    if source != None:
+        g = source.group(grp)
+        if g != None:
+            g.store(data)
+            source.Dirty = True
+            if debug_level > 1:  INFO("STOK %s %s" % (grp, data))
+            source.sfh.write("%s - %s::%s\n" % (timestamp(), grp, data))
+        reply = "1"
+    else:
+        reply = "*BAD*HANDLE*"
+
+    if debug_level > 2:  INFO("[dserver::process]  STOK %s %s -> %s" % (grp, data, reply))
+
+    return reply
+
+#--------------------------------------------------------------------------
+
+def do_stats(msg):                 # Counters, latency histograms and gauges
+    return metrics.text()
+
+#--------------------------------------------------------------------------
+
+def do_flush(msg):                 # Checkpoint now - does not wait for it
+    dirty = len([source for source in sources if source.Dirty and source.Type in CHECKPOINT_TYPES])
+
+    checkpoint_event.set()
+
+    return "%d" % dirty
+
+#--------------------------------------------------------------------------
+
+def do_compact(msg):               # Drop handed out rows from the .dat at the next checkpoint
+    if (len(msg) != 2):
+        ERROR("[dserver::process]  COMPACT -> Bad Message '%s'" % str(msg))
+        return "*BAD*MESSAGE*"
+
+    source = get_source(msg[1])
+
+    if source == None:
+        reply = "*BAD*SOURCE*INDEX*"
+    elif source.Type not in CURSOR_TYPES:
+        reply = "*UNKNOWN*SOURCE*TYPE*"
+    else:
+        source.Compact = True
+        checkpoint_event.set()
+        reply = "1"
+
+    if debug_level > 2:  INFO("[dserver::process]  COMPACT %s -> %s" % (msg[1], reply))
+
+    return reply
+
+#--------------------------------------------------------------------------
+
+HANDLERS = {                        # process() dispatch table
+    'INIT'   : do_init,
+    'REG'    : do_reg,
+    'REGK'   : do_regk,
+    'REGI'   : do_regi,
+    'GETN'   : do_getn,
+    'GETKS'  : do_getks,
+    'GETK'   : do_getk,
+    'GETKR'  : do_getkr,
+    'GETH'   : do_geth,
+    'GETI'   : do_geti,
+    'GETB'   : do_getb,
+    'GETNB'  : do_getnb,
+    'GETKB'  : do_getkb,
+    'GETIR'  : do_getir,
+    'GETW'   : do_getw,
+    'GETWB'  : do_getwb,
+    'CHECKOUT': do_checkout,
+    'COMMIT' : do_commit,
+    'RELEASE': do_release,
+    'STOC'   : do_stoc,
+    'STOK'   : do_stok,
+    'STATS'  : do_stats,
+    'FLUSH'  : do_flush,
+    'COMPACT': do_compact,
+}
+
+#--------------------------------------------------------------------------
+
 def sig_term(signum, frame):
-    "SIGTERM handler"
+    """
+    SIGTERM handler - only asks serve() to stop.  The main thread may be
+    waiting for room in the worker queue, or part way through a lock
+    shutdown() needs, so the flush is left until serve() has returned.
+    """
+
+    global shutdown_flg
 
-    shutdown()
+    shutdown_flg = True
 
 #--------------------------------------------------------------------------
 
@@ -1419,8 +2444,13 @@ def shutdown():
 
     print "\n"
 
-    for i in range(len(sources)):
-        sources[i].flush()
+    stop_leases()                    # Rows out on lease go back before the journals close
+    stop_journal()
+    stop_checkpoint()
+
+    with checkpoint_lock:
+        for i in range(len(sources)):
+            sources[i].flush()
 
     print "*SHUTDOWN*"
 
@@ -1537,10 +2567,102 @@ def init_logging():
     log.addHandler(hdlr)
     log.setLevel(logging.INFO)
 
+    dscore.log = log                 # The shared code logs to the same file
+
     INFO("Server startup at %s" % datetime.now())
 
 #--------------------------------------------------------------------------
 
+def load_sources():
+    "Read in every deferred source, in dserver.ini order"
+
+    t_start = time.time()
+
+    for source in sources:
+        source.load()
+
+    INFO("All sources loaded in %.3fs" % (time.time() - t_start))
+
+#--------------------------------------------------------------------------
+
+def parse_source(i):
+    "Run in a loader process - read source i in, return it marshalled"
+
+    source  = sources[i]
+    t_start = time.time()
+
+    try:
+        rc = source.read_in()
+    except SystemExit:
+        rc = None
+
+    if rc:
+        state = marshal.dumps((rc, source.export()))
+    else:
+        state = None
+
+    return (i, state, time.time() - t_start)
+
+#--------------------------------------------------------------------------
+
+def load_parallel():
+    "Parse the deferred sources in loaders processes and adopt the results"
+
+    t_start  = time.time()
+    deferred = [source for source in sources if not source.Valid]
+    parallel = []
+
+    for i in range(len(sources)):
+        if sources[i].Valid:
+            continue
+
+        state = snapshot_flg and sources[i].read_snapshot()
+
+        if state or sources[i].Storage == 'mmap' or sources[i].Type == 'Barcodes':   # Nothing to parse - or it can't be sent
+            sources[i].load(state or None)
+        else:
+            parallel.append(i)
+
+    no_loaders = min(loaders, len(parallel), multiprocessing.cpu_count())
+
+    if no_loaders < 2:                           # Not worth the transfer
+        for i in parallel:
+            sources[i].load()
+    else:
+        pool = multiprocessing.Pool(no_loaders)
+
+        try:
+            for (i, state, parsed) in pool.imap_unordered(parse_source, parallel):
+                INFO("Parsed %s in %.3fs by a loader" % (sources[i].Name, parsed))
+
+                if state:
+                    sources[i].load(marshal.loads(state))
+        finally:
+            pool.close()
+            pool.join()
+
+    for source in deferred:
+        if not source.Valid:
+            print "[dserver]  Load failed [%s]" % source.Name
+            sys.exit(1)
+
+        INFO(str(source))
+
+        print "Loaded %s" % str(source)
+
+    INFO("All sources loaded in %.3fs by %d loaders" % (time.time() - t_start, max(no_loaders, 1)))
+
+#--------------------------------------------------------------------------
+
+def start_loader():
+    global loader_thread
+
+    loader_thread = threading.Thread(target=load_sources, name='Loader')
+    loader_thread.setDaemon(True)
+    loader_thread.start()
+
+#--------------------------------------------------------------------------
+
 def init_server():
     pid = check_running()
 
@@ -1558,11 +2680,32 @@ def init_server():
     if (not silent_flg):
         INFO("Server PID is %d" % pid)
 
+    init_journal()
+    init_checkpoint(checkpoint_interval, CHECKPOINT_TYPES)
+    init_leases()
+
     print "[dshttpd]  Listening on port %s - Data from %s/%s" % (PORT, os.getcwd(), ENVIRONMENT)
 
     try:
-        httpd = MultiThreadedHTTPServer((HOST, PORT), RequestHandler)
-        httpd.serve_forever()
+        if pool_workers > 0:
+            ThreadPoolHTTPServer.numThreads = pool_workers
+            ThreadPoolHTTPServer.queueSize  = pool_queue
+            ThreadPoolHTTPServer.overflow   = pool_overflow
+
+            httpd = ThreadPoolHTTPServer((HOST, PORT), RequestHandler)
+            httpd.start_pool()
+
+            metrics.Pool = httpd
+
+            INFO("[dshttpd]  Pool of %d workers - queue %d (%s)" % (pool_workers, pool_queue, pool_overflow))
+        else:
+            httpd = MultiThreadedHTTPServer((HOST, PORT), RequestHandler)
+
+        if load_mode == 'background':
+            start_loader()
+
+        serve(httpd)
+        shutdown()
     except KeyboardInterrupt:
         print '^C received, shutting down server'
         httpd.socket.close()
@@ -1571,6 +2714,21 @@ def init_server():
 
 #--------------------------------------------------------------------------
 
+def serve(httpd, poll_interval=0.5):
+    """
+    Accept connections until SIGTERM sets shutdown_flg - serve_forever()
+    can only be stopped from another thread.
+    """
+
+    httpd.timeout = poll_interval
+
+    while not shutdown_flg:
+        httpd.handle_request()
+
+    httpd.server_close()
+
+#--------------------------------------------------------------------------
+
 def terminate(pid=None):
     if pid:
         dserver_pid = pid
@@ -1648,6 +2806,7 @@ def main():
             terminate_flg  = True
         elif o == '-v':
             verbose_flg    = True
+            dscore.verbose_flg = True
         elif o == '-V':
             print "[dserver]  Version: %s" % __version__
             return 1
@@ -33,6 +33,7 @@ import sys
 import getopt
 
 import dserver
+import dscore
 
 #---------------------------------------------------------------------
 
@@ -126,6 +127,7 @@ class Source:
       self.File        = "%s/%s.dat" % (environment, name)
       self.Used        = "%s/tmp/%s.used" % (environment, name)
       self.Stored      = "%s/tmp/%s.stored" % (environment, name)
+      self.Cursor      = "%s/tmp/%s.cur" % (environment, name)
       self.Comments    = []
 
       if debug_level > 2:
@@ -268,10 +270,13 @@ class Source:
 
          line = line.strip()
 
-         if (line.find("[") != -1):
+         if (line.find("[") != -1):     # STOK rows are appended as further sections
             group_name            = line.replace('[','').replace(']','')
-            group                 = Group(group_name)
-            self.Data[group_name] = group
+            group                 = self.Data.get(group_name)
+
+            if group == None:
+               group                 = Group(group_name)
+               self.Data[group_name] = group
             continue
 
          if p_comment.match(line):
@@ -384,6 +389,39 @@ class Source:
 
    #------------------------------------------------------------------
 
+   def read_cursor(self):
+      "Group name -> rows of the .dat the server has handed out - {} if there is no cursor"
+
+      try:
+         f = open(self.Cursor, 'r')
+      except IOError:
+         return {}
+
+      key       = None
+      positions = {}
+
+      try:
+         for line in f:
+            line = line.strip()
+
+            if p_comment.match(line) or not line:
+               continue
+            elif line.startswith('dat '):
+               key = tuple([int(field) for field in line.split()[1:4]])
+            elif line.startswith('group '):
+               (name, n) = line[6:].rsplit(' ', 1)
+               positions[name] = int(n)
+      finally:
+         f.close()
+
+      if (key == None) or (len(key) != 3) or (key != dscore.cursor_key(self.File, key[1])):
+         print "[recover]  Cursor %s does not match %s - ignoring it" % (self.Cursor, self.File)
+         return {}
+
+      return positions
+
+   #------------------------------------------------------------------
+
    def recover_keyed(self):
       """
       20110719175608 - AUSYDBTHBKKB::EE160567961AU,dbc3c1ae-8ee1-4ad5-8fd7-4f274cd60303,2011-07-19 17:56:07
@@ -406,10 +444,30 @@ class Source:
 
          print "%s [%d]:" % (group_tag, group.orig_no_rows)
 
-         group.last_data  = group.Data[group.orig_no_rows-1]
+         if group.orig_no_rows > 0:
+            group.last_data  = group.Data[group.orig_no_rows-1]
+         else:
+            group.last_data  = None
+
          group.Used       = []
          group.Stored     = []
 
+      # Drop the rows the cursor says were handed out...
+
+      positions = self.read_cursor()
+
+      if positions:
+         print
+         print "Cursor:"
+
+         for group_tag in group_tags:
+            group = self.Data[group_tag]
+            n     = min(positions.get(group_tag, 0), len(group.Data))
+
+            del group.Data[:n]
+
+            print "%s [%d]:" % (group_tag, n)
+
       # Recover the stored items...
 
       cnt = 0
@@ -669,12 +727,15 @@ class Source:
          group = self.Data[group_tag]
 
          no_rows = len(group.Data)
-         first_row = group.Data[0]
-         last_row  = group.Data[no_rows-1]
          print "%s [%d]:" % (group_tag, no_rows)
-         print "  %s" % first_row
-         print "  ..."
-         print "  %s" % last_row
+
+         if no_rows > 0:
+            first_row = group.Data[0]
+            last_row  = group.Data[no_rows-1]
+            print "  %s" % first_row
+            print "  ..."
+            print "  %s" % last_row
+
          print
 
    #------------------------------------------------------------------
@@ -901,6 +962,9 @@ def recover_keyed(source):
 
    source.flush_keyed(recover=True)
 
+   if os.path.exists(source.Cursor):   # The .rec holds only the rows still to be handed out
+      print "Delete %s before serving %s.rec as the .dat" % (source.Cursor, source.Name)
+
 #---------------------------------------------------------------------
 
 def recover_keyed_sequence(source):